@@ -1,34 +1,91 @@
 # app_factory.py
-import os
+import logging, os
 from flask import Flask, request
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager
-from routes import auth, user, data_room, file, folder
+from routes import auth, user, data_room, changes, file, folder, upload, batch, metrics
 from database import initialize_database
+from database.usage import USER_QUOTA_BYTES, recount_usage_command
+from database.changes import CHANGE_RETENTION
+from metrics import SLOW_REQUEST_SECONDS, init_metrics
+from green import is_green
+from database.engine import MAX_OVERFLOW, POOL_RECYCLE, POOL_SIZE, POOL_TIMEOUT, REPLICA_BIND, SQLITE_BUSY_TIMEOUT, SQLITE_JOURNAL_MODE, SQLITE_MMAP_SIZE, SQLITE_SYNCHRONOUS
+from purge import PURGE_INTERVAL, purge_command, start_purge_worker
+from storage import UPLOAD_SESSION_TTL, encrypt_blobs_command, init_storage
+from storage.backends import S3_MAX_CONNECTIONS, S3_PRESIGN_EXPIRES
+from search import SEARCH_WORKERS, search_index_command, start_text_extractor
+from previews import PREVIEW_CACHE_SIZE, PREVIEW_WORKERS, start_preview_renderer
 
 def create_app():
     app = Flask(__name__)
 
+    # Log to stderr at LOG_LEVEL, unless the server already configured logging
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
     # Set the SQLALchemy database URI from environment variable or use a local SQLite database
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL') or 'sqlite:///database/data.db'
+    # GET views marked @read_replica read from DATABASE_REPLICA_URL when it is set
+    if os.environ.get('DATABASE_REPLICA_URL'):
+        app.config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: os.environ['DATABASE_REPLICA_URL']}
+    # Connection pool of each engine (database/engine.py)
+    app.config['DATABASE_POOL_SIZE'] = int(os.environ.get('DATABASE_POOL_SIZE', POOL_SIZE))
+    app.config['DATABASE_MAX_OVERFLOW'] = int(os.environ.get('DATABASE_MAX_OVERFLOW', MAX_OVERFLOW))
+    app.config['DATABASE_POOL_TIMEOUT'] = int(os.environ.get('DATABASE_POOL_TIMEOUT', POOL_TIMEOUT))
+    app.config['DATABASE_POOL_RECYCLE'] = int(os.environ.get('DATABASE_POOL_RECYCLE', POOL_RECYCLE))
+    # SQLite pragmas, busy timeout in milliseconds and memory map in bytes
+    app.config['SQLITE_JOURNAL_MODE'] = os.environ.get('SQLITE_JOURNAL_MODE', SQLITE_JOURNAL_MODE)
+    app.config['SQLITE_BUSY_TIMEOUT'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT', SQLITE_BUSY_TIMEOUT))
+    app.config['SQLITE_SYNCHRONOUS'] = os.environ.get('SQLITE_SYNCHRONOUS', SQLITE_SYNCHRONOUS)
+    app.config['SQLITE_MMAP_SIZE'] = int(os.environ.get('SQLITE_MMAP_SIZE', SQLITE_MMAP_SIZE))
     # Disable SQLAlchemy modification tracker due to performance overhead
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     # Set the JWT secret key from environment variable or generate a new one
     app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY') or 'TEST_SECRET_KEY'
+    # Set the master key that wraps the key of every stored file, as URL-safe base64
+    # of 32 random bytes, from environment variable or use a development key
+    app.config['ENCRYPTION_KEY'] = os.environ.get('ENCRYPTION_KEY') or 'VEVTVF9FTkNSWVBUSU9OX0tFWV9fX19fX19fX19fX18='
 
-    # Set the UPLOAD_FOLDER configuration using a relative path
+    # Set the UPLOAD_FOLDER configuration from environment variable or use a relative path
     current_script_directory = os.path.dirname(os.path.abspath(__file__))
-    app.config['UPLOAD_FOLDER'] = os.path.join(current_script_directory, 'uploads')
+    app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER') or os.path.join(current_script_directory, 'uploads')
+
+    # Blobs are kept under UPLOAD_FOLDER, or in an S3-compatible bucket with
+    # STORAGE_BACKEND=s3. Credentials come from the usual AWS environment variables.
+    app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'local')
+    app.config['S3_BUCKET'] = os.environ.get('S3_BUCKET')
+    app.config['S3_PREFIX'] = os.environ.get('S3_PREFIX', 'blobs/')
+    app.config['S3_ENDPOINT_URL'] = os.environ.get('S3_ENDPOINT_URL')
+    app.config['S3_REGION'] = os.environ.get('S3_REGION')
+    app.config['S3_MAX_CONNECTIONS'] = int(os.environ.get('S3_MAX_CONNECTIONS', S3_MAX_CONNECTIONS))
+    app.config['S3_PRESIGN_EXPIRES'] = int(os.environ.get('S3_PRESIGN_EXPIRES', S3_PRESIGN_EXPIRES))
+    # Let the bucket encrypt at rest ('AES256' or 'aws:kms'), which allows presigned downloads
+    app.config['S3_SERVER_SIDE_ENCRYPTION'] = os.environ.get('S3_SERVER_SIDE_ENCRYPTION')
+    init_storage(app)
 
     # Initialize database
     initialize_database(app)
 
+    # Bytes each user may store, unless set per user in user.quota_bytes. 0 for no
+    # limit. `flask recount-usage` rebuilds the usage totals from the files.
+    app.config['USER_QUOTA_BYTES'] = int(os.environ.get('USER_QUOTA_BYTES', USER_QUOTA_BYTES))
+    app.cli.add_command(recount_usage_command)
+
+    # Seconds data room change logs are kept for sync clients to catch up
+    app.config['CHANGE_RETENTION'] = int(os.environ.get('CHANGE_RETENTION', CHANGE_RETENTION))
+
     # Initialize JWTManager
     jwt = JWTManager(app)
 
     # Initialize CORS
     CORS(app)
 
+    # Request latency, SQL and storage metrics, scraped at GET /metrics. Requests
+    # slower than SLOW_REQUEST_SECONDS are logged with their slowest queries.
+    app.config['SLOW_REQUEST_SECONDS'] = float(os.environ.get('SLOW_REQUEST_SECONDS', SLOW_REQUEST_SECONDS))
+    # Bearer token Prometheus scrapes with, /metrics is disabled without one
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+    init_metrics(app)
+
     # Set CORS options on preflight requests
     @app.before_request
     def before_request():
@@ -49,5 +106,37 @@ def create_app():
     app.register_blueprint(data_room.data_room_routes)
     app.register_blueprint(file.file_routes)
     app.register_blueprint(folder.folder_routes)
+    app.register_blueprint(upload.upload_routes)
+    app.register_blueprint(batch.batch_routes)
+    app.register_blueprint(metrics.metrics_routes)
+    # Change feeds wait for minutes, only gevent workers (transfers.py) serve them
+    if is_green():
+        app.register_blueprint(changes.change_routes)
+
+    # Files stored before encryption at rest are encrypted with `flask encrypt-blobs`
+    app.cli.add_command(encrypt_blobs_command)
+
+    # Deleted data rooms and folders are removed in the background, set
+    # PURGE_INTERVAL=0 to disable the worker and run `flask purge` instead
+    app.cli.add_command(purge_command)
+    app.config['PURGE_INTERVAL'] = float(os.environ.get('PURGE_INTERVAL', PURGE_INTERVAL))
+    # The purge also removes upload sessions that received no chunk for this many seconds
+    app.config['UPLOAD_SESSION_TTL'] = int(os.environ.get('UPLOAD_SESSION_TTL', UPLOAD_SESSION_TTL))
+    if app.config['PURGE_INTERVAL'] > 0:
+        start_purge_worker(app, app.config['PURGE_INTERVAL'])
+
+    # Uploaded PDFs are indexed for search by a pool of extraction processes, set
+    # SEARCH_WORKERS=0 to disable it and run `flask search-index` instead
+    app.cli.add_command(search_index_command)
+    app.config['SEARCH_WORKERS'] = int(os.environ.get('SEARCH_WORKERS', SEARCH_WORKERS))
+    if app.config['SEARCH_WORKERS'] > 0:
+        start_text_extractor(app, app.config['SEARCH_WORKERS'])
+
+    # PDF thumbnails and page images are rendered by a pool of processes into a
+    # disk cache of at most PREVIEW_CACHE_SIZE bytes. PREVIEW_WORKERS=0 renders
+    # them inline on first request instead.
+    app.config['PREVIEW_WORKERS'] = int(os.environ.get('PREVIEW_WORKERS', PREVIEW_WORKERS))
+    app.config['PREVIEW_CACHE_SIZE'] = int(os.environ.get('PREVIEW_CACHE_SIZE', PREVIEW_CACHE_SIZE))
+    start_preview_renderer(app, app.config['PREVIEW_WORKERS'], app.config['PREVIEW_CACHE_SIZE'])
     
     return app
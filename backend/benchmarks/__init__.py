@@ -0,0 +1,4 @@
+# benchmarks/__init__.py
+from .dataset import Dataset, build_dataset
+from .load import SCENARIOS, run_load
+from .report import REGRESSION_THRESHOLD, compare, summarize
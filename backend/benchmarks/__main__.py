@@ -0,0 +1,95 @@
+# benchmarks/__main__.py
+import os, shutil, sys, tempfile, time
+import click
+from app_factory import create_app
+from .dataset import build_dataset
+from .load import SCENARIOS, run_load, serve_every_route
+from .report import REGRESSION_THRESHOLD, compare, environment, format_run, load, save, summarize
+
+'''
+Benchmark suite, run from backend/:
+
+    python -m benchmarks run --folders 10000 --files 100000 --concurrency 1,8 --output head.json
+    python -m benchmarks compare base.json head.json
+
+`run` builds a synthetic dataset in a throwaway SQLite database and upload
+folder (or in the empty database at --database-url), creates the app with
+create_app() and drives it with each concurrency level in turn, change feeds
+included although only the gevent app serves them (see load.py). The same seed
+and sizes give the same dataset, so results of two commits can be compared.
+`compare` exits with status 1 when an endpoint regressed.
+'''
+
+
+@click.group()
+def cli():
+    '''Load tests against a synthetic dataset.'''
+
+
+@cli.command()
+@click.option('--users', default=2, show_default=True, help='Synthetic users.')
+@click.option('--rooms', default=2, show_default=True, help='Data rooms per user.')
+@click.option('--folders', default=10000, show_default=True, help='Folders, over all rooms.')
+@click.option('--files', default=100000, show_default=True, help='Files, over all rooms.')
+@click.option('--depth', default=8, show_default=True, help='Deepest folder level.')
+@click.option('--blobs', default=50, show_default=True, help='Distinct PDFs the files share.')
+@click.option('--seed', default=0, show_default=True)
+@click.option('--concurrency', default='1,8', show_default=True, help='Comma-separated client thread counts, one run each.')
+@click.option('--duration', default=30.0, show_default=True, help='Recorded seconds per run.')
+@click.option('--warmup', default=5.0, show_default=True, help='Unrecorded seconds before each run.')
+@click.option('--scenarios', default=None, help='Comma-separated scenarios to run, all by default.')
+@click.option('--database-url', default=None, help='Empty database to use instead of a temporary SQLite file.')
+@click.option('--output', default='benchmark.json', show_default=True, type=click.Path(dir_okay=False))
+@click.option('--keep', is_flag=True, help='Keep the temporary database and uploads.')
+def run(users, rooms, folders, files, depth, blobs, seed, concurrency, duration, warmup, scenarios, database_url, output, keep):
+    '''Build the dataset, run the load and save the results as JSON.'''
+    levels = [int(level) for level in concurrency.split(',')]
+    selected = scenarios.split(',') if scenarios else None
+    unknown = set(selected or ()) - set(SCENARIOS)
+    if unknown:
+        raise click.BadParameter(f"unknown scenarios {', '.join(sorted(unknown))}, choose from {', '.join(SCENARIOS)}", param_hint='--scenarios')
+
+    directory = tempfile.mkdtemp(prefix='dataroom-benchmark-')
+    # create_app reads its configuration from the environment
+    os.environ['DATABASE_URL'] = database_url or 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+    os.environ['UPLOAD_FOLDER'] = os.path.join(directory, 'uploads')
+    try:
+        app = create_app()
+        serve_every_route(app)
+        started = time.perf_counter()
+        with app.app_context():
+            dataset = build_dataset(users=users, rooms_per_user=rooms, folders=folders, files=files, max_depth=depth, blobs=blobs, seed=seed)
+            dialect = app.extensions['sqlalchemy'].db.engine.dialect.name
+        summary = dict(dataset.summary(), seed=seed)
+        click.echo(f"Built {summary} in {time.perf_counter() - started:.1f}s")
+
+        results = dict(environment(), database=dialect, storage=app.config['STORAGE_BACKEND'], dataset=summary, runs=[])
+        for level in levels:
+            samples, seconds = run_load(app, dataset, concurrency=level, duration=duration, warmup=warmup, scenarios=selected, seed=seed)
+            results['runs'].append(dict(summarize(samples, seconds), concurrency=level))
+            click.echo(format_run(results['runs'][-1]))
+        save(results, output)
+        click.echo(f"Saved {output}")
+    finally:
+        if keep:
+            click.echo(f"Kept {directory}")
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+@cli.command('compare')
+@click.argument('baseline', type=click.Path(exists=True, dir_okay=False))
+@click.argument('current', type=click.Path(exists=True, dir_okay=False))
+@click.option('--threshold', default=None, type=float, help='Percent growth of p95 latency or SQL statements that fails the comparison.')
+def compare_command(baseline, current, threshold):
+    '''Compare two saved results, failing on regressions.'''
+    lines, regressions = compare(load(baseline), load(current), REGRESSION_THRESHOLD if threshold is None else threshold)
+    for line in lines:
+        click.echo(line)
+    if regressions:
+        click.echo(f"{regressions} endpoints regressed")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
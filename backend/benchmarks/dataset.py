@@ -0,0 +1,206 @@
+# benchmarks/dataset.py
+import io, random
+from datetime import datetime
+from sqlalchemy import func, text
+from database.models import db, User, DataRoom, Folder, File, Blob
+from database.usage import recount_usage
+from search.extraction import extract_pages, store_pages
+from storage import master_key, storage_backend, store_blob
+
+'''
+Synthetic users, data rooms, folder trees and files for the benchmarks.
+
+Rows are bulk inserted with ids picked up front, so a tree of 10k folders and
+100k files builds in seconds instead of going through the API one request at a
+time. The folder trees are random recursive trees capped at max_depth: each
+new folder goes under a random recent folder of its room (or, now and then,
+at the room root), which gives the long skewed branches real rooms have.
+
+File contents are a small set of generated PDFs shared by every File row, so
+the blob store, previews and the full-text index are exercised without
+generating gigabytes. Names and page text are drawn from WORDS, which is what
+the search and typeahead workloads query.
+
+The same seed always builds the same dataset.
+'''
+
+WORDS = (
+    'agreement', 'amendment', 'audit', 'balance', 'board', 'budget', 'capital', 'closing',
+    'compliance', 'contract', 'diligence', 'disclosure', 'equity', 'escrow', 'exhibit', 'filing',
+    'forecast', 'guarantee', 'indemnity', 'invoice', 'lease', 'ledger', 'license', 'merger',
+    'minutes', 'patent', 'payroll', 'pledge', 'policy', 'proxy', 'receipt', 'schedule',
+    'statement', 'summary', 'tax', 'term', 'transfer', 'trust', 'valuation', 'warranty',
+)
+INSERT_BATCH_SIZE = 5000
+# Share of new folders placed at the room root rather than under another folder
+ROOT_FOLDER_RATIO = 0.02
+# Share of files placed at the room root
+ROOT_FILE_RATIO = 0.05
+
+
+class Dataset:
+    # Ids of what was built, which the workloads pick their targets from
+    def __init__(self):
+        self.users = []
+        # data room id -> owner id
+        self.rooms = {}
+        # data room id -> [folder id], and folder id -> depth
+        self.folders = {}
+        self.depths = {}
+        # data room id -> [file id], and folder id -> number of files in it
+        self.files = {}
+        self.folder_files = {}
+        self.digests = []
+
+    def summary(self):
+        return {
+            "users": len(self.users),
+            "data_rooms": len(self.rooms),
+            "folders": sum(len(ids) for ids in self.folders.values()),
+            "files": sum(len(ids) for ids in self.files.values()),
+            "blobs": len(self.digests),
+            "max_depth": max(self.depths.values(), default=-1) + 1,
+        }
+
+
+def make_pdf(pages):
+    # A minimal PDF with one line of Helvetica text per page
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>']
+    kids = ' '.join(f'{3 + 2 * index} 0 R' for index in range(len(pages)))
+    objects.append(f'<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>')
+    font = 3 + 2 * len(pages)
+    for index, line in enumerate(pages):
+        stream = f'BT /F1 12 Tf 72 720 Td ({line}) Tj ET'
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {4 + 2 * index} 0 R /Resources << /Font << /F1 {font} 0 R >> >> >>')
+        objects.append(f'<< /Length {len(stream)} >>\nstream\n{stream}\nendstream')
+    objects.append('<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+
+    pdf = b'%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += f'{number} 0 obj\n{body}\nendobj\n'.encode()
+    xref = len(pdf)
+    pdf += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode()
+    pdf += b''.join(f'{offset:010d} 00000 n \n'.encode() for offset in offsets)
+    pdf += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode()
+    return pdf
+
+
+def random_words(rng, count):
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+def _next_id(model):
+    return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+
+def _insert(model, rows):
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        db.session.execute(model.__table__.insert(), rows[start:start + INSERT_BATCH_SIZE])
+
+
+def _sync_sequences():
+    # Ids were picked by hand, move the Postgres sequences past them
+    if db.engine.dialect.name != 'postgresql':
+        return
+    for table in ('user', 'data_room', 'folder', 'file'):
+        db.session.execute(text(f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), (SELECT max(id) FROM \"{table}\"))"))
+
+
+def _store_blobs(rng, count, pages):
+    # Generate and store count distinct PDFs, returning their digests and sizes
+    blobs = []
+    for index in range(count):
+        pdf = make_pdf([f"{random_words(rng, 12)} {index}" for _ in range(pages)])
+        blobs.append(store_blob(io.BytesIO(pdf)))
+    return blobs
+
+
+def build_dataset(users=2, rooms_per_user=2, folders=10000, files=100000, max_depth=8, blobs=50, pages=2, seed=0):
+    '''
+    Build the synthetic dataset in the current app's database and blob store,
+    which should be empty. folders and files are totals, spread evenly over
+    the users * rooms_per_user data rooms. Runs in an app context.
+    '''
+    rng = random.Random(seed)
+    dataset = Dataset()
+    now = datetime.utcnow()
+
+    stored = _store_blobs(rng, blobs, pages)
+    dataset.digests = [digest for digest, _ in stored]
+
+    with db.session.begin():
+        user_id, room_id, folder_id, file_id = _next_id(User), _next_id(DataRoom), _next_id(Folder), _next_id(File)
+
+        user_rows = []
+        room_rows = []
+        for user_index in range(users):
+            username = f"bench-{seed}-{user_index}"
+            user_rows.append({"id": user_id, "username": username, "email": f"{username}@example.com"})
+            dataset.users.append((user_id, username))
+            for room_index in range(rooms_per_user):
+                room_rows.append({"id": room_id, "name": f"Room {room_index} {random_words(rng, 2)}", "owner_id": user_id})
+                dataset.rooms[room_id] = user_id
+                dataset.folders[room_id] = []
+                dataset.files[room_id] = []
+                room_id += 1
+            user_id += 1
+        _insert(User, user_rows)
+        _insert(DataRoom, room_rows)
+
+        # Folders, each room its share, parents always created before children
+        folder_rows = []
+        rooms = list(dataset.rooms)
+        paths = {}
+        for index in range(folders):
+            room = rooms[index % len(rooms)]
+            # Parents come from the room's recent folders, which keeps this linear and the branches long
+            candidates = [id for id in dataset.folders[room][-1000:] if dataset.depths[id] < max_depth - 1]
+            parent = None
+            if candidates and rng.random() >= ROOT_FOLDER_RATIO:
+                parent = rng.choice(candidates)
+            path = f"{paths[parent]}{parent}/" if parent else '/'
+            paths[folder_id] = path
+            dataset.depths[folder_id] = dataset.depths[parent] + 1 if parent else 0
+            folder_rows.append({
+                "id": folder_id, "name": f"{random_words(rng, 2).title()} {index}", "owner_id": dataset.rooms[room],
+                "parent_data_room_id": room, "parent_folder_id": parent, "ancestor_path": path, "depth": dataset.depths[folder_id],
+            })
+            dataset.folders[room].append(folder_id)
+            folder_id += 1
+        _insert(Folder, folder_rows)
+
+        # Files, at the room root or in a random folder of their room
+        file_rows = []
+        references = {}
+        for index in range(files):
+            room = rooms[index % len(rooms)]
+            parent = None
+            if dataset.folders[room] and rng.random() >= ROOT_FILE_RATIO:
+                parent = rng.choice(dataset.folders[room])
+                dataset.folder_files[parent] = dataset.folder_files.get(parent, 0) + 1
+            digest, size = stored[rng.randrange(len(stored))]
+            references[digest] = (size, references.get(digest, (size, 0))[1] + 1)
+            file_rows.append({
+                "id": file_id, "name": f"{random_words(rng, 2)} {index}.pdf", "content": digest, "size": size, "created_at": now,
+                "owner_id": dataset.rooms[room], "parent_data_room_id": room, "parent_folder_id": parent,
+            })
+            dataset.files[room].append(file_id)
+            file_id += 1
+        _insert(File, file_rows)
+
+        # Every stored blob gets a row, unreferenced ones included, so search sees them all
+        for digest, size in stored:
+            references.setdefault(digest, (size, 0))
+        _insert(Blob, [{"digest": digest, "size": size, "ref_count": count} for digest, (size, count) in references.items()])
+        _sync_sequences()
+        # Totals of the folders, rooms and users, from the rows just inserted
+        recount_usage()
+
+    # Index the text inline, the benchmark shouldn't wait on the extraction workers
+    for digest in dataset.digests:
+        pages_text = extract_pages(storage_backend(), digest, master_key())
+        with db.session.begin():
+            store_pages(digest, pages_text)
+    return dataset
@@ -0,0 +1,294 @@
+# benchmarks/load.py
+import io, itertools, random, threading, time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from database.models import db, DataRoom, File, Folder
+from routes.changes import change_routes
+from .dataset import WORDS, make_pdf, random_words
+
+'''
+Concurrent load on every blueprint, through the app's WSGI interface.
+
+Each worker thread has its own test client, logs in as one of the synthetic
+users and loops over weighted scenarios until the time is up. A scenario is a
+short user journey (open a folder, upload a file then rename and delete it...)
+and every request in it is recorded under its method and URL rule, so
+'GET /folder/<int:folder_id>' collects every folder listing whatever the id.
+
+The app is a threaded one, so serve_every_route() first registers the change
+feeds, which only the gevent app of transfers.py serves. Sync clients poll
+them here without ?wait=, since a waiting request would only time the wait.
+It also gives GET /metrics a token to be scraped with.
+
+A request is timed from the call until the last byte of its body, streamed
+downloads and archives included. The SQL statements it ran are counted by a
+cursor event on every engine, attributed to the thread running the request,
+so background workers never inflate the count.
+'''
+
+# Folders with at most this many files are archived by the archive scenario
+SMALL_FOLDER_FILES = 20
+CHUNK_SIZE = 64 * 1024
+# Bearer token the metrics scenario scrapes with, unless METRICS_TOKEN is set
+METRICS_TOKEN = 'benchmark'
+
+_statements = threading.local()
+
+
+def serve_every_route(app):
+    # Register what the threaded app leaves out, before its first request
+    if change_routes.name not in app.blueprints:
+        app.register_blueprint(change_routes)
+    app.config['METRICS_TOKEN'] = app.config.get('METRICS_TOKEN') or METRICS_TOKEN
+
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_statements, 'counting', False):
+        _statements.count += 1
+
+
+class Worker:
+    # One simulated client, recording into its own samples so threads never share a lock
+    def __init__(self, app, dataset, user, seed, names):
+        self.app = app
+        self.client = app.test_client()
+        self.adapter = app.url_map.bind('localhost')
+        self.dataset = dataset
+        self.user_id, self.username = user
+        self.rng = random.Random(seed)
+        self.names = names
+        self.samples = {}
+        # Change cursor of every room this client follows
+        self.cursors = {}
+        self.recording = False
+        self.token = self.client.post('/login', json={"username": self.username}).get_json()['access_token']
+
+        self.rooms = [room for room, owner in dataset.rooms.items() if owner == self.user_id]
+        self.small_folders = {
+            room: [id for id in dataset.folders[room] if dataset.folder_files.get(id, 0) <= SMALL_FOLDER_FILES]
+            for room in self.rooms
+        }
+
+    def request(self, method, path, variant=None, token=None, **kwargs):
+        rule, _ = self.adapter.match(path.split('?')[0], method=method, return_rule=True)
+        endpoint = f"{method} {rule.rule}" + (f" ({variant})" if variant else '')
+        headers = {"Authorization": f"Bearer {token or self.token}", **kwargs.pop('headers', {})}
+
+        _statements.count, _statements.counting = 0, True
+        start = time.perf_counter()
+        try:
+            response = self.client.open(path, method=method, headers=headers, buffered=True, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            _statements.counting = False
+        if self.recording:
+            self.samples.setdefault(endpoint, []).append((elapsed, _statements.count, response.status_code))
+        return response
+
+    def lookup(self, query):
+        # Ids the API doesn't return, read outside of any measured request
+        with self.app.app_context():
+            return query().scalar()
+
+    # Targets
+
+    def room(self):
+        return self.rng.choice(self.rooms)
+
+    def folder(self, room=None):
+        folders = self.dataset.folders[room or self.room()]
+        return self.rng.choice(folders) if folders else None
+
+    def file(self, room=None):
+        return self.rng.choice(self.dataset.files[room or self.room()])
+
+    def name(self, suffix=''):
+        return f"{random_words(self.rng, 2)} bench {next(self.names)}{suffix}"
+
+    # Read scenarios
+
+    def list_rooms(self):
+        self.request('GET', '/data-room')
+
+    def browse_room(self):
+        room = self.room()
+        self.request('GET', f'/data-room/{room}')
+        self.request('GET', f'/data-room/{room}/tree?depth=2')
+
+    def browse_folder(self):
+        self.request('GET', f'/folder/{self.folder()}')
+
+    def download_file(self):
+        self.request('GET', f'/file/{self.file()}')
+
+    def read_range(self):
+        self.request('GET', f'/file/{self.file()}', variant='range', headers={"Range": "bytes=0-1023"})
+
+    def preview(self):
+        self.request('GET', f'/file/{self.file()}/preview?size=thumbnail')
+
+    def search(self):
+        self.request('GET', f'/data-room/{self.room()}/search?q={self.rng.choice(WORDS)}')
+
+    def typeahead(self):
+        self.request('GET', f'/data-room/{self.room()}/typeahead?q={self.rng.choice(WORDS)[:3]}')
+
+    def archive(self):
+        room = self.room()
+        if self.small_folders[room]:
+            self.request('GET', f'/folder/{self.rng.choice(self.small_folders[room])}/archive')
+
+    def follow_changes(self):
+        # A sync client catching up on a room from its last cursor, loading the room first
+        room = self.room()
+        if room not in self.cursors:
+            self.cursors[room] = self.request('GET', f'/data-room/{room}').get_json()['change_cursor']
+        response = self.request('GET', f'/data-room/{room}/changes?since={self.cursors[room]}')
+        if response.status_code == 200:
+            self.cursors[room] = response.get_json()['cursor']
+        elif response.status_code == 410:
+            del self.cursors[room]
+
+    def scrape_metrics(self):
+        self.request('GET', '/metrics', headers={"Authorization": f"Bearer {self.app.config['METRICS_TOKEN']}"})
+
+    def account(self):
+        self.request('POST', '/login', json={"username": self.username})
+        self.request('GET', '/user')
+
+    # Write scenarios
+
+    def file_lifecycle(self):
+        room = self.room()
+        folder = self.folder(room)
+        name = self.name('.pdf')
+        pdf = make_pdf([random_words(self.rng, 12)])
+        self.request('POST', '/file', data={
+            "name": name, "parent_data_room_id": str(room), "parent_folder_id": str(folder or ''),
+            "files": (io.BytesIO(pdf), name),
+        })
+        file_id = self.lookup(lambda: db.session.query(File.id).filter_by(parent_data_room_id=room, parent_folder_id=folder, name=name))
+        if file_id:
+            self.request('PUT', f'/file/{file_id}', json={"name": self.name('.pdf'), "parent_data_room_id": room, "parent_folder_id": self.folder(room)})
+            self.request('DELETE', f'/file/{file_id}')
+
+    def bulk_upload(self):
+        room = self.room()
+        files = [(io.BytesIO(make_pdf([random_words(self.rng, 12)])), self.name('.pdf')) for _ in range(5)]
+        self.request('POST', '/file/bulk', data={"parent_data_room_id": str(room), "parent_folder_id": str(self.folder(room) or ''), "files": files})
+
+    def chunked_upload(self):
+        room = self.room()
+        data = make_pdf([random_words(self.rng, 12) for _ in range(8)]) * 4
+        response = self.request('POST', '/file/upload', json={"name": self.name('.pdf'), "size": len(data), "parent_data_room_id": room, "parent_folder_id": self.folder(room)})
+        if response.status_code != 201:
+            return
+        upload_id = response.get_json()['upload_id']
+        for offset in range(0, len(data), CHUNK_SIZE):
+            self.request('PUT', f'/file/upload/{upload_id}?offset={offset}', data=data[offset:offset + CHUNK_SIZE])
+        self.request('GET', f'/file/upload/{upload_id}')
+        if self.rng.random() < 0.2:
+            self.request('DELETE', f'/file/upload/{upload_id}')
+            return
+        response = self.request('POST', f'/file/upload/{upload_id}/complete')
+        if response.status_code == 201:
+            self.request('DELETE', f"/file/{response.get_json()['id']}")
+
+    def folder_lifecycle(self):
+        room = self.room()
+        parent, name = self.folder(room), self.name()
+        self.request('POST', '/folder', json={"name": name, "parent_data_room_id": room, "parent_folder_id": parent})
+        folder_id = self.lookup(lambda: db.session.query(Folder.id).filter_by(parent_data_room_id=room, parent_folder_id=parent, name=name, deleted_at=None))
+        if folder_id:
+            self.request('PUT', f'/folder/{folder_id}', json={"name": self.name(), "parent_data_room_id": room, "parent_folder_id": self.folder(room)})
+            self.request('GET', f'/folder/{folder_id}')
+            self.request('DELETE', f'/folder/{folder_id}')
+
+    def room_lifecycle(self):
+        name = self.name()
+        self.request('POST', '/data-room', json={"name": name})
+        room_id = self.lookup(lambda: db.session.query(DataRoom.id).filter_by(owner_id=self.user_id, name=name, deleted_at=None))
+        if room_id:
+            self.request('PUT', f'/data-room/{room_id}', json={"name": self.name()})
+            self.request('DELETE', f'/data-room/{room_id}')
+
+    def batch(self):
+        room = self.room()
+        operations = [{"op": "rename", "type": "file", "id": self.file(room), "name": self.name('.pdf')} for _ in range(10)]
+        self.request('POST', '/batch', json={"operations": operations})
+
+    def signup(self):
+        # A throwaway user, renamed then deleted
+        username = f"bench-signup-{next(self.names)}"
+        response = self.request('POST', '/user', json={"username": username, "email": f"{username}@example.com"})
+        if response.status_code == 200:
+            token = response.get_json()['access_token']
+            self.request('PUT', '/user', token=token, json={"username": f"{username}-renamed", "email": f"{username}-renamed@example.com"})
+            self.request('DELETE', '/user', token=token)
+
+
+# Scenario name -> weight. Reads dominate, as they do in real use.
+SCENARIOS = {
+    "list_rooms": 6,
+    "browse_room": 6,
+    "browse_folder": 14,
+    "download_file": 6,
+    "read_range": 3,
+    "preview": 5,
+    "search": 4,
+    "typeahead": 8,
+    "archive": 1,
+    "follow_changes": 6,
+    "scrape_metrics": 1,
+    "account": 2,
+    "file_lifecycle": 3,
+    "bulk_upload": 1,
+    "chunked_upload": 1,
+    "folder_lifecycle": 2,
+    "room_lifecycle": 1,
+    "batch": 1,
+    "signup": 1,
+}
+
+
+def run_load(app, dataset, concurrency=8, duration=30, warmup=5, scenarios=None, seed=0):
+    '''
+    Run the weighted scenarios (all of SCENARIOS by default) on concurrency
+    threads for duration seconds after warmup seconds that are not recorded.
+    The app must have been through serve_every_route().
+    Returns ({endpoint: [(seconds, statements, status)]}, elapsed seconds).
+    '''
+    weights = {name: SCENARIOS[name] for name in (scenarios or SCENARIOS)}
+    names = itertools.count()
+    workers = [Worker(app, dataset, dataset.users[index % len(dataset.users)], seed * 1000 + index, names) for index in range(concurrency)]
+    started = threading.Barrier(concurrency + 1)
+    deadline = {}
+
+    def loop(worker):
+        choices, cumulative = list(weights), list(itertools.accumulate(weights.values()))
+        started.wait()
+        while time.perf_counter() < deadline['warmup']:
+            getattr(worker, worker.rng.choices(choices, cum_weights=cumulative)[0])()
+        worker.recording = True
+        while time.perf_counter() < deadline['end']:
+            getattr(worker, worker.rng.choices(choices, cum_weights=cumulative)[0])()
+
+    event.listen(Engine, 'before_cursor_execute', _count_statement)
+    try:
+        threads = [threading.Thread(target=loop, args=(worker,), daemon=True) for worker in workers]
+        for thread in threads:
+            thread.start()
+        now = time.perf_counter()
+        deadline.update(warmup=now + warmup, end=now + warmup + duration)
+        started.wait()
+        for thread in threads:
+            thread.join()
+    finally:
+        event.remove(Engine, 'before_cursor_execute', _count_statement)
+
+    samples = {}
+    for worker in workers:
+        for endpoint, values in worker.samples.items():
+            samples.setdefault(endpoint, []).extend(values)
+    # Scenarios finishing after the deadline still count, so measure to the last one
+    return samples, max(duration, time.perf_counter() - deadline['warmup'])
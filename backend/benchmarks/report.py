@@ -0,0 +1,139 @@
+# benchmarks/report.py
+import json, math, os, platform, subprocess
+from datetime import datetime
+
+'''
+Summaries of benchmark samples, saved as JSON and compared between runs.
+
+    {"commit": ..., "dataset": {...}, "runs": [
+        {"concurrency": 8, "seconds": 30.2, "requests": 9120, "throughput": 302.0, "errors": 0,
+         "endpoints": {"GET /folder/<int:folder_id>": {
+             "requests": 2210, "errors": 0, "throughput": 73.2,
+             "latency_ms": {"p50": 4.1, "p95": 9.8, "p99": 15.0, "mean": 4.9, "max": 40.3},
+             "statements": {"mean": 5.0, "max": 7}}}}]}
+
+Errors are responses with a 5xx status. Client errors are part of the
+workload (a name taken by a concurrent request, say) and counted as requests.
+'''
+
+# Change in p95 latency or statements per request, in percent, that counts as a regression
+REGRESSION_THRESHOLD = 10.0
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of sorted values
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def summarize(samples, seconds):
+    # Per-endpoint figures of samples, {endpoint: [(seconds, statements, status)]}
+    endpoints = {}
+    for endpoint, values in sorted(samples.items()):
+        latencies = sorted(elapsed * 1000 for elapsed, _, _ in values)
+        statements = [count for _, count, _ in values]
+        endpoints[endpoint] = {
+            "requests": len(values),
+            "errors": sum(1 for _, _, status in values if status >= 500),
+            "throughput": round(len(values) / seconds, 2),
+            "latency_ms": {
+                "p50": round(percentile(latencies, 0.50), 2),
+                "p95": round(percentile(latencies, 0.95), 2),
+                "p99": round(percentile(latencies, 0.99), 2),
+                "mean": round(sum(latencies) / len(latencies), 2),
+                "max": round(latencies[-1], 2),
+            },
+            "statements": {
+                "mean": round(sum(statements) / len(statements), 2),
+                "max": max(statements),
+            },
+        }
+    requests = sum(endpoint["requests"] for endpoint in endpoints.values())
+    return {
+        "seconds": round(seconds, 2),
+        "requests": requests,
+        "throughput": round(requests / seconds, 2),
+        "errors": sum(endpoint["errors"] for endpoint in endpoints.values()),
+        "endpoints": endpoints,
+    }
+
+
+def _git(*args):
+    try:
+        return subprocess.run(['git', *args], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    # What the results were measured on, to tell comparable runs apart
+    return {
+        "commit": _git('rev-parse', 'HEAD'),
+        "dirty": bool(_git('status', '--porcelain', '--untracked-files=no')),
+        "created_at": datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def save(results, path):
+    with open(path, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+        output.write('\n')
+
+
+def load(path):
+    with open(path) as source:
+        return json.load(source)
+
+
+def format_run(run):
+    # Plain text table of one run
+    lines = [f"concurrency {run['concurrency']}: {run['requests']} requests in {run['seconds']}s, {run['throughput']}/s, {run['errors']} errors"]
+    lines.append(f"  {'endpoint':<52} {'n':>6} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'sql':>6}")
+    for endpoint, figures in run['endpoints'].items():
+        latency = figures['latency_ms']
+        lines.append(f"  {endpoint:<52} {figures['requests']:>6} {figures['throughput']:>8} {latency['p50']:>8} {latency['p95']:>8} {latency['p99']:>8} {figures['statements']['mean']:>6}")
+    return '\n'.join(lines)
+
+
+def _change(before, after):
+    if before == 0:
+        return 0.0 if after == 0 else math.inf
+    return (after - before) / before * 100
+
+
+def compare(baseline, current, threshold=REGRESSION_THRESHOLD):
+    '''
+    Compare two saved results, run by run at equal concurrency. Returns the
+    lines of a report and the number of endpoints whose p95 latency or mean
+    statement count grew by more than threshold percent.
+    '''
+    lines = []
+    regressions = 0
+    if baseline.get('dataset') != current.get('dataset'):
+        lines.append("warning: the runs used different datasets")
+    runs = {run['concurrency']: run for run in baseline['runs']}
+    if not runs.keys() & {run['concurrency'] for run in current['runs']}:
+        lines.append("no concurrency level was run in both")
+    for run in current['runs']:
+        before = runs.get(run['concurrency'])
+        if before is None:
+            continue
+        lines.append(f"concurrency {run['concurrency']}: throughput {before['throughput']} -> {run['throughput']}/s ({_change(before['throughput'], run['throughput']):+.1f}%)")
+        for endpoint, figures in run['endpoints'].items():
+            old = before['endpoints'].get(endpoint)
+            if old is None:
+                lines.append(f"  {endpoint:<52} new")
+                continue
+            latency = _change(old['latency_ms']['p95'], figures['latency_ms']['p95'])
+            statements = _change(old['statements']['mean'], figures['statements']['mean'])
+            regressed = latency > threshold or statements > threshold
+            regressions += regressed
+            lines.append(
+                f"  {endpoint:<52} p95 {old['latency_ms']['p95']:>8} -> {figures['latency_ms']['p95']:>8} ({latency:+7.1f}%)"
+                f"  sql {old['statements']['mean']:>6} -> {figures['statements']['mean']:>6}{'  REGRESSION' if regressed else ''}"
+            )
+    return lines, regressions
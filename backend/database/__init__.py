@@ -1,21 +1,55 @@
 # database.py
-from flask_sqlalchemy import SQLAlchemy
+import logging, os
+from flask_migrate import Migrate, stamp, upgrade
 from flask import jsonify
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from .engine import ProfiledSQLAlchemy
 
-db = SQLAlchemy()
+db = ProfiledSQLAlchemy()
+
+log = logging.getLogger(__name__)
+
+# Search index structures the migrations create by hand, outside the models
+SEARCH_INDEX_OBJECTS = ('file_page_fts', 'search_vector', 'ix_file_page_search_vector', 'file_name_fts', 'folder_name_fts', 'ix_file_name_', 'ix_folder_name_')
+
+def _include_object(object, name, type_, reflected, compare_to):
+    # Keep autogenerate from dropping the search index (and the FTS5 shadow tables)
+    return not (reflected and compare_to is None and name.startswith(SEARCH_INDEX_OBJECTS))
+
+migrate = Migrate(include_object=_include_object)
+
+# Alembic migrations, see migrations/README
+MIGRATIONS_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+# The schema db.create_all() used to create, before there were migrations
+BASELINE_REVISION = '0001'
 
 def initialize_database(app):
     with app.app_context():
         db.init_app(app)
+        migrate.init_app(app, db, directory=MIGRATIONS_DIRECTORY)
 
         # Configure SQLAlchemy error handler
         @app.errorhandler(SQLAlchemyError)
         def handle_database_error(error):
-            print(f"SQLAlchemy error: {error}")
+            log.error("SQLAlchemy error: %s", error)
             return jsonify({"error": "Database error", "message": str(error)}), 500
 
         try:
-            db.create_all()
-        except SQLAlchemyError as e:
-            handle_database_error(e)
+            # Bring the schema up to date, adopting databases from before migrations
+            tables = inspect(db.engine).get_table_names()
+            if tables and 'alembic_version' not in tables:
+                stamp(directory=MIGRATIONS_DIRECTORY, revision=BASELINE_REVISION)
+            upgrade(directory=MIGRATIONS_DIRECTORY)
+        except SQLAlchemyError:
+            # SQLite DDL isn't transactional, a failed migration may have applied
+            # part of its changes. Don't serve requests on such a schema.
+            log.exception("Migrating the database failed")
+            raise
+        # Worker processes forked later must not inherit the migration's pooled connections
+        db.engine.dispose()
+
+
+def is_unique_violation(error):
+    # True for a write rejected by a unique index, on SQLite or Postgres
+    return isinstance(error, IntegrityError) and (getattr(error.orig, 'pgcode', None) == '23505' or 'UNIQUE constraint failed' in str(error.orig))
@@ -0,0 +1,179 @@
+# changes.py
+import threading, time
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from . import db
+from .models import DataRoom, Change
+
+'''
+Append-only change log of every data room, read by sync clients through
+GET /data-room/<id>/changes?since=<cursor>.
+
+Writes append entries in the same transaction as the change itself, so the
+log never shows a change that was rolled back or misses one that committed:
+
+    {"seq": 42, "type": "file", "op": "move", "id": 7, "name": "Lease.pdf", "parent_folder_id": 3}
+
+    - type is file, folder or data_room, op is create, rename, move or delete
+    - parent_folder_id is null at the room root, files created carry their size
+    - deleting a folder deletes its whole subtree, deleting the room ends the log
+    - moving to another room is a delete in the old room and a create in the
+      new one, a folder created that way arrives with its contents
+
+seq numbers the entries of each room 1, 2, 3... and is the cursor. Appending
+increments data_room.change_seq first, and the row lock that takes is held
+until commit, so the writers of a room commit in seq order and a client that
+has seen seq N has seen every change up to N. Since there are no gaps, a
+missing seq means the entries were trimmed and the client has to reload.
+
+Entries older than CHANGE_RETENTION seconds are trimmed by the purge worker,
+along with the log of purged rooms. Waiting readers poll the room's
+change_seq every CHANGE_POLL_INTERVAL seconds, and commits in this process
+wake the waiters of the rooms they changed straight away.
+'''
+
+CHANGE_RETENTION = 7 * 24 * 3600
+CHANGE_POLL_INTERVAL = 1.0
+CHANGE_TRIM_BATCH_SIZE = 500
+
+
+class ChangesExpired(Exception):
+    pass
+
+
+def change(data_room_id, kind, op, id, name=None, parent_folder_id=None, size=None):
+    # One log entry, for record_changes()
+    return {"data_room_id": int(data_room_id), "kind": kind, "op": op, "item_id": id, "name": name, "parent_folder_id": parent_folder_id, "size": size}
+
+
+def move_changes(kind, id, name, old_place, new_place, size=None):
+    '''
+    Entries for renaming or moving an item from old_place to new_place, both
+    (data_room_id, parent_folder_id).
+    '''
+    (old_data_room_id, old_folder_id), (new_data_room_id, new_folder_id) = old_place, new_place
+    if int(old_data_room_id) != int(new_data_room_id):
+        return [change(old_data_room_id, kind, 'delete', id), change(new_data_room_id, kind, 'create', id, name, new_folder_id, size)]
+    return [change(new_data_room_id, kind, 'move' if old_folder_id != new_folder_id else 'rename', id, name, new_folder_id)]
+
+
+def record_changes(changes):
+    '''
+    Append changes to the logs of their rooms: one UPDATE and one SELECT per
+    room to take the seq numbers, rooms in id order so two writers never lock
+    them in opposite orders, and one bulk INSERT.
+    '''
+    by_data_room = {}
+    for entry in changes:
+        by_data_room.setdefault(entry['data_room_id'], []).append(entry)
+    if not by_data_room:
+        return
+
+    rows = []
+    for data_room_id in sorted(by_data_room):
+        entries = by_data_room[data_room_id]
+        DataRoom.query.filter_by(id=data_room_id).update({DataRoom.change_seq: DataRoom.change_seq + len(entries)}, synchronize_session=False)
+        last = db.session.query(DataRoom.change_seq).filter_by(id=data_room_id).scalar()
+        for seq, entry in enumerate(entries, start=last - len(entries) + 1):
+            rows.append(dict(entry, seq=seq))
+    db.session.bulk_insert_mappings(Change, rows)
+
+    # Waiters are woken once the transaction commits
+    db.session.info.setdefault('changed_data_rooms', set()).update(by_data_room)
+
+
+def change_json(entry):
+    data = {"seq": entry.seq, "type": entry.kind, "op": entry.op, "id": entry.item_id}
+    if entry.op != 'delete':
+        data["name"] = entry.name
+        data["parent_folder_id"] = entry.parent_folder_id
+    if entry.size is not None:
+        data["size"] = entry.size
+    return data
+
+
+def changes_since(data_room_id, since, limit):
+    '''
+    Up to limit entries of the room after seq since, oldest first, in one
+    transaction. Returns (entries, cursor, has_more), or None once the room
+    has been purged. Raises ChangesExpired when entries after since were
+    trimmed, or since is ahead of the room.
+    '''
+    with db.session.begin():
+        last = db.session.query(DataRoom.change_seq).filter_by(id=data_room_id).scalar()
+        if last is None:
+            return None
+        if since > last:
+            raise ChangesExpired()
+        entries = Change.query.filter(Change.data_room_id == data_room_id, Change.seq > since).order_by(Change.seq).limit(limit).all()
+        if any(entry.seq != since + index + 1 for index, entry in enumerate(entries)) or (since < last and not entries):
+            raise ChangesExpired()
+        cursor = entries[-1].seq if entries else since
+        return [change_json(entry) for entry in entries], cursor, cursor < last
+
+
+def wait_for_changes(data_room_id, since, limit, timeout, poll_interval=CHANGE_POLL_INTERVAL):
+    '''
+    changes_since(), waiting up to timeout seconds for the first entry after
+    since. No connection is held while waiting.
+    '''
+    deadline = time.monotonic() + timeout
+    while True:
+        result = changes_since(data_room_id, since, limit)
+        remaining = deadline - time.monotonic()
+        if result is None or result[0] or remaining <= 0:
+            return result
+        _signals.wait(data_room_id, min(poll_interval, remaining))
+
+
+def trim_changes(retention=CHANGE_RETENTION, batch_size=CHANGE_TRIM_BATCH_SIZE, data_room_id=None):
+    '''
+    Delete entries older than retention seconds, or every entry of
+    data_room_id, in batches. Returns the number of entries deleted.
+    '''
+    if data_room_id is not None:
+        condition = Change.data_room_id == data_room_id
+    else:
+        condition = Change.created_at < datetime.utcnow() - timedelta(seconds=retention)
+
+    trimmed = 0
+    while True:
+        with db.session.begin():
+            ids = [id for (id,) in db.session.query(Change.id).filter(condition).order_by(Change.id).limit(batch_size)]
+            if not ids:
+                return trimmed
+            trimmed += Change.query.filter(Change.id.in_(ids)).delete(synchronize_session=False)
+
+
+class ChangeSignals:
+    # Wakes the readers waiting on a data room when this process commits changes to it
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = {}
+
+    def wait(self, data_room_id, timeout):
+        with self._lock:
+            signal = self._events.setdefault(data_room_id, threading.Event())
+        signal.wait(timeout)
+
+    def notify(self, data_room_ids):
+        with self._lock:
+            signals = [self._events.pop(id) for id in data_room_ids if id in self._events]
+        for signal in signals:
+            signal.set()
+
+
+_signals = ChangeSignals()
+
+
+@event.listens_for(Session, 'after_commit')
+def _notify_waiters(session):
+    changed = session.info.pop('changed_data_rooms', None)
+    if changed:
+        _signals.notify(changed)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_changes(session):
+    session.info.pop('changed_data_rooms', None)
@@ -0,0 +1,120 @@
+# database/engine.py
+from functools import wraps
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.pool import NullPool, QueuePool
+
+'''
+Engine profiles, applied to every engine by the dialect of its URL.
+
+SQLite runs in WAL mode, so readers never block on the writer and the writer
+never blocks on readers, with a busy timeout instead of failing straight away
+when two writers meet. synchronous=NORMAL only syncs at checkpoints, which WAL
+keeps crash safe, and reads go through a memory map. Connections are pooled
+instead of reopened for every checkout, so the pragmas run once per connection.
+
+Postgres keeps a pool of DATABASE_POOL_SIZE connections, plus up to
+DATABASE_MAX_OVERFLOW opened under load, checks connections before handing
+them out and recycles them before server or proxy idle timeouts close them.
+
+With DATABASE_REPLICA_URL set, views decorated with @read_replica run their
+queries on the replica. Flushes always go to the primary.
+'''
+
+POOL_SIZE = 10
+MAX_OVERFLOW = 10
+POOL_TIMEOUT = 30
+POOL_RECYCLE = 1800
+SQLITE_JOURNAL_MODE = 'WAL'
+SQLITE_BUSY_TIMEOUT = 5000
+SQLITE_SYNCHRONOUS = 'NORMAL'
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+REPLICA_BIND = 'replica'
+
+
+def _in_memory(sa_url):
+    return sa_url.database in (None, '', ':memory:')
+
+
+def _sqlite_pragmas(config):
+    pragmas = [
+        f"PRAGMA journal_mode={config.get('SQLITE_JOURNAL_MODE', SQLITE_JOURNAL_MODE)}",
+        f"PRAGMA busy_timeout={int(config.get('SQLITE_BUSY_TIMEOUT', SQLITE_BUSY_TIMEOUT))}",
+        f"PRAGMA synchronous={config.get('SQLITE_SYNCHRONOUS', SQLITE_SYNCHRONOUS)}",
+        f"PRAGMA mmap_size={int(config.get('SQLITE_MMAP_SIZE', SQLITE_MMAP_SIZE))}",
+    ]
+
+    def on_connect(connection, record):
+        cursor = connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+    return on_connect
+
+
+def engine_profile(config, sa_url, options):
+    '''
+    Engine options for sa_url, on top of options. Options set explicitly in
+    SQLALCHEMY_ENGINE_OPTIONS are kept.
+    '''
+    pool = {
+        "pool_size": int(config.get('DATABASE_POOL_SIZE', POOL_SIZE)),
+        "max_overflow": int(config.get('DATABASE_MAX_OVERFLOW', MAX_OVERFLOW)),
+        "pool_timeout": int(config.get('DATABASE_POOL_TIMEOUT', POOL_TIMEOUT)),
+    }
+    explicit = config.get('SQLALCHEMY_ENGINE_OPTIONS') or {}
+    backend = sa_url.get_backend_name()
+    if backend == 'sqlite' and not _in_memory(sa_url):
+        # Flask-SQLAlchemy opens a new connection per checkout unless told otherwise
+        if options.get('poolclass') is NullPool and 'poolclass' not in explicit:
+            options['poolclass'] = QueuePool
+            for key, value in pool.items():
+                options.setdefault(key, value)
+        # Pooled connections move between threads, one at a time
+        options.setdefault('connect_args', {}).setdefault('check_same_thread', False)
+    elif backend == 'postgresql':
+        for key, value in pool.items():
+            options.setdefault(key, value)
+        options.setdefault('pool_pre_ping', True)
+        options.setdefault('pool_recycle', int(config.get('DATABASE_POOL_RECYCLE', POOL_RECYCLE)))
+    return options
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        # Reads of a @read_replica view go to the replica, anything being flushed to the primary
+        if not self._flushing and has_app_context() and g.get('read_replica') and REPLICA_BIND in (self.app.config.get('SQLALCHEMY_BINDS') or {}):
+            return get_state(self.app).db.get_engine(self.app, bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause)
+
+
+class ProfiledSQLAlchemy(SQLAlchemy):
+    '''
+    Flask-SQLAlchemy with the engine profiles above and read replica routing.
+    '''
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        config = self.get_app().config
+        engine = super().create_engine(sa_url, engine_profile(config, sa_url, engine_opts))
+        if engine.dialect.name == 'sqlite' and not _in_memory(sa_url):
+            event.listen(engine, 'connect', _sqlite_pragmas(config))
+        return engine
+
+
+def read_replica(view):
+    '''
+    Run the queries of a read-only view on the read replica, when there is one.
+    They may not see writes made in the last moments before, up to the
+    replication lag, so views that read back what the client just wrote
+    should stay on the primary.
+    '''
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # g lives as long as the request, streamed responses included
+        g.read_replica = True
+        return view(*args, **kwargs)
+    return wrapper
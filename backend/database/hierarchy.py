@@ -0,0 +1,171 @@
+# hierarchy.py
+from sqlalchemy import String, and_, cast, func, literal, or_, select, union_all
+from sqlalchemy.orm import aliased
+from . import db
+from .models import DataRoom, Folder, File
+
+'''
+Materialized-path index over the Folder hierarchy.
+
+Every folder stores the ids of its ancestors, root first, in ancestor_path:
+
+    DataRoom 1
+    |
+    |-- Folder 3        ancestor_path '/'        depth 0
+        |
+        |-- Folder 4    ancestor_path '/3/'      depth 1
+            |
+            |-- Folder 7    ancestor_path '/3/4/'    depth 2
+
+Breadcrumbs are the ids in ancestor_path, and the subtree under a folder is
+every folder whose ancestor_path starts with that folder's own path ('/3/4/'
+for Folder 4). Paths only contain digits and '/', and '/' sorts directly below
+'0', so "starts with prefix" is the index range [prefix, prefix[:-1] + '0').
+
+Deleting a folder only sets deleted_at on the subtree root (a tombstone), so a
+folder is hidden when it or any of its ancestors carries one. Tombstones are
+few and short-lived, so checks join against the deleted_at index rather than
+walking the tree.
+'''
+
+
+def folder_path(folder):
+    # The ancestor_path of this folder's direct children
+    return f"{folder.ancestor_path}{folder.id}/"
+
+
+def ancestor_ids(folder):
+    return [int(id) for id in folder.ancestor_path.strip('/').split('/') if id]
+
+
+def under_path(prefix):
+    # Index range scan for ancestor_path LIKE prefix || '%'
+    return and_(Folder.ancestor_path >= prefix, Folder.ancestor_path < prefix[:-1] + '0')
+
+
+def place_folder(folder, parent_folder):
+    # Set the index columns of a new folder from its parent (None at the room root)
+    if parent_folder:
+        folder.ancestor_path = folder_path(parent_folder)
+        folder.depth = parent_folder.depth + 1
+    else:
+        folder.ancestor_path = '/'
+        folder.depth = 0
+
+
+def is_in_subtree(folder, candidate):
+    # True when candidate is folder itself or one of its descendants
+    return candidate.id == folder.id or candidate.ancestor_path.startswith(folder_path(folder))
+
+
+def subtree_folder_ids(folder):
+    # Select of the ids of folder and all of its descendants
+    return db.session.query(Folder.id).filter(or_(Folder.id == folder.id, under_path(folder_path(folder))))
+
+
+def under_tombstone(folder):
+    '''
+    Correlated condition: folder is a tombstone or sits below one. Ancestors
+    always share the folder's room, so this only reads the deleted_at index.
+    '''
+    tombstone = aliased(Folder)
+    return select(tombstone.id).where(
+        tombstone.deleted_at.isnot(None),
+        or_(tombstone.id == folder.id, folder.ancestor_path.like(literal('%/').concat(cast(tombstone.id, String)).concat('/%'))),
+    ).exists()
+
+
+def tombstoned_folder_ids(folder_ids):
+    # The subset of folder_ids hidden by a tombstone, in one query
+    if not folder_ids:
+        return set()
+    return {id for (id,) in db.session.query(Folder.id).filter(Folder.id.in_(folder_ids), under_tombstone(Folder))}
+
+
+def is_tombstoned(data_room_id, folder_id=None):
+    '''
+    True when the data room, or the folder or any of its ancestors, has been
+    deleted and is waiting to be purged. One query.
+    '''
+    deleted = db.session.query(DataRoom.id).filter(DataRoom.id == data_room_id, DataRoom.deleted_at.isnot(None)).exists()
+    if folder_id:
+        deleted = or_(deleted, db.session.query(Folder.id).filter(Folder.id == folder_id, under_tombstone(Folder)).exists())
+    return db.session.query(deleted).scalar()
+
+
+def breadcrumbs(folder):
+    # Ancestors of folder, root first, in one primary-key lookup
+    ids = ancestor_ids(folder)
+    if not ids:
+        return []
+    names = dict(db.session.query(Folder.id, Folder.name).filter(Folder.id.in_(ids)))
+    return [{"id": id, "name": names.get(id)} for id in ids]
+
+
+def move_subtree(folder, parent_folder, parent_data_room_id):
+    '''
+    Re-parent folder under parent_folder (None for the room root), rewriting the
+    index of every descendant in one UPDATE. Descendants and their files follow
+    the folder into parent_data_room_id.
+    '''
+    old_prefix = folder_path(folder)
+    old_depth = folder.depth
+    moves_room = int(parent_data_room_id) != folder.parent_data_room_id
+
+    # Files follow their folders into the new room, matched before paths change
+    if moves_room:
+        File.query.filter(File.parent_folder_id.in_(subtree_folder_ids(folder))) \
+            .update({File.parent_data_room_id: parent_data_room_id}, synchronize_session='fetch')
+
+    place_folder(folder, parent_folder)
+    new_prefix = folder_path(folder)
+    values = {
+        Folder.ancestor_path: literal(new_prefix).concat(func.substr(Folder.ancestor_path, len(old_prefix) + 1)),
+        Folder.depth: Folder.depth + (folder.depth - old_depth),
+    }
+    if moves_room:
+        values[Folder.parent_data_room_id] = parent_data_room_id
+    # Refresh any descendants already loaded in this session
+    Folder.query.filter(under_path(old_prefix)).update(values, synchronize_session='fetch')
+
+    folder.parent_folder_id = parent_folder.id if parent_folder else None
+    folder.parent_data_room_id = parent_data_room_id
+
+
+def tree_rows(data_room_id, max_depth=None):
+    '''
+    Every folder and file of a data room in one statement, in depth-first order:
+    each folder is followed by its own files, then by its subfolders.
+
+    Rows are (kind, parent_path, path, id, name, depth) where kind is 'folder' or
+    'file', parent_path is the path of the containing folder ('/' at the root) and
+    path is the folder's own path. max_depth limits how many levels below the
+    room are returned, with top-level items at level 1.
+    '''
+    own_path = Folder.ancestor_path.concat(cast(Folder.id, String)).concat('/')
+
+    # Deleted subtrees are left out, along with the files inside them
+    folders = select(
+        literal('folder').label('kind'), Folder.ancestor_path.label('parent_path'), own_path.label('path'),
+        Folder.id, Folder.name, Folder.depth,
+    ).where(Folder.parent_data_room_id == data_room_id, ~under_tombstone(Folder))
+
+    nested_files = select(
+        literal('file').label('kind'), own_path.label('parent_path'), own_path.label('path'),
+        File.id, File.name, (Folder.depth + 1).label('depth'),
+    ).join(Folder, File.parent_folder_id == Folder.id).where(File.parent_data_room_id == data_room_id, ~under_tombstone(Folder))
+
+    root_files = select(
+        literal('file').label('kind'), literal('/').label('parent_path'), literal('/').label('path'),
+        File.id, File.name, literal(0).label('depth'),
+    ).where(File.parent_data_room_id == data_room_id, File.parent_folder_id.is_(None))
+
+    if max_depth is not None:
+        folders = folders.where(Folder.depth < max_depth)
+        nested_files = nested_files.where(Folder.depth + 1 < max_depth)
+
+    tree = union_all(folders, nested_files, root_files).subquery()
+    # Folders sort before the files sharing their path, which sort before subfolders
+    return db.session.execute(
+        select(tree).order_by(tree.c.path, tree.c.kind.desc(), tree.c.name, tree.c.id).execution_options(stream_results=True)
+    )
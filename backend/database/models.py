@@ -1,4 +1,5 @@
 # models.py
+from datetime import datetime
 from . import db
 
 '''
@@ -33,6 +34,10 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     username = db.Column(db.String(50), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
+
+    # Bytes of the user's live files, and their own quota (NULL for USER_QUOTA_BYTES), see database/usage.py
+    used_bytes = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    quota_bytes = db.Column(db.BigInteger)
     
     # One-to-many relationship with DataRoom
     data_rooms = db.relationship('DataRoom', backref='user', lazy=True)
@@ -43,11 +48,28 @@ class DataRoom(db.Model):
     
     # Foreign key relationship with User
     owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+
+    # Set when the room is deleted, the purge worker removes its contents later
+    deleted_at = db.Column(db.DateTime, index=True)
+
+    # Bumped whenever the room or its top-level listing changes, see database/versions.py
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    # Files anywhere in the room and their bytes, see database/usage.py
+    file_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    total_bytes = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+
+    # seq of the last entry in the room's change log, see database/changes.py
+    change_seq = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     
     # One-to-many relationships with File and Folder
     children_files = db.relationship('File', backref='data_room', lazy=True, cascade='all, delete-orphan')
     children_folders = db.relationship('Folder', backref='data_room', lazy=True, cascade='all, delete-orphan')
 
+# A user's live data rooms have distinct names
+db.Index('uq_data_room_name', DataRoom.owner_id, DataRoom.name, unique=True,
+         sqlite_where=DataRoom.deleted_at.is_(None), postgresql_where=DataRoom.deleted_at.is_(None))
+
 class Folder(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(100), nullable=False)
@@ -58,17 +80,105 @@ class Folder(db.Model):
     
     # Self-referential relationship for parent-child Folders
     parent_folder_id = db.Column(db.Integer, db.ForeignKey('folder.id'))
+
+    # Materialized path of ancestor ids, root first ('/3/4/'), see database/hierarchy.py.
+    # Byte-wise collation so prefix lookups are index range scans on Postgres too.
+    ancestor_path = db.Column(db.String(512).with_variant(db.String(512, collation='C'), 'postgresql'), nullable=False, default='/', index=True)
+    depth = db.Column(db.Integer, nullable=False, default=0)
+
+    # Set on the root of a deleted subtree only, see purge.py
+    deleted_at = db.Column(db.DateTime, index=True)
+
+    # Bumped whenever the folder, its breadcrumbs or its children change
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    # Files anywhere in the subtree and their bytes, see database/usage.py
+    file_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    total_bytes = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
     
     # One-to-many relationships with File and Folder
     children_folders = db.relationship('Folder', backref=db.backref('parent', remote_side=[id]), lazy=True, cascade='all, delete-orphan')    
     children_files = db.relationship('File', backref='folder', lazy=True, cascade='all, delete-orphan')
 
+# Children of a data room root or of a folder, in listing order
+db.Index('ix_folder_parent_data_room_id', Folder.parent_data_room_id, Folder.parent_folder_id, Folder.name)
+db.Index('ix_folder_parent_folder_id', Folder.parent_folder_id, Folder.name)
+
+# Sibling folders have distinct names. Root-level folders have no parent folder
+# and NULLs never collide in a unique index, so they are keyed under folder 0.
+# Tombstoned folders free their name straight away.
+db.Index('uq_folder_name', Folder.parent_data_room_id, db.func.coalesce(Folder.parent_folder_id, 0), Folder.name, unique=True,
+         sqlite_where=Folder.deleted_at.is_(None), postgresql_where=Folder.deleted_at.is_(None))
+
 class File(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(100), nullable=False)
-    content = db.Column(db.String(100), nullable=False)
+
+    # SHA-256 digest of the Blob holding the uploaded bytes
+    content = db.Column(db.String(100), nullable=False, index=True)
+
+    # Bytes of plaintext, the blob's size for every File sharing it
+    size = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+
+    # Uploaded bytes are immutable, so this doubles as the Last-Modified time
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Foreign key relationship with DataRoom, User, and Folder
     owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     parent_data_room_id = db.Column(db.Integer, db.ForeignKey('data_room.id'), nullable=False)
     parent_folder_id = db.Column(db.Integer, db.ForeignKey('folder.id'))
+
+db.Index('ix_file_parent_data_room_id', File.parent_data_room_id, File.parent_folder_id, File.name)
+db.Index('ix_file_parent_folder_id', File.parent_folder_id, File.name)
+
+# Sibling files have distinct names, keyed like uq_folder_name
+db.Index('uq_file_name', File.parent_data_room_id, db.func.coalesce(File.parent_folder_id, 0), File.name, unique=True)
+
+class Blob(db.Model):
+    # Content-addressed upload bytes, shared by every File with identical content
+    digest = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+
+    # Number of File rows pointing at this digest, bytes are removed at zero
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+
+    # Set once the text of the blob has been extracted into FilePage rows
+    indexed_at = db.Column(db.DateTime)
+
+class FilePage(db.Model):
+    # Text of one page of a blob, searched through the full-text index in search/index.py
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    digest = db.Column(db.String(64), nullable=False, index=True)
+    page = db.Column(db.Integer, nullable=False)
+    text = db.Column(db.Text, nullable=False)
+
+class UploadSession(db.Model):
+    # Resumable chunked upload, the received bytes live in uploads/sessions/<id>.part
+    id = db.Column(db.String(32), primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    # Where the File is created once the upload is finalized. The parents are
+    # re-validated at that point, so they are not foreign keys and an in-flight
+    # session never blocks deleting its data room or folder.
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    parent_data_room_id = db.Column(db.Integer, nullable=False)
+    parent_folder_id = db.Column(db.Integer)
+
+class Change(db.Model):
+    # One entry of a data room's change log, see database/changes.py. Not a
+    # foreign key, the log outlives the rows it describes until it is trimmed.
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    data_room_id = db.Column(db.Integer, nullable=False)
+    seq = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(16), nullable=False)
+    op = db.Column(db.String(16), nullable=False)
+    item_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(100))
+    parent_folder_id = db.Column(db.Integer)
+    size = db.Column(db.BigInteger)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+# Entries of a room in log order, one per seq
+db.Index('uq_change_seq', Change.data_room_id, Change.seq, unique=True)
@@ -0,0 +1,179 @@
+# permissions.py
+import threading, time
+from collections import OrderedDict, namedtuple
+from flask import current_app, g
+from sqlalchemy import and_, literal, null, or_, select, union_all
+from . import db
+from .models import DataRoom, Folder, File
+from .hierarchy import under_tombstone
+
+'''
+Ownership resolution for data rooms, folders and files.
+
+resolve() answers "who owns it, where is it, is it deleted" for any mix of
+data rooms, folders and files with a single UNION ALL query, so a route
+authorizes its item, destination room and destination folder in one round
+trip instead of a get() per object plus a tombstone check.
+
+Results are kept for the rest of the request in flask.g, and across requests
+in a bounded LRU cache whose entries expire after PERMISSION_CACHE_TTL
+seconds. Routes call invalidate() after committing a move or delete:
+
+    - moving or deleting a file drops that file
+    - moving or deleting a folder drops every entry in the data rooms it left
+      and entered, since its whole subtree changed path or visibility
+    - deleting a data room drops every entry in it
+
+The cache is per process, so with several workers a change made elsewhere is
+seen here after at most PERMISSION_CACHE_TTL seconds. Writes only take
+ownership from it: they check deleted again with is_tombstoned() inside their
+transaction, so a delete made by another worker is never applied twice.
+'''
+
+PERMISSION_CACHE_SIZE = 10000
+PERMISSION_CACHE_TTL = 30
+
+# folder_id is the parent folder, deleted covers the item, its ancestors and its
+# data room. Paths are left out on purpose: writes that depend on where a folder
+# sits load the Folder itself, rather than trusting a cached copy.
+Access = namedtuple('Access', 'kind id owner_id data_room_id folder_id deleted')
+
+KINDS = ('data_room', 'folder', 'file')
+
+
+class AccessCache:
+    '''
+    LRU of Access entries keyed by (kind, id). Every entry remembers the
+    generation of its data room when it was stored, and invalidating a room
+    bumps the generation, which drops all of the room's entries in O(1).
+    '''
+
+    def __init__(self, size=PERMISSION_CACHE_SIZE, ttl=PERMISSION_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            access, expires, generation = entry
+            if expires < time.monotonic() or generation != self._generations.get(access.data_room_id, 0):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return access
+
+    def put(self, access):
+        key = (access.kind, access.id)
+        with self._lock:
+            self._entries[key] = (access, time.monotonic() + self.ttl, self._generations.get(access.data_room_id, 0))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_data_room(self, data_room_id):
+        with self._lock:
+            self._generations[data_room_id] = self._generations.get(data_room_id, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+
+
+def _cache():
+    # One cache per app, sized from PERMISSION_CACHE_SIZE and PERMISSION_CACHE_TTL
+    cache = current_app.extensions.get('access_cache')
+    if cache is None:
+        cache = current_app.extensions['access_cache'] = AccessCache(
+            current_app.config.get('PERMISSION_CACHE_SIZE', PERMISSION_CACHE_SIZE),
+            current_app.config.get('PERMISSION_CACHE_TTL', PERMISSION_CACHE_TTL),
+        )
+    return cache
+
+
+def _ids(values):
+    # Ids as they arrive from JSON or form data, anything that isn't one can't exist
+    ids = set()
+    for value in values:
+        try:
+            ids.add(int(value))
+        except (TypeError, ValueError):
+            pass
+    return ids
+
+
+def _select(kind, ids):
+    ids = list(ids)
+    if kind == 'data_room':
+        return select(
+            literal('data_room').label('kind'), DataRoom.id, DataRoom.owner_id, DataRoom.id.label('data_room_id'),
+            null().label('folder_id'), DataRoom.deleted_at.isnot(None).label('deleted'),
+        ).where(DataRoom.id.in_(ids))
+    if kind == 'folder':
+        return select(
+            literal('folder').label('kind'), Folder.id, Folder.owner_id, Folder.parent_data_room_id,
+            Folder.parent_folder_id, or_(DataRoom.deleted_at.isnot(None), under_tombstone(Folder)).label('deleted'),
+        ).join(DataRoom, Folder.parent_data_room_id == DataRoom.id).where(Folder.id.in_(ids))
+    return select(
+        literal('file').label('kind'), File.id, File.owner_id, File.parent_data_room_id,
+        File.parent_folder_id, or_(DataRoom.deleted_at.isnot(None), and_(Folder.id.isnot(None), under_tombstone(Folder))).label('deleted'),
+    ).join(DataRoom, File.parent_data_room_id == DataRoom.id).outerjoin(Folder, File.parent_folder_id == Folder.id).where(File.id.in_(ids))
+
+
+def resolve_many(data_room_ids=(), folder_ids=(), file_ids=()):
+    '''
+    Access for every given id, as {(kind, id): Access}. Ids that don't exist are
+    left out. Runs at most one query, none when everything is cached.
+    '''
+    scope = g.setdefault('access', {})
+    cache = _cache()
+    wanted = {(kind, id) for kind, ids in zip(KINDS, (data_room_ids, folder_ids, file_ids)) for id in _ids(ids)}
+
+    found = {}
+    missing = {kind: set() for kind in KINDS}
+    for key in wanted:
+        access = scope.get(key) or cache.get(key)
+        if access is None:
+            missing[key[0]].add(key[1])
+        else:
+            found[key] = scope[key] = access
+
+    selects = [_select(kind, ids) for kind, ids in missing.items() if ids]
+    if selects:
+        query = selects[0] if len(selects) == 1 else union_all(*selects)
+        for row in db.session.execute(query):
+            access = Access(*row[:5], bool(row[5]))
+            found[(access.kind, access.id)] = scope[(access.kind, access.id)] = access
+            cache.put(access)
+    return found
+
+
+def resolve(*targets):
+    '''
+    Access for each (kind, id) in targets, in the same order, with None where
+    the id is None or doesn't exist:
+
+        data_room, parent_folder = resolve(('data_room', 1), ('folder', None))
+    '''
+    keys = [(kind, next(iter(_ids([id])), None)) for kind, id in targets]
+    found = resolve_many(*([id for kind, id in keys if kind == each] for each in KINDS))
+    return [found.get(key) for key in keys]
+
+
+def invalidate(data_room_ids=(), file_ids=()):
+    # Forget cached access after a move or delete has been committed
+    g.pop('access', None)
+    cache = _cache()
+    for data_room_id in _ids(data_room_ids):
+        cache.invalidate_data_room(data_room_id)
+    for file_id in _ids(file_ids):
+        cache.discard(('file', file_id))
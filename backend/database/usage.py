@@ -0,0 +1,205 @@
+# usage.py
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import func, or_, select
+from . import db
+from .models import User, DataRoom, Folder, File, Blob
+from .hierarchy import ancestor_ids
+
+'''
+Rolled-up file counts and byte totals.
+
+Every File records its size, and every folder and data room carries the number
+of files and bytes below it (file_count, total_bytes), as does each user's
+used_bytes, so listings, billing and quotas read one row instead of walking
+the tree. Writes change them in the same transaction as the change itself,
+with UPDATEs that add a delta:
+
+    - creating a file adds it to its folder, every ancestor of that folder,
+      its data room and its owner
+    - deleting a file, folder or data room takes its totals away again, the
+      purge that removes the rows later leaves them alone
+    - moving takes the totals away from the old ancestors and adds them to the
+      new ones, ancestors the two places share are left untouched
+
+Ancestors come from ancestor_path, so a write runs one UPDATE per table and
+distinct delta however deep it happens. Changed folders and rooms also get
+their version bumped, since their totals show in their parent's listing.
+
+Uploads add their bytes to used_bytes first, with an UPDATE that only matches
+while the user stays within USER_QUOTA_BYTES (or their own quota_bytes), so the
+check reads no other row and concurrent uploads can't overshoot together.
+
+Totals of deleted folders and rooms are left as they were. `flask recount-usage`
+rebuilds everything from the File rows should the totals ever drift.
+'''
+
+# Bytes each user may store unless they have their own quota_bytes, 0 for no limit
+USER_QUOTA_BYTES = 0
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def _quota_condition(size):
+    # Users for whom size more bytes stay within their quota
+    default = current_app.config.get('USER_QUOTA_BYTES', USER_QUOTA_BYTES)
+    if default:
+        return User.used_bytes + size <= func.coalesce(User.quota_bytes, default)
+    return or_(User.quota_bytes.is_(None), User.used_bytes + size <= User.quota_bytes)
+
+
+def user_quota(user):
+    # Bytes user may store, None without a limit
+    if user.quota_bytes is not None:
+        return user.quota_bytes
+    return current_app.config.get('USER_QUOTA_BYTES', USER_QUOTA_BYTES) or None
+
+
+def has_quota(owner_id, size):
+    # True when size more bytes fit in the user's quota right now, one primary key lookup
+    return db.session.query(User.id).filter(User.id == owner_id, _quota_condition(size)).first() is not None
+
+
+def folder_chain(folder):
+    # Ids of the ancestors of a loaded folder, root first, then the folder itself. [] for None.
+    return ancestor_ids(folder) + [folder.id] if folder else []
+
+
+def folder_chains(folder_ids):
+    # folder_chain() of each folder id, from one primary key lookup
+    ids = {int(id) for id in folder_ids if id}
+    if not ids:
+        return {}
+    return {row.id: folder_chain(row) for row in db.session.query(Folder.id, Folder.ancestor_path).filter(Folder.id.in_(ids))}
+
+
+def _add(totals, key, files, size):
+    count, total = totals.get(key, (0, 0))
+    totals[key] = (count + files, total + size)
+
+
+class UsageChanges:
+    '''
+    Count and byte deltas collected over one write for the rows of a single
+    owner, written by apply() before the commit. Deltas to the same row add
+    up, so a move leaves the ancestors its old and new place share alone.
+    '''
+
+    def __init__(self, owner_id):
+        self.owner_id = owner_id
+        self.folders = {}
+        self.data_rooms = {}
+        self.used_bytes = 0
+
+    def add(self, files, size, data_room_id=None, chain=()):
+        # files files of size bytes enter (leave, when negative) the folders in chain and the data room
+        for folder_id in chain:
+            _add(self.folders, folder_id, files, size)
+        if data_room_id is not None:
+            _add(self.data_rooms, int(data_room_id), files, size)
+        self.used_bytes += size
+
+    def folder_totals(self, folder):
+        # (file_count, total_bytes) of a loaded folder, including the deltas not applied yet
+        files, size = self.folders.get(folder.id, (0, 0))
+        return folder.file_count + files, folder.total_bytes + size
+
+    def apply(self, check_quota=False):
+        '''
+        Write the deltas, the owner's used_bytes first. With check_quota, growing
+        past the quota raises QuotaExceeded and nothing else is written, the
+        caller's transaction should be rolled back.
+        '''
+        if self.used_bytes:
+            query = User.query.filter(User.id == self.owner_id)
+            if check_quota and self.used_bytes > 0:
+                query = query.filter(_quota_condition(self.used_bytes))
+            updated = query.update({User.used_bytes: User.used_bytes + self.used_bytes}, synchronize_session=False)
+            if check_quota and not updated:
+                raise QuotaExceeded("Storage quota exceeded")
+        _update_totals(Folder, self.folders)
+        _update_totals(DataRoom, self.data_rooms)
+        self.folders, self.data_rooms, self.used_bytes = {}, {}, 0
+
+
+def _update_totals(model, deltas):
+    # One UPDATE per distinct delta, a file created ten levels down is still a single statement
+    ids_by_delta = {}
+    for id, delta in deltas.items():
+        if delta != (0, 0):
+            ids_by_delta.setdefault(delta, []).append(id)
+    for (files, size), ids in ids_by_delta.items():
+        model.query.filter(model.id.in_(ids)).update({
+            model.file_count: model.file_count + files,
+            model.total_bytes: model.total_bytes + size,
+            model.version: model.version + 1,
+        }, synchronize_session=False)
+
+
+def recount_usage():
+    '''
+    Rebuild every size and total from the File rows, in the caller's
+    transaction: sizes from the blobs, or from the stored bytes for files
+    uploaded before the blob store, then the totals from one grouped query
+    over the files. Returns the number of files counted.
+    '''
+    from storage import is_blob_digest, open_stored_file, stored_file_key
+
+    blob_size = select(Blob.size).where(Blob.digest == File.content).scalar_subquery()
+    File.query.filter(File.content.in_(select(Blob.digest))).update({File.size: blob_size}, synchronize_session=False)
+    for file in File.query.filter(File.size == 0):
+        if is_blob_digest(file.content):
+            continue
+        try:
+            stream, size = open_stored_file(stored_file_key(file))
+        except FileNotFoundError:
+            continue
+        stream.close()
+        file.size = size
+    db.session.flush()
+
+    # Files below a tombstone or in a deleted room no longer count
+    folders = {row.id: row for row in db.session.query(Folder.id, Folder.ancestor_path, Folder.deleted_at)}
+    tombstones = {id for id, row in folders.items() if row.deleted_at}
+    deleted_data_rooms = {id for (id,) in db.session.query(DataRoom.id).filter(DataRoom.deleted_at.isnot(None))}
+
+    folder_totals, data_room_totals, used_bytes = {}, {}, {}
+    counted = 0
+    direct = db.session.query(File.parent_data_room_id, File.parent_folder_id, File.owner_id, func.count(File.id), func.sum(File.size)) \
+        .group_by(File.parent_data_room_id, File.parent_folder_id, File.owner_id)
+    for data_room_id, folder_id, owner_id, files, size in direct:
+        chain = folder_chain(folders[folder_id]) if folder_id in folders else []
+        if folder_id and (not chain or tombstones.intersection(chain)):
+            continue
+        for id in chain:
+            _add(folder_totals, id, files, size or 0)
+        _add(data_room_totals, data_room_id, files, size or 0)
+        if data_room_id not in deleted_data_rooms:
+            used_bytes[owner_id] = used_bytes.get(owner_id, 0) + (size or 0)
+            counted += files
+
+    db.session.bulk_update_mappings(Folder, [
+        {"id": id, "file_count": folder_totals.get(id, (0, 0))[0], "total_bytes": folder_totals.get(id, (0, 0))[1]} for id in folders
+    ])
+    db.session.bulk_update_mappings(DataRoom, [
+        {"id": id, "file_count": data_room_totals.get(id, (0, 0))[0], "total_bytes": data_room_totals.get(id, (0, 0))[1]} for (id,) in db.session.query(DataRoom.id)
+    ])
+    db.session.bulk_update_mappings(User, [
+        {"id": id, "used_bytes": used_bytes.get(id, 0)} for (id,) in db.session.query(User.id)
+    ])
+    # Listings cached by clients may show the old totals
+    Folder.query.update({Folder.version: Folder.version + 1}, synchronize_session=False)
+    DataRoom.query.update({DataRoom.version: DataRoom.version + 1}, synchronize_session=False)
+    return counted
+
+
+@click.command('recount-usage')
+@with_appcontext
+def recount_usage_command():
+    '''Rebuild file sizes and the folder, data room and user totals.'''
+    with db.session.begin():
+        counted = recount_usage()
+    click.echo(f"Counted {counted} files")
@@ -0,0 +1,74 @@
+# versions.py
+import hashlib
+from flask import request, Response
+from sqlalchemy import or_
+from . import db
+from .models import DataRoom, Folder
+from .hierarchy import folder_path, under_path
+
+'''
+Version counters and ETags for listings.
+
+Every data room and folder carries a version that only ever goes up. Writes
+bump it in the same transaction as the change itself:
+
+    - creating, moving, renaming or deleting a file or folder bumps the folder
+      (or, at the root, the data room) it leaves and the one it enters
+    - renaming or moving a folder also bumps the folder and every descendant,
+      since their breadcrumbs changed
+    - renaming a data room bumps the room
+    - a change to the file count or bytes of a folder or room bumps it, along
+      with every ancestor, see database/usage.py
+
+Listing endpoints turn the versions they are built from into an ETag, so a
+client polling with If-None-Match gets a 304 after a single-row lookup instead
+of a fresh page of children.
+'''
+
+
+def bump_versions(parents=(), folders=()):
+    '''
+    Bump the listings a write changed, with at most one UPDATE per table.
+
+    parents are (data_room_id, parent_folder_id) pairs of containers whose
+    children changed, parent_folder_id is None at the room root. folders are
+    renamed or moved Folder rows, bumped along with their whole subtree.
+    '''
+    data_room_ids = {data_room_id for data_room_id, parent_folder_id in parents if parent_folder_id is None}
+    folder_ids = {parent_folder_id for _, parent_folder_id in parents if parent_folder_id is not None}
+
+    conditions = [Folder.id.in_(folder_ids)] if folder_ids else []
+    for folder in folders:
+        conditions.append(or_(Folder.id == folder.id, under_path(folder_path(folder))))
+
+    if conditions:
+        Folder.query.filter(or_(*conditions)).update({Folder.version: Folder.version + 1}, synchronize_session=False)
+    if data_room_ids:
+        DataRoom.query.filter(DataRoom.id.in_(data_room_ids)).update({DataRoom.version: DataRoom.version + 1}, synchronize_session=False)
+
+
+def listing_etag(*versions):
+    # The versions a listing was built from, plus the query string that picks the page
+    key = ':'.join(str(version) for version in versions) + '?' + request.query_string.decode()
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def user_data_rooms_etag(owner_id):
+    # Every live room of the user with its version, read from one indexed scan
+    rows = db.session.query(DataRoom.id, DataRoom.version).filter_by(owner_id=owner_id, deleted_at=None).order_by(DataRoom.id)
+    return listing_etag('data_rooms', *(f"{id}.{version}" for id, version in rows))
+
+
+def with_etag(response, etag):
+    # Clients must revalidate on every use, listings change at any time
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def not_modified(etag):
+    # A 304 response when the client already holds this listing, None otherwise
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    return with_etag(Response(status=304), etag)
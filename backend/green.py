@@ -0,0 +1,54 @@
+# green.py
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Support for code that also runs in the gevent workers of transfers.py.
+
+There threading is monkey patched: a "thread" is a greenlet taking turns with
+every connection of the worker on one OS thread, so CPU bound work in one
+stalls all transfers, and process pools break as their management thread is a
+greenlet too. native_thread_pool() hands such work to real threads instead,
+which run beside the event loop (OpenSSL, hashlib and pdfium release the GIL).
+'''
+
+_native = threading.local()
+
+
+def is_green():
+    # True in a process monkey patched by gevent
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+def on_native_worker():
+    # True on a thread of a native_thread_pool() under gevent, which can't
+    # queue work on another pool and should run it inline
+    return getattr(_native, 'worker', False)
+
+
+def native_thread_pool(max_workers, thread_name_prefix=''):
+    # A concurrent.futures executor on OS threads, patched by gevent or not
+    if not is_green():
+        return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+
+    import gevent
+    from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+
+    class NativeThreadPoolExecutor(GeventThreadPoolExecutor):
+        def submit(self, fn, *args, **kwargs):
+            def run():
+                _native.worker = True
+                return fn(*args, **kwargs)
+
+            future = super().submit(run)
+            # gevent calls done callbacks from the event loop, where blocking
+            # (a lock, starting a thread) is an error, so give each a greenlet
+            add_done_callback = future.add_done_callback
+            future.add_done_callback = lambda callback: add_done_callback(lambda done: gevent.spawn(callback, done))
+            return future
+
+    return NativeThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
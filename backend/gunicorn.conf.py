@@ -0,0 +1,28 @@
+# gunicorn.conf.py
+import os, re, shutil, tempfile
+
+'''
+Read by gunicorn from the working directory, on top of the command line flags.
+
+Workers share their metrics through files in PROMETHEUS_MULTIPROC_DIR (see
+metrics.py). It has to be set before the app imports prometheus_client, so
+here rather than in create_app(). Every server gets a directory of its own
+below it, named after its bind address, so `make serve` and `make
+serve_transfers` can run side by side and each /metrics sums its own workers.
+'''
+
+METRICS_DIRECTORY = os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.path.join(tempfile.gettempdir(), 'dataroom-metrics')
+
+
+def on_starting(server):
+    # Files left by a previous run of this server would be summed into this one's metrics
+    directory = os.path.join(METRICS_DIRECTORY, re.sub(r'[^\w.-]', '_', '-'.join(server.cfg.bind)))
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    # Workers are forked after this and inherit it
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = directory
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,157 @@
+# metrics.py
+import logging, os, time
+from functools import wraps
+from flask import g, has_request_context, request
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.wsgi import ClosingIterator
+
+'''
+Request, SQL and storage instrumentation, exported for Prometheus at GET /metrics.
+
+Every request is timed from its first hook until the server closes the
+response, so streamed downloads and archives count until their last byte. The
+SQL statements it ran are counted and timed by cursor events on every engine,
+attributed to the request through flask.g. Storage backends count the bytes
+they read and write, and views marked @transfer('upload') or
+@transfer('download') are also timed as transfers.
+
+Gunicorn workers are separate processes, each with its own counters. With
+PROMETHEUS_MULTIPROC_DIR set (gunicorn.conf.py does it) every process writes
+its metrics to files in that directory and /metrics sums them all, whichever
+worker answers the scrape.
+
+/metrics is only served to scrapers sending the bearer token METRICS_TOKEN,
+without one configured it answers 404.
+
+Requests slower than SLOW_REQUEST_SECONDS are logged as warnings with their
+SLOW_REQUEST_STATEMENTS slowest statements. 0 disables the log.
+'''
+
+SLOW_REQUEST_SECONDS = 0
+SLOW_REQUEST_STATEMENTS = 5
+# Statements kept per request for the slow log, archives of large trees run thousands
+MAX_KEPT_STATEMENTS = 1000
+# Characters of a statement shown in the slow log
+STATEMENT_PREVIEW = 300
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+STATEMENT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144, 233, 377, 610, 987)
+SQL_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 10)
+
+REQUEST_DURATION = Histogram('dataroom_request_duration_seconds', 'Time from the start of a request to the last byte of its response.', ['method', 'endpoint', 'status'], buckets=LATENCY_BUCKETS)
+REQUEST_STATEMENTS = Histogram('dataroom_request_sql_statements', 'SQL statements run by a request.', ['method', 'endpoint'], buckets=STATEMENT_BUCKETS)
+REQUEST_SQL_DURATION = Histogram('dataroom_request_sql_duration_seconds', 'Time a request spent running SQL statements.', ['method', 'endpoint'], buckets=LATENCY_BUCKETS)
+SQL_DURATION = Histogram('dataroom_sql_statement_duration_seconds', 'Time of each SQL statement, in requests or not.', buckets=SQL_BUCKETS)
+TRANSFER_DURATION = Histogram('dataroom_transfer_duration_seconds', 'Time of upload and download requests, to the last byte.', ['direction', 'endpoint'], buckets=LATENCY_BUCKETS)
+STORAGE_BYTES_READ = Counter('dataroom_storage_read_bytes', 'Bytes read from the blob store.', ['backend'])
+STORAGE_BYTES_WRITTEN = Counter('dataroom_storage_written_bytes', 'Bytes written to the blob store.', ['backend'])
+
+log = logging.getLogger(__name__)
+
+
+class RequestStatements:
+    # SQL run by one request, shared with the close callback that reports it
+    def __init__(self, keep):
+        self.count = 0
+        self.seconds = 0.0
+        self.keep = keep
+        self.statements = []
+
+    def add(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        if self.keep and len(self.statements) < MAX_KEPT_STATEMENTS:
+            self.statements.append((seconds, statement))
+
+    def slowest(self, count):
+        return sorted(self.statements, key=lambda item: item[0], reverse=True)[:count]
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the statement's execution context, which a failed statement takes with it
+    if context is not None:
+        context.metrics_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'metrics_started', None)
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    del context.metrics_started
+    SQL_DURATION.observe(seconds)
+    if has_request_context():
+        statements = g.get('metrics_statements')
+        if statements is not None:
+            statements.add(statement, seconds)
+
+
+def transfer(direction):
+    # Also time the view as an 'upload' or a 'download'
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            g.metrics_transfer = direction
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _observe(method, endpoint, path, status, started, statements, direction, slow):
+    # Runs when the server closes the response, out of the request context
+    elapsed = time.perf_counter() - started
+    REQUEST_DURATION.labels(method, endpoint, status).observe(elapsed)
+    REQUEST_STATEMENTS.labels(method, endpoint).observe(statements.count)
+    REQUEST_SQL_DURATION.labels(method, endpoint).observe(statements.seconds)
+    if direction:
+        TRANSFER_DURATION.labels(direction, endpoint).observe(elapsed)
+    if slow and elapsed >= slow:
+        queries = ''.join(f"\n  {seconds * 1000:.1f} ms  {' '.join(statement.split())[:STATEMENT_PREVIEW]}" for seconds, statement in statements.slowest(SLOW_REQUEST_STATEMENTS))
+        log.warning("Slow request %s %s -> %s in %.3fs, %d SQL statements in %.3fs%s", method, path, status, elapsed, statements.count, statements.seconds, queries)
+
+
+def init_metrics(app):
+    slow = app.config.get('SLOW_REQUEST_SECONDS', SLOW_REQUEST_SECONDS)
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_started = time.perf_counter()
+        g.metrics_statements = RequestStatements(keep=slow > 0)
+
+    @app.after_request
+    def finish_request_metrics(response):
+        if 'metrics_started' not in g:
+            # A before_request hook registered ahead of ours answered
+            return response
+        # Rules rather than paths, so ids don't make a series each
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        method, path, status = request.method, request.path, response.status_code
+        started, statements, direction = g.metrics_started, g.metrics_statements, g.get('metrics_transfer')
+        observe = lambda: _observe(method, endpoint, path, status, started, statements, direction, slow)
+        if response.direct_passthrough:
+            # Werkzeug hands files from send_file() to the server without its close
+            # hook, so close them through ours. This gives up sendfile(), which only
+            # unencrypted legacy blobs could use.
+            response.response = ClosingIterator(response.response, observe)
+        else:
+            response.call_on_close(observe)
+        return response
+
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def registry():
+    # Every process's metrics when they are shared through files, this process's otherwise
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        collected = CollectorRegistry()
+        multiprocess.MultiProcessCollector(collected)
+        return collected
+    return REGISTRY
+
+
+def exposition():
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
@@ -0,0 +1,100 @@
+"""blob store, upload sessions, folder index and tombstones
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 09:44:52.093716
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases created with db.create_all() after 0001 may already have some
+    # of these, so only add what is missing
+    inspector = sa.inspect(op.get_bind())
+    tables = inspector.get_table_names()
+
+    def has_column(table, column):
+        return column in {c['name'] for c in inspector.get_columns(table)}
+
+    if 'blob' not in tables:
+        op.create_table('blob',
+        sa.Column('digest', sa.String(length=64), nullable=False),
+        sa.Column('size', sa.BigInteger(), nullable=False),
+        sa.Column('ref_count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('digest')
+        )
+    if 'upload_session' not in tables:
+        op.create_table('upload_session',
+        sa.Column('id', sa.String(length=32), nullable=False),
+        sa.Column('name', sa.String(length=100), nullable=False),
+        sa.Column('size', sa.BigInteger(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('owner_id', sa.Integer(), nullable=False),
+        sa.Column('parent_data_room_id', sa.Integer(), nullable=False),
+        sa.Column('parent_folder_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['owner_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index(op.f('ix_upload_session_owner_id'), 'upload_session', ['owner_id'], unique=False)
+
+    if not has_column('file', 'created_at'):
+        op.add_column('file', sa.Column('created_at', sa.DateTime(), nullable=True))
+
+    if not has_column('data_room', 'deleted_at'):
+        op.add_column('data_room', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+        op.create_index(op.f('ix_data_room_deleted_at'), 'data_room', ['deleted_at'], unique=False)
+
+    if not has_column('folder', 'deleted_at'):
+        op.add_column('folder', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+        op.create_index(op.f('ix_folder_deleted_at'), 'folder', ['deleted_at'], unique=False)
+
+    if not has_column('folder', 'ancestor_path'):
+        op.add_column('folder', sa.Column('ancestor_path', sa.String(length=512).with_variant(sa.String(length=512, collation='C'), 'postgresql'), nullable=False, server_default='/'))
+        op.add_column('folder', sa.Column('depth', sa.Integer(), nullable=False, server_default='0'))
+        op.create_index(op.f('ix_folder_ancestor_path'), 'folder', ['ancestor_path'], unique=False)
+        _backfill_ancestor_paths()
+
+
+def _backfill_ancestor_paths():
+    # Walk the existing tree top-down and write every folder's path and depth
+    folder = sa.table('folder', sa.column('id', sa.Integer), sa.column('parent_folder_id', sa.Integer),
+                      sa.column('ancestor_path', sa.String), sa.column('depth', sa.Integer))
+    bind = op.get_bind()
+    children = {}
+    for id, parent_folder_id in bind.execute(sa.select(folder.c.id, folder.c.parent_folder_id)):
+        children.setdefault(parent_folder_id, []).append(id)
+
+    rows = []
+    level = [(id, '/', 0) for id in children.get(None, [])]
+    while level:
+        rows.extend(level)
+        level = [(child, f"{path}{id}/", depth + 1) for id, path, depth in level for child in children.get(id, [])]
+
+    if rows:
+        bind.execute(
+            folder.update().where(folder.c.id == sa.bindparam('folder_id')).values(ancestor_path=sa.bindparam('path'), depth=sa.bindparam('level')),
+            [{"folder_id": id, "path": path, "level": depth} for id, path, depth in rows],
+        )
+
+
+def downgrade():
+    op.drop_index(op.f('ix_folder_ancestor_path'), table_name='folder')
+    op.drop_column('folder', 'depth')
+    op.drop_column('folder', 'ancestor_path')
+    op.drop_index(op.f('ix_folder_deleted_at'), table_name='folder')
+    op.drop_column('folder', 'deleted_at')
+    op.drop_index(op.f('ix_data_room_deleted_at'), table_name='data_room')
+    op.drop_column('data_room', 'deleted_at')
+    op.drop_column('file', 'created_at')
+    op.drop_index(op.f('ix_upload_session_owner_id'), table_name='upload_session')
+    op.drop_table('upload_session')
+    op.drop_table('blob')
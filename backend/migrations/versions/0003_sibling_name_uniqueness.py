@@ -0,0 +1,75 @@
+"""sibling name uniqueness and parent indexes
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 10:02:19.630254
+
+"""
+import os
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_folder_parent_data_room_id', 'folder', ['parent_data_room_id', 'parent_folder_id', 'name'], unique=False)
+    op.create_index('ix_folder_parent_folder_id', 'folder', ['parent_folder_id', 'name'], unique=False)
+    op.create_index('ix_file_parent_data_room_id', 'file', ['parent_data_room_id', 'parent_folder_id', 'name'], unique=False)
+    op.create_index('ix_file_parent_folder_id', 'file', ['parent_folder_id', 'name'], unique=False)
+
+    # The old check-then-insert let concurrent creates store a name twice
+    _rename_duplicates('folder', ('parent_data_room_id', 'parent_folder_id'), live_only=True)
+    _rename_duplicates('file', ('parent_data_room_id', 'parent_folder_id'), live_only=False)
+    _rename_duplicates('data_room', ('owner_id',), live_only=True)
+
+    # Root-level items have no parent folder, coalesce so they collide too.
+    # Tombstoned folders and data rooms give up their name straight away
+    live = sa.text('deleted_at IS NULL')
+    op.create_index('uq_folder_name', 'folder', ['parent_data_room_id', sa.text('coalesce(parent_folder_id, 0)'), 'name'], unique=True,
+                    sqlite_where=live, postgresql_where=live)
+    op.create_index('uq_file_name', 'file', ['parent_data_room_id', sa.text('coalesce(parent_folder_id, 0)'), 'name'], unique=True)
+    op.create_index('uq_data_room_name', 'data_room', ['owner_id', 'name'], unique=True,
+                    sqlite_where=live, postgresql_where=live)
+
+
+def _rename_duplicates(table_name, parent_columns, live_only):
+    '''
+    Keep the oldest of the siblings sharing a name and rename the others
+    "Report (2).pdf", "Report (3).pdf"..., skipping names already taken, so the
+    unique indexes can be created.
+    '''
+    table = sa.table(table_name, sa.column('id', sa.Integer), sa.column('name', sa.String), sa.column('deleted_at', sa.DateTime),
+                     *[sa.column(name, sa.Integer) for name in parent_columns])
+    parents = [sa.func.coalesce(table.c[name], 0) for name in parent_columns]
+    named = [table.c.name.isnot(None)] + ([table.c.deleted_at.is_(None)] if live_only else [])
+    bind = op.get_bind()
+
+    duplicates = bind.execute(sa.select(*parents, table.c.name).where(*named).group_by(*parents, table.c.name).having(sa.func.count() > 1)).fetchall()
+    for *parent, name in duplicates:
+        siblings = [*named, *[column == value for column, value in zip(parents, parent)]]
+        taken = {sibling for (sibling,) in bind.execute(sa.select(table.c.name).where(*siblings))}
+        ids = [id for (id,) in bind.execute(sa.select(table.c.id).where(*siblings, table.c.name == name).order_by(table.c.id))]
+        stem, extension = os.path.splitext(name) if table_name == 'file' else (name, '')
+        number = 2
+        for id in ids[1:]:
+            while f"{stem} ({number}){extension}" in taken:
+                number += 1
+            new_name = f"{stem} ({number}){extension}"
+            taken.add(new_name)
+            bind.execute(table.update().where(table.c.id == id).values(name=new_name))
+
+
+def downgrade():
+    op.drop_index('uq_data_room_name', table_name='data_room')
+    op.drop_index('uq_file_name', table_name='file')
+    op.drop_index('uq_folder_name', table_name='folder')
+    op.drop_index('ix_file_parent_folder_id', table_name='file')
+    op.drop_index('ix_file_parent_data_room_id', table_name='file')
+    op.drop_index('ix_folder_parent_folder_id', table_name='folder')
+    op.drop_index('ix_folder_parent_data_room_id', table_name='folder')
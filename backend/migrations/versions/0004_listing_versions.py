@@ -0,0 +1,27 @@
+"""version counters on data rooms and folders
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 14:21:07.318652
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing rows start at version 1, like new ones
+    op.add_column('data_room', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+    op.add_column('folder', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    op.drop_column('folder', 'version')
+    op.drop_column('data_room', 'version')
@@ -0,0 +1,57 @@
+"""full-text search over extracted page text
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 16:40:52.904117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('blob', sa.Column('indexed_at', sa.DateTime(), nullable=True))
+    op.create_index(op.f('ix_file_content'), 'file', ['content'], unique=False)
+    op.create_table('file_page',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('digest', sa.String(length=64), nullable=False),
+    sa.Column('page', sa.Integer(), nullable=False),
+    sa.Column('text', sa.Text(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_file_page_digest'), 'file_page', ['digest'], unique=False)
+
+    # The inverted index itself is dialect specific, see search/index.py
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        # External content FTS5 table kept in sync with file_page by triggers.
+        # Pages are never updated, only inserted and deleted.
+        op.execute("CREATE VIRTUAL TABLE file_page_fts USING fts5(text, content='file_page', content_rowid='id', tokenize='porter unicode61')")
+        op.execute("CREATE TRIGGER file_page_fts_insert AFTER INSERT ON file_page BEGIN "
+                   "INSERT INTO file_page_fts(rowid, text) VALUES (new.id, new.text); END")
+        op.execute("CREATE TRIGGER file_page_fts_delete AFTER DELETE ON file_page BEGIN "
+                   "INSERT INTO file_page_fts(file_page_fts, rowid, text) VALUES ('delete', old.id, old.text); END")
+    elif dialect == 'postgresql':
+        op.execute("ALTER TABLE file_page ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (to_tsvector('english', text)) STORED")
+        op.execute("CREATE INDEX ix_file_page_search_vector ON file_page USING gin (search_vector)")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute("DROP TRIGGER file_page_fts_delete")
+        op.execute("DROP TRIGGER file_page_fts_insert")
+        op.execute("DROP TABLE file_page_fts")
+    elif dialect == 'postgresql':
+        op.execute("DROP INDEX ix_file_page_search_vector")
+    op.drop_index(op.f('ix_file_page_digest'), table_name='file_page')
+    op.drop_table('file_page')
+    op.drop_index(op.f('ix_file_content'), table_name='file')
+    op.drop_column('blob', 'indexed_at')
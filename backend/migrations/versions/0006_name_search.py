@@ -0,0 +1,52 @@
+"""name indexes for typeahead
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 18:05:33.517240
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Prefix and substring indexes over file and folder names, see search/names.py
+    dialect = op.get_bind().dialect.name
+    for table in ('folder', 'file'):
+        if dialect == 'sqlite':
+            op.execute(f"CREATE INDEX ix_{table}_name_prefix ON {table} (parent_data_room_id, lower(name))")
+
+            # Trigram FTS5 table over the names, kept in sync by triggers
+            op.execute(f"CREATE VIRTUAL TABLE {table}_name_fts USING fts5(name, content='{table}', content_rowid='id', tokenize='trigram')")
+            op.execute(f"CREATE TRIGGER {table}_name_fts_insert AFTER INSERT ON {table} BEGIN "
+                       f"INSERT INTO {table}_name_fts(rowid, name) VALUES (new.id, new.name); END")
+            op.execute(f"CREATE TRIGGER {table}_name_fts_delete AFTER DELETE ON {table} BEGIN "
+                       f"INSERT INTO {table}_name_fts({table}_name_fts, rowid, name) VALUES ('delete', old.id, old.name); END")
+            op.execute(f"CREATE TRIGGER {table}_name_fts_update AFTER UPDATE OF name ON {table} BEGIN "
+                       f"INSERT INTO {table}_name_fts({table}_name_fts, rowid, name) VALUES ('delete', old.id, old.name); "
+                       f"INSERT INTO {table}_name_fts(rowid, name) VALUES (new.id, new.name); END")
+            op.execute(f"INSERT INTO {table}_name_fts({table}_name_fts) VALUES ('rebuild')")
+        elif dialect == 'postgresql':
+            op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            op.execute(f"CREATE INDEX ix_{table}_name_prefix ON {table} (parent_data_room_id, lower(name) text_pattern_ops)")
+            op.execute(f"CREATE INDEX ix_{table}_name_trigram ON {table} USING gin (lower(name) gin_trgm_ops)")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table in ('file', 'folder'):
+        if dialect == 'sqlite':
+            op.execute(f"DROP TRIGGER {table}_name_fts_update")
+            op.execute(f"DROP TRIGGER {table}_name_fts_delete")
+            op.execute(f"DROP TRIGGER {table}_name_fts_insert")
+            op.execute(f"DROP TABLE {table}_name_fts")
+        elif dialect == 'postgresql':
+            op.execute(f"DROP INDEX ix_{table}_name_trigram")
+        op.execute(f"DROP INDEX ix_{table}_name_prefix")
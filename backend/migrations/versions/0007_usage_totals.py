@@ -0,0 +1,88 @@
+"""file sizes, folder and data room totals, user usage and quota
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 21:05:43.512907
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('file', sa.Column('size', sa.BigInteger(), nullable=False, server_default='0'))
+    for table in ('folder', 'data_room'):
+        op.add_column(table, sa.Column('file_count', sa.Integer(), nullable=False, server_default='0'))
+        op.add_column(table, sa.Column('total_bytes', sa.BigInteger(), nullable=False, server_default='0'))
+    op.add_column('user', sa.Column('used_bytes', sa.BigInteger(), nullable=False, server_default='0'))
+    op.add_column('user', sa.Column('quota_bytes', sa.BigInteger(), nullable=True))
+    _backfill_totals()
+
+
+def _backfill_totals():
+    '''
+    Sizes from the blobs, then the totals of every folder, room and user from
+    the files grouped by parent. Files uploaded before the blob store count as
+    0 bytes until `flask recount-usage` reads their sizes from storage.
+    '''
+    file = sa.table('file', sa.column('content', sa.String), sa.column('size', sa.BigInteger), sa.column('owner_id', sa.Integer),
+                    sa.column('parent_data_room_id', sa.Integer), sa.column('parent_folder_id', sa.Integer))
+    blob = sa.table('blob', sa.column('digest', sa.String), sa.column('size', sa.BigInteger))
+    folder = sa.table('folder', sa.column('id', sa.Integer), sa.column('ancestor_path', sa.String), sa.column('deleted_at', sa.DateTime),
+                      sa.column('file_count', sa.Integer), sa.column('total_bytes', sa.BigInteger))
+    data_room = sa.table('data_room', sa.column('id', sa.Integer), sa.column('deleted_at', sa.DateTime),
+                         sa.column('file_count', sa.Integer), sa.column('total_bytes', sa.BigInteger))
+    user = sa.table('user', sa.column('id', sa.Integer), sa.column('used_bytes', sa.BigInteger))
+    bind = op.get_bind()
+
+    blob_size = sa.select(blob.c.size).where(blob.c.digest == file.c.content).scalar_subquery()
+    bind.execute(file.update().where(file.c.content.in_(sa.select(blob.c.digest))).values(size=blob_size))
+
+    paths, tombstones = {}, set()
+    for id, ancestor_path, deleted_at in bind.execute(sa.select(folder.c.id, folder.c.ancestor_path, folder.c.deleted_at)):
+        paths[id] = [int(ancestor) for ancestor in ancestor_path.strip('/').split('/') if ancestor] + [id]
+        if deleted_at:
+            tombstones.add(id)
+    deleted_data_rooms = {id for (id,) in bind.execute(sa.select(data_room.c.id).where(data_room.c.deleted_at.isnot(None)))}
+
+    # Files below a tombstone or in a deleted room no longer count
+    folder_totals, data_room_totals, used_bytes = {}, {}, {}
+    direct = sa.select(file.c.parent_data_room_id, file.c.parent_folder_id, file.c.owner_id, sa.func.count(), sa.func.sum(file.c.size)) \
+        .group_by(file.c.parent_data_room_id, file.c.parent_folder_id, file.c.owner_id)
+    for data_room_id, folder_id, owner_id, count, size in bind.execute(direct):
+        chain = paths.get(folder_id, []) if folder_id else []
+        if folder_id and (not chain or tombstones.intersection(chain)):
+            continue
+        for totals, key in [(folder_totals, id) for id in chain] + [(data_room_totals, data_room_id)]:
+            files, total = totals.get(key, (0, 0))
+            totals[key] = (files + count, total + (size or 0))
+        if data_room_id not in deleted_data_rooms:
+            used_bytes[owner_id] = used_bytes.get(owner_id, 0) + (size or 0)
+
+    for table, totals in ((folder, folder_totals), (data_room, data_room_totals)):
+        if totals:
+            bind.execute(
+                table.update().where(table.c.id == sa.bindparam('row_id')).values(file_count=sa.bindparam('files'), total_bytes=sa.bindparam('bytes')),
+                [{"row_id": id, "files": files, "bytes": total} for id, (files, total) in totals.items()],
+            )
+    if used_bytes:
+        bind.execute(
+            user.update().where(user.c.id == sa.bindparam('user_id')).values(used_bytes=sa.bindparam('bytes')),
+            [{"user_id": id, "bytes": total} for id, total in used_bytes.items()],
+        )
+
+
+def downgrade():
+    op.drop_column('user', 'quota_bytes')
+    op.drop_column('user', 'used_bytes')
+    for table in ('data_room', 'folder'):
+        op.drop_column(table, 'total_bytes')
+        op.drop_column(table, 'file_count')
+    op.drop_column('file', 'size')
@@ -0,0 +1,43 @@
+"""change log of every data room
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 23:12:31.604218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing rooms start with an empty log
+    op.add_column('data_room', sa.Column('change_seq', sa.Integer(), nullable=False, server_default='0'))
+    op.create_table('change',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('data_room_id', sa.Integer(), nullable=False),
+    sa.Column('seq', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=16), nullable=False),
+    sa.Column('op', sa.String(length=16), nullable=False),
+    sa.Column('item_id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=100), nullable=True),
+    sa.Column('parent_folder_id', sa.Integer(), nullable=True),
+    sa.Column('size', sa.BigInteger(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_change_created_at'), 'change', ['created_at'], unique=False)
+    op.create_index('uq_change_seq', 'change', ['data_room_id', 'seq'], unique=True)
+
+
+def downgrade():
+    op.drop_index('uq_change_seq', table_name='change')
+    op.drop_index(op.f('ix_change_created_at'), table_name='change')
+    op.drop_table('change')
+    op.drop_column('data_room', 'change_seq')
@@ -0,0 +1,3 @@
+# previews/__init__.py
+from .cache import PREVIEW_CACHE_SIZE, PreviewCache
+from .rendering import PREVIEW_SIZES, PREVIEW_WORKERS, preview, render_pages, render_previews, start_preview_renderer
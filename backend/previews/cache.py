@@ -0,0 +1,87 @@
+# previews/cache.py
+import os, threading
+
+'''
+Size-bounded disk cache of rendered previews, shared by every process:
+
+    uploads/previews/<digest[0:2]>/<digest>-<size>-<page>.jpg
+    uploads/previews/<digest[0:2]>/<digest>.pages     page count, 0 when not a PDF
+
+Entries are keyed by content hash, so every file with the same bytes shares
+them and they never go stale. A hit bumps the entry's mtime, and once the
+cache grows past its bound the least recently used entries are removed until
+it is back under PREVIEW_CACHE_LOW_WATER of the bound.
+
+Each process tracks the size it has seen and rescans the directory before
+evicting, so entries written by other processes are accounted for at the
+next eviction.
+'''
+
+PREVIEW_CACHE_SIZE = 1024 * 1024 * 1024
+PREVIEW_CACHE_LOW_WATER = 0.9
+
+
+class PreviewCache:
+    def __init__(self, directory, max_size=PREVIEW_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self._size = None
+        self._lock = threading.Lock()
+
+    def path(self, digest, size, page):
+        return os.path.join(self.directory, digest[:2], f"{digest}-{size}-{page}.jpg")
+
+    def pages_path(self, digest):
+        return os.path.join(self.directory, digest[:2], f"{digest}.pages")
+
+    def read_pages(self, digest):
+        # Page count of a blob rendered before, None when not known
+        try:
+            with open(self.pages_path(digest)) as file:
+                return int(file.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def read(self, digest, size, page):
+        # Contents of a cached preview or None, marking it recently used
+        path = self.path(digest, size, page)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def _entries(self):
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def added(self, size):
+        # Account for a new entry of size bytes, evicting when over the bound
+        with self._lock:
+            if self._size is None:
+                self._size = sum(entry_size for _, entry_size, _ in self._entries())
+            else:
+                self._size += size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        self._size = sum(entry_size for _, entry_size, _ in entries)
+        target = self.max_size * PREVIEW_CACHE_LOW_WATER
+        for _, entry_size, path in entries:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= entry_size
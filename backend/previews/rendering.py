@@ -0,0 +1,186 @@
+# previews/rendering.py
+import io, logging, multiprocessing, os, threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import pypdfium2 as pdfium
+from flask import current_app
+from green import is_green, native_thread_pool
+from storage.encryption import decode_master_key, open_blob
+from .cache import PREVIEW_CACHE_SIZE, PreviewCache
+
+'''
+Page images rendered from PDF blobs.
+
+Rendering is CPU bound, so it runs in a pool of PREVIEW_WORKERS processes next
+to each web process. Once an upload commits, the thumbnail and the first page
+of every new blob are rendered ahead of time. Any other page is rendered the
+first time it is asked for, and waited on by the request. Workers write images
+straight into the cache, so only sizes come back over the pipe.
+
+Rendering also records the blob's page count next to its images, 0 for a blob
+that is not a PDF, so pages it doesn't have are turned away without opening
+it again and never take up an entry in the cache.
+'''
+
+PREVIEW_WORKERS = 2
+# Longest edge of each preview size, in pixels
+PREVIEW_SIZES = {"thumbnail": 256, "page": 1024}
+PREVIEW_QUALITY = 75
+# Rendered ahead of time for new blobs, as (size, page)
+PRERENDERED = (("thumbnail", 1), ("page", 1))
+# Seconds a request waits for a page it has to render
+PREVIEW_TIMEOUT = 30
+
+_MP_CONTEXT = multiprocessing.get_context('fork')
+
+log = logging.getLogger(__name__)
+
+
+def _write(path, data):
+    # Readers in other processes never see a partial image
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as file:
+        file.write(data)
+    os.replace(temporary, path)
+
+
+def render_pages(backend, digest, key, targets, pages_path):
+    '''
+    Render (size, page, image_path) targets of the PDF stored in backend under
+    digest, decrypted with the master key, as JPEG files, and write its page
+    count to pages_path. Pages it doesn't have are skipped. Runs in a worker
+    process. Returns the number of bytes written.
+    '''
+    written = 0
+    try:
+        file, _ = open_blob(backend.open(digest), key)
+    except Exception:
+        file = None
+    try:
+        document = pdfium.PdfDocument(file, autoclose=True) if file else None
+    except Exception:
+        file.close()
+        document = None
+    try:
+        pages = str(len(document) if document is not None else 0).encode()
+        _write(pages_path, pages)
+        written += len(pages)
+        for size, page, image_path in targets:
+            if document is None or not 1 <= page <= len(document):
+                continue
+            pdf_page = document[page - 1]
+            scale = PREVIEW_SIZES[size] / max(pdf_page.get_size())
+            image = pdf_page.render(scale=scale).to_pil().convert('RGB')
+            buffer = io.BytesIO()
+            image.save(buffer, 'JPEG', quality=PREVIEW_QUALITY, optimize=True)
+            data = buffer.getvalue()
+            _write(image_path, data)
+            written += len(data)
+    finally:
+        if document is not None:
+            document.close()
+    return written
+
+
+class PreviewRenderer:
+    '''
+    Renders previews of one web process into the shared cache. With no workers
+    nothing is rendered ahead of time and requests render inline.
+    '''
+
+    def __init__(self, directory, cache_size, backend, key, workers=PREVIEW_WORKERS):
+        self.cache = PreviewCache(directory, cache_size)
+        self.backend = backend
+        self.key = key
+        self.workers = workers
+        self._pool = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        # pdfium is not thread safe, inline renders take turns
+        self._inline = threading.Lock()
+
+    def _executor(self):
+        # Started on first use. Process pools don't work under gevent, there
+        # renders take turns on one thread as pdfium is not thread safe.
+        if self._pool is None:
+            if is_green():
+                self._pool = native_thread_pool(1, 'preview-render')
+            else:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=_MP_CONTEXT)
+        return self._pool
+
+    def submit(self, digest, targets):
+        '''
+        Queue (size, page) targets of a blob. Returns the futures of the jobs
+        rendering them, targets already being rendered share their job.
+        '''
+        with self._lock:
+            futures = {self._pending[(digest, *target)] for target in targets if (digest, *target) in self._pending}
+            new = [target for target in targets if (digest, *target) not in self._pending]
+            if new:
+                jobs = [(size, page, self.cache.path(digest, size, page)) for size, page in new]
+                future = self._executor().submit(render_pages, self.backend, digest, self.key, jobs, self.cache.pages_path(digest))
+                for target in new:
+                    self._pending[(digest, *target)] = future
+                futures.add(future)
+        if new:
+            future.add_done_callback(lambda future: self._done(digest, new, future))
+        return futures
+
+    def _done(self, digest, targets, future):
+        with self._lock:
+            for target in targets:
+                self._pending.pop((digest, *target), None)
+            if future.cancelled():
+                return
+            error = future.exception()
+            if isinstance(error, BrokenProcessPool):
+                # A worker died, the next render starts a new pool
+                self._pool = None
+        if error is None:
+            self.cache.added(future.result())
+        else:
+            log.error("Rendering previews of %s failed: %s", digest, error)
+
+    def prerender(self, digests):
+        if self.workers > 0:
+            for digest in digests:
+                self.submit(digest, PRERENDERED)
+
+    def get(self, digest, size, page):
+        '''
+        JPEG bytes of a page preview, rendering it on a cache miss. b'' when
+        there is nothing to show.
+        '''
+        data = self.cache.read(digest, size, page)
+        if data is not None:
+            return data
+        # Past the last page, or not a PDF at all
+        pages = self.cache.read_pages(digest)
+        if pages is not None and page > pages:
+            return b''
+        if self.workers > 0:
+            for future in self.submit(digest, [(size, page)]):
+                future.result(timeout=PREVIEW_TIMEOUT)
+        else:
+            with self._inline:
+                self.cache.added(render_pages(self.backend, digest, self.key, [(size, page, self.cache.path(digest, size, page))], self.cache.pages_path(digest)))
+        return self.cache.read(digest, size, page) or b''
+
+
+def start_preview_renderer(app, workers=PREVIEW_WORKERS, cache_size=PREVIEW_CACHE_SIZE):
+    directory = os.path.join(app.config['UPLOAD_FOLDER'], 'previews')
+    app.extensions['preview_renderer'] = PreviewRenderer(directory, cache_size, app.extensions['storage'], decode_master_key(app.config['ENCRYPTION_KEY']), workers)
+
+
+def render_previews(digests):
+    # Queue newly stored blobs for rendering ahead of the first listing that shows them
+    renderer = current_app.extensions.get('preview_renderer')
+    if renderer and digests:
+        renderer.prerender(set(digests))
+
+
+def preview(digest, size, page):
+    # JPEG bytes of a page of a blob at one of PREVIEW_SIZES, b'' when it has none
+    return current_app.extensions['preview_renderer'].get(digest, size, page)
@@ -0,0 +1,172 @@
+# purge.py
+import logging, os, shutil, threading, time
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import false, or_
+from database.models import db, DataRoom, Folder, File
+from database.hierarchy import folder_path, under_path
+from database.changes import CHANGE_RETENTION, trim_changes
+from storage import UPLOAD_SESSION_TTL, expire_sessions, release_blobs, unlink_unreferenced
+
+'''
+Background purge of deleted data rooms and folders.
+
+DELETE /data-room/<id> and DELETE /folder/<id> only set deleted_at on the room
+or on the root of the folder subtree (a tombstone) and return. The purge then
+removes everything below each tombstone in batches of PURGE_BATCH_SIZE rows,
+each batch in its own short transaction followed by a pause, so other writers
+never wait on a large delete:
+
+    1. files anywhere below the tombstone, dropping their blob references and
+       unlinking unreferenced blobs after each commit
+    2. folders, deepest first, so a parent never goes before its children
+    3. the tombstoned room or folder itself, then its legacy upload directory
+
+Each pass also trims change log entries older than CHANGE_RETENTION seconds,
+and the whole log of every purged room, see database/changes.py, and deletes
+upload sessions abandoned for UPLOAD_SESSION_TTL seconds with their part files.
+
+All progress lives in the database, so an interrupted purge picks up from the
+remaining rows on its next run. Several purges may run at once: a batch whose
+rows were already deleted by another purge is rolled back and read again.
+'''
+
+PURGE_BATCH_SIZE = 500
+# Seconds to pause after each batch
+PURGE_BATCH_DELAY = 0.1
+# Seconds between passes of the background worker
+PURGE_INTERVAL = 60
+
+log = logging.getLogger(__name__)
+
+
+class _BatchTaken(Exception):
+    pass
+
+
+def _purge_rows(select_files, select_folders, batch_size, delay):
+    '''
+    Delete the rows of select_files() and then select_folders() in batches. Both
+    are called again for every batch. Returns the number of rows deleted.
+    '''
+    purged = 0
+    for select, model in ((select_files, File), (select_folders, Folder)):
+        while True:
+            try:
+                with db.session.begin():
+                    rows = select().limit(batch_size).all()
+                    if not rows:
+                        break
+
+                    # Delete exactly the selected rows or none of them
+                    deleted = model.query.filter(model.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+                    if deleted != len(rows):
+                        raise _BatchTaken()
+                    unreferenced = release_blobs(row.content for row in rows) if model is File else []
+            except _BatchTaken:
+                continue
+
+            # Remove the bytes only once no committed File points at them
+            unlink_unreferenced(unreferenced)
+            purged += len(rows)
+            time.sleep(delay)
+    return purged
+
+
+def _remove_legacy_directory(*parts):
+    path = os.path.join(current_app.config['UPLOAD_FOLDER'], *parts)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+
+def purge_folder(folder_id, batch_size=PURGE_BATCH_SIZE, delay=PURGE_BATCH_DELAY):
+    # Remove a tombstoned folder and its subtree, returns the number of rows deleted
+    def descendants():
+        # Re-read every batch, an ancestor of the tombstone may have been moved
+        folder = Folder.query.get(folder_id)
+        if folder is None:
+            return Folder.query.filter(false())
+        return Folder.query.filter(under_path(folder_path(folder)))
+
+    def files():
+        subtree_ids = descendants().with_entities(Folder.id)
+        return db.session.query(File.id, File.content).filter(or_(File.parent_folder_id == folder_id, File.parent_folder_id.in_(subtree_ids)))
+
+    def folders():
+        return descendants().with_entities(Folder.id).order_by(Folder.depth.desc())
+
+    purged = _purge_rows(files, folders, batch_size, delay)
+
+    with db.session.begin():
+        folder = Folder.query.get(folder_id)
+        if folder is None:
+            return purged
+        legacy_directory = ('user-' + str(folder.owner_id), 'data-room-' + str(folder.parent_data_room_id), 'folder-' + str(folder.id))
+        purged += Folder.query.filter_by(id=folder_id).delete(synchronize_session=False)
+
+    _remove_legacy_directory(*legacy_directory)
+    return purged
+
+
+def purge_data_room(data_room_id, batch_size=PURGE_BATCH_SIZE, delay=PURGE_BATCH_DELAY):
+    # Remove a tombstoned data room and everything in it, returns the number of rows deleted
+    def files():
+        return db.session.query(File.id, File.content).filter(File.parent_data_room_id == data_room_id)
+
+    def folders():
+        return db.session.query(Folder.id).filter(Folder.parent_data_room_id == data_room_id).order_by(Folder.depth.desc())
+
+    purged = _purge_rows(files, folders, batch_size, delay)
+    trim_changes(batch_size=batch_size, data_room_id=data_room_id)
+
+    with db.session.begin():
+        data_room = DataRoom.query.get(data_room_id)
+        if data_room is None:
+            return purged
+        legacy_directory = ('user-' + str(data_room.owner_id), 'data-room-' + str(data_room.id))
+        purged += DataRoom.query.filter_by(id=data_room_id).delete(synchronize_session=False)
+
+    _remove_legacy_directory(*legacy_directory)
+    return purged
+
+
+def purge_tombstones(batch_size=PURGE_BATCH_SIZE, delay=PURGE_BATCH_DELAY):
+    # Purge every tombstone, oldest first, then trim old change log entries and expire abandoned uploads. Returns the number of rows deleted.
+    with db.session.begin():
+        folder_ids = [id for (id,) in db.session.query(Folder.id).filter(Folder.deleted_at.isnot(None)).order_by(Folder.deleted_at, Folder.id)]
+        data_room_ids = [id for (id,) in db.session.query(DataRoom.id).filter(DataRoom.deleted_at.isnot(None)).order_by(DataRoom.deleted_at, DataRoom.id)]
+
+    purged = 0
+    for folder_id in folder_ids:
+        purged += purge_folder(folder_id, batch_size, delay)
+    for data_room_id in data_room_ids:
+        purged += purge_data_room(data_room_id, batch_size, delay)
+    trim_changes(current_app.config.get('CHANGE_RETENTION', CHANGE_RETENTION), batch_size)
+    expire_sessions(current_app.config.get('UPLOAD_SESSION_TTL', UPLOAD_SESSION_TTL))
+    return purged
+
+
+def start_purge_worker(app, interval=PURGE_INTERVAL):
+    # Purge in a daemon thread of this process every interval seconds
+    def run():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    purge_tombstones()
+                except Exception:
+                    log.exception("Purge failed")
+
+    worker = threading.Thread(target=run, name='purge', daemon=True)
+    worker.start()
+    return worker
+
+
+@click.command('purge')
+@click.option('--batch-size', default=PURGE_BATCH_SIZE, show_default=True, help='Rows deleted per transaction.')
+@click.option('--delay', default=PURGE_BATCH_DELAY, show_default=True, help='Seconds to pause between batches.')
+@with_appcontext
+def purge_command(batch_size, delay):
+    '''Remove deleted data rooms and folders now.'''
+    click.echo(f"Purged {purge_tombstones(batch_size, delay)} rows")
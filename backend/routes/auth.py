@@ -3,9 +3,12 @@ from flask import Blueprint, jsonify, request, url_for, redirect
 from flask_jwt_extended import create_access_token
 from database.models import db, User
 from datetime import timedelta
+import logging
 
 auth_routes = Blueprint('auth', __name__)
 
+log = logging.getLogger(__name__)
+
 @auth_routes.route('/login', methods=['POST'])
 def login():
     try:
@@ -21,7 +24,7 @@ def login():
         access_token = create_access_token(identity=user.id, expires_delta=timedelta(hours=12))
         return jsonify(access_token=access_token), 200
     except Exception as e:
-        print(e)
+        log.exception("Login failed")
         return jsonify({"message": f"Error: {str(e)}"}), 500
 
 
@@ -36,5 +39,5 @@ def create_mock_user(username):
         access_token = create_access_token(identity=new_user.id, expires_delta=timedelta(hours=12))
         return jsonify(access_token=access_token), 200
     except Exception as e:
-        print(e)
+        log.exception("Creating user %s failed", username)
         return jsonify({"message": f"Error: {str(e)}"}), 500
\ No newline at end of file
@@ -0,0 +1,264 @@
+# api/routes/batch.py
+import os
+from datetime import datetime
+from flask import Blueprint, jsonify, request
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from database import is_unique_violation
+from database.models import db, File, Folder, DataRoom
+from database.hierarchy import ancestor_ids, is_in_subtree, move_subtree, tombstoned_folder_ids
+from database.permissions import invalidate
+from database.versions import bump_versions
+from database.usage import UsageChanges, folder_chain
+from database.changes import change, move_changes, record_changes
+from storage import is_blob_digest, release_blobs, stored_file_key, unlink_unreferenced
+
+'''
+Batch move / rename / delete of files and folders in one transaction:
+
+    POST /batch
+    {"operations": [
+        {"op": "move", "type": "file", "id": 7, "parent_data_room_id": 1, "parent_folder_id": 3, "name": "optional new name"},
+        {"op": "rename", "type": "folder", "id": 4, "name": "Closing Set"},
+        {"op": "delete", "type": "file", "id": 9}
+    ]}
+
+Items, destinations and possible name conflicts are loaded with one query per
+table for the whole batch. Operations are applied in order, so later operations
+see the effect of earlier ones, and each gets its own entry in "results".
+Failed operations are skipped without affecting the rest of the batch, except
+for a name taken by a concurrent request, which fails the whole batch with 409.
+Deleting a folder only tombstones it, purge.py removes its subtree later.
+'''
+
+batch_routes = Blueprint('batch', __name__)
+
+MAX_BATCH_OPERATIONS = 1000
+OPERATIONS = ('move', 'rename', 'delete')
+MODELS = {'file': File, 'folder': Folder}
+
+
+def _is_id(value):
+    # JSON true and false are ints to Python, but never ids
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _result(index, status, message):
+    return {"index": index, "status": status, "message": message}
+
+
+@batch_routes.route('/batch', methods=['POST'])
+@jwt_required()
+def apply_batch():
+    current_user_id = get_jwt_identity()
+    data = request.get_json()
+    if not data:
+        return jsonify({"message": "No JSON data in request body"}), 400
+
+    operations = data.get('operations')
+    if not isinstance(operations, list) or not operations:
+        return jsonify({"message": "operations must be a non-empty list"}), 400
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return jsonify({"message": f"At most {MAX_BATCH_OPERATIONS} operations per batch"}), 400
+
+    # Validate the shape of every operation before touching the database
+    results = [None] * len(operations)
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get('op') not in OPERATIONS or operation.get('type') not in MODELS or not _is_id(operation.get('id')):
+            results[index] = _result(index, 400, "op, type and id are required")
+        elif operation['op'] == 'rename' and not operation.get('name'):
+            results[index] = _result(index, 400, "name is required")
+        elif operation['op'] == 'move' and not operation.get('parent_data_room_id'):
+            results[index] = _result(index, 400, "parent_data_room_id is required")
+        elif operation['op'] == 'move':
+            # Ids may arrive as strings, as they do from forms in the single item routes
+            try:
+                if any(isinstance(operation.get(key), bool) for key in ('parent_data_room_id', 'parent_folder_id')):
+                    raise TypeError()
+                operation['parent_data_room_id'] = int(operation['parent_data_room_id'])
+                operation['parent_folder_id'] = int(operation['parent_folder_id']) if operation.get('parent_folder_id') else None
+            except (TypeError, ValueError):
+                results[index] = _result(index, 400, "parent_data_room_id and parent_folder_id must be ids")
+    valid = [(index, operation) for index, operation in enumerate(operations) if results[index] is None]
+
+    try:
+        # Start a transaction
+        with db.session.begin():
+            # Load every item and destination with one query per table
+            file_ids = {operation['id'] for _, operation in valid if operation['type'] == 'file'}
+            folder_ids = {operation['id'] for _, operation in valid if operation['type'] == 'folder'}
+            folder_ids |= {operation.get('parent_folder_id') for _, operation in valid if operation['op'] == 'move' and operation.get('parent_folder_id')}
+            data_room_ids = {operation['parent_data_room_id'] for _, operation in valid if operation['op'] == 'move'}
+
+            files = {file.id: file for file in File.query.filter(File.id.in_(file_ids))} if file_ids else {}
+            # The parents of files and folders decide whether they have been deleted
+            folder_ids |= {file.parent_folder_id for file in files.values() if file.parent_folder_id}
+            items = {
+                'file': files,
+                'folder': {folder.id: folder for folder in Folder.query.filter(Folder.id.in_(folder_ids))} if folder_ids else {},
+            }
+            data_room_ids |= {item.parent_data_room_id for loaded in items.values() for item in loaded.values()}
+            data_rooms = {data_room.id: data_room for data_room in DataRoom.query.filter(DataRoom.id.in_(data_room_ids))} if data_room_ids else {}
+
+            # Occupied names for every name the batch could move into, keyed by
+            # (item_type, data room, parent folder, name)
+            occupied = set()
+            for item_type, model in MODELS.items():
+                names = {operation.get('name') or getattr(items[item_type].get(operation['id']), 'name', None) for _, operation in valid if operation['type'] == item_type and operation['op'] != 'delete'}
+                names.discard(None)
+                if names:
+                    query = db.session.query(model.parent_data_room_id, model.parent_folder_id, model.name).filter(model.name.in_(names))
+                    if model is Folder:
+                        query = query.filter(Folder.deleted_at.is_(None))
+                    for row in query:
+                        occupied.add((item_type, row.parent_data_room_id, row.parent_folder_id, row.name))
+
+            # Folders under a tombstone, including the ones this batch deletes
+            deleted_folder_ids = tombstoned_folder_ids(items['folder'].keys())
+
+            def is_deleted(folder):
+                return folder.id in deleted_folder_ids or any(id in deleted_folder_ids for id in ancestor_ids(folder))
+
+            def is_hidden(item_type, item):
+                if data_rooms[item.parent_data_room_id].deleted_at:
+                    return True
+                if item_type == 'folder':
+                    return is_deleted(item)
+                return item.parent_folder_id is not None and is_deleted(items['folder'][item.parent_folder_id])
+
+            released = []
+            # Files uploaded before the blob store own their bytes outright
+            legacy_paths = []
+            # Totals above every deleted or moved item, written once at the end
+            usage = UsageChanges(current_user_id)
+            # Change log entries, in operation order
+            changes = []
+
+            def place(item_type, item):
+                # The room and the folder ids above item as it sits now, earlier
+                # operations included. Parents of files are always loaded.
+                if item_type == 'folder':
+                    return item.parent_data_room_id, ancestor_ids(item)
+                return item.parent_data_room_id, folder_chain(items['folder'].get(item.parent_folder_id))
+
+            def totals(item_type, item):
+                return (1, item.size) if item_type == 'file' else usage.folder_totals(item)
+
+            # Cached access to forget once the batch is committed
+            changed_data_room_ids, changed_file_ids = set(), set()
+            # Listings to bump: containers whose children changed, and renamed or moved folders
+            changed_parents, changed_folders = set(), []
+            for index, operation in valid:
+                item_type = operation['type']
+                item = items[item_type].get(operation['id'])
+                if item is None or is_hidden(item_type, item):
+                    results[index] = _result(index, 404, f"{item_type.capitalize()} not found")
+                    continue
+                if current_user_id != item.owner_id:
+                    results[index] = _result(index, 401, "Unauthorized")
+                    continue
+
+                slot = (item_type, item.parent_data_room_id, item.parent_folder_id, item.name)
+
+                if operation['op'] == 'delete':
+                    changed_parents.add((item.parent_data_room_id, item.parent_folder_id))
+                    files, size = totals(item_type, item)
+                    usage.add(-files, -size, *place(item_type, item))
+                    changes.append(change(item.parent_data_room_id, item_type, 'delete', item.id))
+                    if item_type == 'file':
+                        released.append(item.content)
+                        if not is_blob_digest(item.content):
+                            legacy_paths.append(stored_file_key(item))
+                        db.session.delete(item)
+                        del items['file'][item.id]
+                        changed_file_ids.add(item.id)
+                    else:
+                        item.deleted_at = datetime.utcnow()
+                        deleted_folder_ids.add(item.id)
+                        changed_data_room_ids.add(item.parent_data_room_id)
+                    # Free the name before a later operation reuses it
+                    db.session.flush()
+                    occupied.discard(slot)
+                    results[index] = _result(index, 200, f"{item_type.capitalize()} deleted")
+                    continue
+
+                # Resolve the destination, renames stay where they are
+                if operation['op'] == 'rename':
+                    data_room_id, parent_folder = item.parent_data_room_id, None
+                    parent_folder_id = item.parent_folder_id
+                else:
+                    data_room = data_rooms.get(operation['parent_data_room_id'])
+                    if not data_room or data_room.deleted_at:
+                        results[index] = _result(index, 404, "Data Room not found")
+                        continue
+                    if current_user_id != data_room.owner_id:
+                        results[index] = _result(index, 401, "Unauthorized")
+                        continue
+                    data_room_id = data_room.id
+
+                    parent_folder = None
+                    parent_folder_id = operation.get('parent_folder_id')
+                    if parent_folder_id:
+                        parent_folder = items['folder'].get(parent_folder_id)
+                        if not parent_folder or is_deleted(parent_folder):
+                            results[index] = _result(index, 404, "Folder not found")
+                            continue
+                        if current_user_id != parent_folder.owner_id:
+                            results[index] = _result(index, 401, "Unauthorized")
+                            continue
+                        if parent_folder.parent_data_room_id != data_room_id:
+                            results[index] = _result(index, 400, "Parent folder is not in the Data Room")
+                            continue
+                        if item_type == 'folder' and is_in_subtree(item, parent_folder):
+                            results[index] = _result(index, 400, "Cannot move a folder into itself")
+                            continue
+                    else:
+                        parent_folder_id = None
+
+                name = operation.get('name') or item.name
+                target = (item_type, data_room_id, parent_folder_id, name)
+                if target != slot and target in occupied:
+                    results[index] = _result(index, 400, f"{item_type.capitalize()} name already exists")
+                    continue
+
+                # Apply the move or rename
+                changes.extend(move_changes(item_type, item.id, name, (item.parent_data_room_id, item.parent_folder_id), (data_room_id, parent_folder_id), getattr(item, 'size', None)))
+                item.name = name
+                changed_parents |= {(item.parent_data_room_id, item.parent_folder_id), (data_room_id, parent_folder_id)}
+                if item_type == 'folder':
+                    changed_folders.append(item)
+                if operation['op'] == 'move' and (parent_folder_id != item.parent_folder_id or data_room_id != item.parent_data_room_id):
+                    files, size = totals(item_type, item)
+                    usage.add(-files, -size, *place(item_type, item))
+                    usage.add(files, size, data_room_id, folder_chain(parent_folder))
+                    if item_type == 'folder':
+                        changed_data_room_ids |= {item.parent_data_room_id, data_room_id}
+                        move_subtree(item, parent_folder, data_room_id)
+                    else:
+                        changed_file_ids.add(item.id)
+                        item.parent_data_room_id = data_room_id
+                        item.parent_folder_id = parent_folder_id
+                # Flush in operation order so the unique name indexes see the
+                # same sequence of names as the occupied set
+                db.session.flush()
+                occupied.discard(slot)
+                occupied.add(target)
+                results[index] = _result(index, 200, f"{item_type.capitalize()} {'moved' if operation['op'] == 'move' else 'renamed'}")
+
+            unreferenced = release_blobs(released)
+            bump_versions(parents=changed_parents, folders=changed_folders)
+            usage.apply()
+            record_changes(changes)
+            db.session.commit()
+            invalidate(data_room_ids=changed_data_room_ids, file_ids=changed_file_ids)
+
+        # Remove the bytes only once no committed File points at them
+        unlink_unreferenced(unreferenced)
+        for path in legacy_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        return jsonify({"results": results}), 200
+    except Exception as e:
+        if is_unique_violation(e):
+            # Another request took one of the names after they were loaded
+            return jsonify({"message": "A name was taken concurrently, retry the batch"}), 409
+        return jsonify({"message": f"Error: {str(e)}"}), 500
@@ -0,0 +1,100 @@
+# api/routes/changes.py
+import json, time
+from flask import Blueprint, jsonify, request, Response, stream_with_context
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from database.models import db
+from database.permissions import resolve
+from database.changes import ChangesExpired, wait_for_changes
+from database.pagination import page_size
+
+'''
+Change feeds of data rooms, see database/changes.py.
+
+A long-poll waits up to MAX_CHANGE_WAIT seconds and an event stream stays
+open for CHANGE_STREAM_SECONDS, which would hold one of the 8 threads of a
+`make serve` worker all along. The feeds are therefore only registered on the
+gevent workers of transfers.py (`make serve_transfers`), where a waiting
+client costs a greenlet. The threaded app answers them with a 404.
+'''
+
+change_routes = Blueprint('changes', __name__)
+
+# Longest ?wait= of a change long-poll, in seconds
+MAX_CHANGE_WAIT = 30
+# Seconds an event stream of changes stays open, clients reconnect with Last-Event-ID
+CHANGE_STREAM_SECONDS = 300
+# Seconds between keep-alive comments on an idle event stream
+CHANGE_STREAM_HEARTBEAT = 15
+
+@change_routes.route('/data-room/<int:data_room_id>/changes', methods=['GET'])
+@jwt_required()
+def get_data_room_changes(data_room_id):
+    '''
+    Entries of the room's change log after ?since= (a seq, 0 for the start),
+    see database/changes.py:
+
+        {"changes": [{"seq": 8, "type": "file", "op": "create", ...}], "cursor": 8, "has_more": false}
+
+    With ?wait=<seconds> the request waits for the first change when there is
+    none yet. With Accept: text/event-stream the changes are pushed as server
+    sent events instead, each batch with its cursor as the event id. A 410
+    means the entries after the cursor are gone and the room must be reloaded.
+    '''
+    current_user_id = get_jwt_identity()
+    since = request.headers.get('Last-Event-ID') or request.args.get('since', '0')
+    if not since.isdigit():
+        return jsonify({"message": "since must be a change cursor"}), 400
+    since = int(since)
+    wait = max(0.0, min(request.args.get('wait', 0, type=float), MAX_CHANGE_WAIT))
+    stream = request.accept_mimetypes.best_match(['application/json', 'text/event-stream']) == 'text/event-stream'
+    limit = page_size()
+
+    try:
+        # Start a transaction
+        with db.session.begin():
+            # A deleted room still serves its log, which ends with the delete
+            [access] = resolve(('data_room', data_room_id))
+            if not access:
+                return jsonify({"message": "Data Room not found"}), 404
+            if current_user_id != access.owner_id:
+                return jsonify({"msg": "Unauthorized"}), 401
+
+        if stream:
+            response = Response(stream_with_context(_stream_changes(data_room_id, since, limit)), mimetype='text/event-stream')
+            response.cache_control.no_store = True
+            # Keep proxies from buffering the events
+            response.headers['X-Accel-Buffering'] = 'no'
+            return response
+
+        # No connection is held while waiting
+        result = wait_for_changes(data_room_id, since, limit, wait)
+        if result is None:
+            return jsonify({"message": "Data Room not found"}), 404
+        changes, cursor, has_more = result
+        return jsonify(changes=changes, cursor=cursor, has_more=has_more)
+    except ChangesExpired:
+        return jsonify({"message": "Changes since this cursor are no longer available, reload the Data Room"}), 410
+    except Exception as e:
+        return jsonify({"message": f"Error: {str(e)}"}), 500
+
+
+def _stream_changes(data_room_id, since, limit):
+    # Server-sent events of the room's changes until CHANGE_STREAM_SECONDS have passed
+    deadline = time.monotonic() + CHANGE_STREAM_SECONDS
+    yield f"retry: {int(CHANGE_STREAM_HEARTBEAT * 1000)}\n\n"
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        try:
+            result = wait_for_changes(data_room_id, since, limit, min(CHANGE_STREAM_HEARTBEAT, remaining))
+        except ChangesExpired:
+            yield "event: expired\ndata: {}\n\n"
+            return
+        if result is None:
+            return
+        changes, since, _ = result
+        if changes:
+            yield f"id: {since}\ndata: {json.dumps(changes)}\n\n"
+        else:
+            yield ": keep-alive\n\n"
@@ -1,38 +1,60 @@
 # api/routes/data_room.py
-import os, shutil
-from flask import Blueprint, jsonify, request, current_app
+import json
+from datetime import datetime
+from flask import Blueprint, jsonify, request, Response, stream_with_context
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from database.models import db, DataRoom
+from sqlalchemy import or_
+from database import is_unique_violation
+from database.models import db, DataRoom, Folder, File
+from database.hierarchy import tree_rows
+from database.permissions import invalidate, resolve
+from database.versions import bump_versions, listing_etag, not_modified, user_data_rooms_etag, with_etag
+from database.usage import UsageChanges
+from database.changes import change, record_changes
+from database.pagination import InvalidCursor, children_page, decode_key_cursor, encode_cursor, first_children_pages, keyset_page, page_size
+from database.engine import read_replica
+from metrics import transfer
+from storage import ARCHIVE_COMPRESSION, archive_disposition, stream_archive
+from search import MAX_TYPEAHEAD_LIMIT, TYPEAHEAD_LIMIT, decode_search_cursor, find_names, search_pages
 
 data_room_routes = Blueprint('data_room', __name__)
 
 @data_room_routes.route('/data-room', methods=['GET'])
 @jwt_required()
+@read_replica
 def get_user_data_rooms():
     current_user_id = get_jwt_identity()
+    cursor = request.args.get('cursor')
+    limit = page_size()
     try:
         # Start a transaction
         with db.session.begin():
-            # Query the database to get all data rooms for the current user
-            user_data_rooms = DataRoom.query.filter_by(owner_id=current_user_id).all()
-            if not user_data_rooms:
-                return jsonify({}), 200
+            # Answer polling clients from the room versions alone
+            etag = user_data_rooms_etag(current_user_id)
+            response = not_modified(etag)
+            if response:
+                return response
 
-            # Return as JSON, no pagination for now
+            # Page through the current user's data rooms
+            after = decode_key_cursor(cursor) if cursor else None
+            user_data_rooms, last = keyset_page(DataRoom.query.filter_by(owner_id=current_user_id, deleted_at=None), DataRoom, after, limit)
+
+            # Each room carries the first page of its top-level children, fetched
+            # for every room on the page at once
+            children_pages = first_children_pages([data_room.id for data_room in user_data_rooms], limit)
             data_rooms = []
             for data_room in user_data_rooms:
-                data_rooms.append({
-                    "id": data_room.id,
-                    "name": data_room.name,
-                    "files": [{"id": file.id, "name": file.name} for file in data_room.children_files if file.parent_folder_id is None],
-                    "folders": [{"id": folder.id, "name": folder.name} for folder in data_room.children_folders if folder.parent_folder_id is None]
-                })
-            return jsonify(user_data_rooms=data_rooms)
+                folders, files, next_cursor = children_pages[data_room.id]
+                data_rooms.append(_data_room_json(data_room, folders, files, next_cursor))
+            return with_etag(jsonify(user_data_rooms=data_rooms, next_cursor=encode_cursor(last) if last else None), etag)
+    except InvalidCursor as e:
+        return jsonify({"message": str(e)}), 400
     except Exception as e:
         return jsonify({"message": f"Error: {str(e)}"}), 500
 
 @data_room_routes.route('/data-room/<int:data_room_id>', methods=['GET'])
 @jwt_required()
+@read_replica
 def get_data_room(data_room_id):
     current_user_id = get_jwt_identity()
     try:
@@ -40,29 +62,143 @@ def get_data_room(data_room_id):
         with db.session.begin():
             data_room = DataRoom.query.get(data_room_id)
 
-            if not data_room:
+            if not data_room or data_room.deleted_at:
                 return jsonify({"message": "Data Room not found"}), 404
 
             if current_user_id != data_room.owner_id:
                 return jsonify({"msg": "Unauthorized"}), 401
+
+            # Answer polling clients from the room row, a 304 carries no children
+            etag = listing_etag('data_room', data_room.id, data_room.version)
+            response = not_modified(etag)
+            if response:
+                return response
             
-            files = data_room.children_files
-            folders = data_room.children_folders
-
-            for file in files:
-                if current_user_id != file.owner_id:
-                    return jsonify({"msg": "Unauthorized"}), 401
-
-            for folder in folders:
-                if current_user_id != folder.owner_id:
-                    return jsonify({"msg": "Unauthorized"}), 401
-
-            return jsonify({
-                "id": data_room.id,
-                "name": data_room.name,
-                "files": [{"id": file.id, "name": file.name} for file in files if file.parent_folder_id is None],
-                "folders": [{"id": folder.id, "name": folder.name} for folder in folders if folder.parent_folder_id is None]
-            })
+            # Every file and folder in the room must belong to the current user
+            if _has_foreign_children(data_room.id, current_user_id):
+                return jsonify({"msg": "Unauthorized"}), 401
+
+            return with_etag(jsonify(_data_room_page(data_room, request.args.get('cursor'), page_size())), etag)
+    except InvalidCursor as e:
+        return jsonify({"message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"message": f"Error: {str(e)}"}), 500
+
+@data_room_routes.route('/data-room/<int:data_room_id>/tree', methods=['GET'])
+@jwt_required()
+@read_replica
+def get_data_room_tree(data_room_id):
+    current_user_id = get_jwt_identity()
+
+    # Optionally limit how many levels below the room are returned
+    max_depth = request.args.get('depth', type=int)
+    if max_depth is not None and max_depth < 1:
+        return jsonify({"message": "depth must be at least 1"}), 400
+
+    try:
+        # Start a transaction
+        with db.session.begin():
+            data_room = DataRoom.query.get(data_room_id)
+
+            if not data_room or data_room.deleted_at:
+                return jsonify({"message": "Data Room not found"}), 404
+
+            if current_user_id != data_room.owner_id:
+                return jsonify({"msg": "Unauthorized"}), 401
+
+            name = data_room.name
+
+        # The whole tree comes from one query and is serialized as rows arrive
+        return Response(stream_with_context(_stream_tree(data_room_id, name, max_depth)), mimetype='application/json')
+    except Exception as e:
+        return jsonify({"message": f"Error: {str(e)}"}), 500
+
+@data_room_routes.route('/data-room/<int:data_room_id>/archive', methods=['GET'])
+@jwt_required()
+@read_replica
+@transfer('download')
+def archive_data_room(data_room_id):
+    current_user_id = get_jwt_identity()
+
+    # Uploads are mostly PDFs, which barely deflate, so entries are stored by default
+    compression = request.args.get('compression', 'stored')
+    if compression not in ARCHIVE_COMPRESSION:
+        return jsonify({"message": f"compression must be one of {', '.join(ARCHIVE_COMPRESSION)}"}), 400
+
+    try:
+        # Start a transaction
+        with db.session.begin():
+            [access] = resolve(('data_room', data_room_id))
+
+            if not access or access.deleted:
+                return jsonify({"message": "Data Room not found"}), 404
+
+            if current_user_id != access.owner_id:
+                return jsonify({"msg": "Unauthorized"}), 401
+
+            name = DataRoom.query.get(data_room_id).name
+
+        # The ZIP is written to the client as it is built, one chunk at a time
+        archive = stream_archive(data_room_id, compression=ARCHIVE_COMPRESSION[compression])
+        return Response(stream_with_context(archive), mimetype='application/zip', headers={"Content-Disposition": archive_disposition(name)})
+    except Exception as e:
+        return jsonify({"message": f"Error: {str(e)}"}), 500
+
+@data_room_routes.route('/data-room/<int:data_room_id>/search', methods=['GET'])
+@jwt_required()
+@read_replica
+def search_data_room(data_room_id):
+    current_user_id = get_jwt_identity()
+
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({"message": "q is required"}), 400
+
+    try:
+        # Start a transaction
+        with db.session.begin():
+            [access] = resolve(('data_room', data_room_id))
+
+            if not access or access.deleted:
+                return jsonify({"message": "Data Room not found"}), 404
+
+            if current_user_id != access.owner_id:
+                return jsonify({"msg": "Unauthorized"}), 401
+
+            # Ranked pages of the room's files, continuing after the cursor's hit
+            cursor = request.args.get('cursor')
+            after = decode_search_cursor(cursor) if cursor else None
+            hits, last = search_pages(data_room_id, current_user_id, q, after, page_size())
+            return jsonify(hits=hits, next_cursor=encode_cursor(last) if last else None)
+    except InvalidCursor as e:
+        return jsonify({"message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"message": f"Error: {str(e)}"}), 500
+
+@data_room_routes.route('/data-room/<int:data_room_id>/typeahead', methods=['GET'])
+@jwt_required()
+@read_replica
+def typeahead_data_room(data_room_id):
+    current_user_id = get_jwt_identity()
+
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify({"message": "q is required"}), 400
+    limit = max(1, min(request.args.get('limit', TYPEAHEAD_LIMIT, type=int), MAX_TYPEAHEAD_LIMIT))
+
+    try:
+        # Start a transaction
+        with db.session.begin():
+            [access] = resolve(('data_room', data_room_id))
+
+            if not access or access.deleted:
+                return jsonify({"message": "Data Room not found"}), 404
+
+            if current_user_id != access.owner_id:
+                return jsonify({"msg": "Unauthorized"}), 401
+
+            # Files and folders by name, each with its folder path
+            return jsonify(matches=find_names(data_room_id, current_user_id, q, limit))
     except Exception as e:
         return jsonify({"message": f"Error: {str(e)}"}), 500
 
@@ -83,17 +219,17 @@ def create_data_room():
     try:
         # Start a transaction
         with db.session.begin():
-            # Check if the data room already exists
-            existing_data_room = DataRoom.query.filter_by(name=name, owner_id=current_user_id).first()
-            if existing_data_room:
-                return jsonify({"message": "Data Room already exists"}), 400
-
+            # uq_data_room_name rejects a second live room with the same name
             new_data_room = DataRoom(name=name, owner_id=current_user_id)
             db.session.add(new_data_room)
+            db.session.flush()
+            record_changes([change(new_data_room.id, 'data_room', 'create', new_data_room.id, name)])
             db.session.commit()
 
             return jsonify({"message": "Data Room created successfully"}), 201
     except Exception as e:
+        if is_unique_violation(e):
+            return jsonify({"message": "Data Room already exists"}), 400
         return jsonify({"message": f"Error: {str(e)}"}), 500
 
 @data_room_routes.route('/data-room/<int:data_room_id>', methods=['PUT'])
@@ -109,7 +245,7 @@ def rename_data_room(data_room_id):
         with db.session.begin():
             data_room = DataRoom.query.get(data_room_id)
 
-            if not data_room:
+            if not data_room or data_room.deleted_at:
                 return jsonify({"message": "Data Room not found"}), 404
 
             if current_user_id != data_room.owner_id:
@@ -119,27 +255,20 @@ def rename_data_room(data_room_id):
             if not new_name:
                 return jsonify({"message": "New name is required"}), 400
 
-            data_room.name = new_name
-            db.session.commit()
-        
-        files = data_room.children_files
-        folders = data_room.children_folders
-
-        for file in files:
-            if current_user_id != file.owner_id:
+            # Every file and folder in the room must belong to the current user
+            if _has_foreign_children(data_room.id, current_user_id):
                 return jsonify({"msg": "Unauthorized"}), 401
 
-        for folder in folders:
-            if current_user_id != folder.owner_id:
-                return jsonify({"msg": "Unauthorized"}), 401
+            data_room.name = new_name
+            bump_versions(parents=[(data_room.id, None)])
+            record_changes([change(data_room.id, 'data_room', 'rename', data_room.id, new_name)])
+            page = _data_room_page(data_room, None, page_size())
+            db.session.commit()
 
-        return jsonify({
-            "id": data_room.id,
-            "name": data_room.name,
-            "files": [{"id": file.id, "name": file.name} for file in files if file.parent_folder_id is None],
-            "folders": [{"id": folder.id, "name": folder.name} for folder in folders if folder.parent_folder_id is None]
-        })
+        return jsonify(page)
     except Exception as e:
+        if is_unique_violation(e):
+            return jsonify({"message": "Data Room already exists"}), 400
         return jsonify({"message": f"Error: {str(e)}"}), 500
 
 
@@ -150,27 +279,101 @@ def delete_data_room(data_room_id):
     try:
         # Start a transaction
         with db.session.begin():
-            data_room = DataRoom.query.get(data_room_id)
+            # Locked, so a delete racing on another worker waits and then finds the tombstone
+            data_room = DataRoom.query.filter_by(id=data_room_id).with_for_update().first()
 
-            if not data_room:
+            if not data_room or data_room.deleted_at:
                 return jsonify({"message": "Data Room not found"}), 404
 
             if current_user_id != data_room.owner_id:
                 return jsonify({"msg": "Unauthorized"}), 401
 
-            # Delete the entire data room directory from the storage
-            data_room_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'user-' + str(current_user_id), 'data-room-' + str(data_room.id))
-            if os.path.exists(data_room_path):
-                shutil.rmtree(data_room_path)
-
-            print('delete data room path', data_room_path)
-            # Delete the data room and let SQLAlchemy handle cascading deletes
-            db.session.delete(data_room)
-
-            # Commit changes to the database
+            # Tombstone the room, purge.py removes its contents and blobs later
+            data_room.deleted_at = datetime.utcnow()
+            usage = UsageChanges(current_user_id)
+            usage.add(-data_room.file_count, -data_room.total_bytes)
+            usage.apply()
+            record_changes([change(data_room.id, 'data_room', 'delete', data_room.id)])
             db.session.commit()
+            invalidate(data_room_ids=[data_room_id])
 
-            return jsonify({"message": "Data Room deleted successfully"}), 200
+        return jsonify({"message": "Data Room deleted successfully"}), 200
     except Exception as e:
         return jsonify({"message": f"Error: {str(e)}"}), 500
 
+
+def _data_room_page(data_room, cursor, limit):
+    # Top-level children only, the folder filter runs in SQL
+    folder_query = Folder.query.filter_by(parent_data_room_id=data_room.id, parent_folder_id=None, deleted_at=None)
+    file_query = File.query.filter_by(parent_data_room_id=data_room.id, parent_folder_id=None)
+    folders, files, next_cursor = children_page(folder_query, file_query, cursor, limit)
+    return _data_room_json(data_room, folders, files, next_cursor)
+
+
+def _data_room_json(data_room, folders, files, next_cursor):
+    return {
+        "id": data_room.id,
+        "name": data_room.name,
+        "file_count": data_room.file_count,
+        "total_bytes": data_room.total_bytes,
+        # Follow the room from here with GET /data-room/<id>/changes?since=
+        "change_cursor": data_room.change_seq,
+        "files": [{"id": file.id, "name": file.name, "size": file.size} for file in files],
+        "folders": [{"id": folder.id, "name": folder.name, "file_count": folder.file_count, "total_bytes": folder.total_bytes} for folder in folders],
+        "next_cursor": next_cursor
+    }
+
+
+def _has_foreign_children(data_room_id, owner_id):
+    # One query with an EXISTS per table instead of loading every child
+    foreign_folders = db.session.query(Folder.id).filter(Folder.parent_data_room_id == data_room_id, Folder.owner_id != owner_id).exists()
+    foreign_files = db.session.query(File.id).filter(File.parent_data_room_id == data_room_id, File.owner_id != owner_id).exists()
+    return db.session.query(or_(foreign_folders, foreign_files)).scalar()
+
+
+def _stream_tree(data_room_id, name, max_depth, flush_size=64 * 1024):
+    '''
+    Serialize a data room as nested JSON straight from the depth-first rows of
+    tree_rows, without building the tree in memory:
+
+        {"id": 1, "name": "...", "files": [...], "folders": [{"id": 3, "name": "...", "files": [...], "folders": [...]}]}
+
+    Folders at the depth limit are emitted without "files" and "folders".
+    '''
+    chunks = [json.dumps({"id": data_room_id, "name": name})[:-1], ',"files":[']
+    size = 0
+
+    # Open containers, innermost last: [path, in_folders_section, is_empty]
+    stack = [['/', False, True]]
+
+    def close(frame):
+        return '],"folders":[]}' if not frame[1] else ']}'
+
+    for row in tree_rows(data_room_id, max_depth):
+        while stack[-1][0] != row.parent_path:
+            chunks.append(close(stack.pop()))
+
+        frame = stack[-1]
+        item = json.dumps({"id": row.id, "name": row.name})
+        if row.kind == 'file':
+            chunks.append(item if frame[2] else ',' + item)
+            frame[2] = False
+        else:
+            if not frame[1]:
+                chunks.append('],"folders":[')
+                frame[1], frame[2] = True, True
+            if max_depth is not None and row.depth + 1 >= max_depth:
+                chunks.append(item if frame[2] else ',' + item)
+            else:
+                chunks.append((item if frame[2] else ',' + item)[:-1] + ',"files":[')
+                stack.append([row.path, False, True])
+            frame[2] = False
+
+        size += len(chunks[-1])
+        if size >= flush_size:
+            yield ''.join(chunks)
+            chunks, size = [], 0
+
+    while stack:
+        chunks.append(close(stack.pop()))
+    yield ''.join(chunks)
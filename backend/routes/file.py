@@ -1,43 +1,160 @@
 # api/routes/file.py
-import os
-from flask import Blueprint, jsonify, request, current_app, send_file
+import os, zipfile
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from flask import Blueprint, jsonify, redirect, request, send_file, Response, current_app
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.http import is_resource_modified
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from database.models import db, File, Folder, DataRoom
+from database import is_unique_violation
+from database.models import db, File
+from database.hierarchy import is_tombstoned
+from database.permissions import invalidate, resolve
+from database.versions import bump_versions
+from database.usage import QuotaExceeded, UsageChanges, folder_chains, has_quota
+from database.changes import change, move_changes, record_changes
+from database.engine import read_replica
+from metrics import transfer
+from previews import PREVIEW_SIZES, preview, render_previews
+from search import extract_text
+from storage import is_blob_digest, stored_file_key, open_stored_file, download_url, store_blob, acquire_blob, acquire_blobs, release_blobs, unlink_unreferenced
 
 file_routes = Blueprint('file', __name__)
 
+# Bulk uploads write at most this many blobs concurrently per request
+BULK_UPLOAD_WORKERS = 4
+MAX_BULK_FILES = 1000
+# Uncompressed bytes a bulk upload archive may expand to, as declared by its members
+MAX_ARCHIVE_SIZE = 4 * 1024 ** 3
+# Seconds browsers reuse a preview without revalidating, previews of a file never change
+PREVIEW_MAX_AGE = 86400
+
 @file_routes.route('/file/<int:file_id>', methods=['GET'])
 @jwt_required()
+@read_replica
+@transfer('download')
 def view_file(file_id):
     current_user_id = get_jwt_identity()
     try:
         # Start a transaction
         with db.session.begin():
-            file = File.query.get(file_id)
+            [access] = resolve(('file', file_id))
 
             # Ensure that the file exists and belongs to the current user
-            if not file:
+            if not access:
                 return jsonify({"message": "File not found"}), 404
 
-            if current_user_id != file.owner_id:
+            if current_user_id != access.owner_id:
                 return jsonify({"msg": "Unauthorized"}), 401
+
+            # Files inside a deleted folder or room are gone until they are purged
+            file = File.query.get(file_id) if not access.deleted else None
+            if not file:
+                return jsonify({"message": "File not found"}), 404
             
-            # Fetch the file path from the database
-            user_upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'user-' + str(current_user_id), 'data-room-' + str(file.parent_data_room_id), 'folder-' + str(file.parent_folder_id))
-            file_path = os.path.join(user_upload_folder, file.content)
-
-            # Check if the file exists
-            if os.path.exists(file_path):
-                # Send the file as a response
-                return send_file(file_path, as_attachment=True)
-            else:
+            # Blob contents never change, so the digest is a strong validator and
+            # the creation time is the last modification
+            etag = file.content if is_blob_digest(file.content) else True
+            last_modified = file.created_at
+            download_name = file.name
+            key = stored_file_key(file)
+
+        # Answer revalidations before touching the disk
+        if etag is not True and not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+
+        # Send clients straight to the object store when it can serve the file
+        url = download_url(key, download_name) if etag is not True else None
+        if url:
+            response = redirect(url)
+            response.cache_control.private = True
+            response.cache_control.no_store = True
+            return response
+
+        # Check if the file exists
+        try:
+            stream, size = open_stored_file(key)
+        except FileNotFoundError:
+            return jsonify({"message": "File not found"}), 404
+
+        # Send the plaintext as a response, honouring Range and If-Range headers.
+        # Encrypted blobs are decrypted as they are read, a range only decrypts
+        # the chunks it covers.
+        try:
+            response = send_file(stream, as_attachment=True, download_name=download_name, etag=etag, last_modified=last_modified)
+            response.content_length = size
+            response = response.make_conditional(request.environ, accept_ranges=True, complete_length=size)
+        except RequestedRangeNotSatisfiable:
+            stream.close()
+            return jsonify({"message": "Requested range not satisfiable"}), 416, {"Content-Range": f"bytes */{size}"}
+        response.cache_control.private = True
+        # Advertise range support up front so PDF viewers can fetch pages lazily
+        response.accept_ranges = 'bytes'
+        return response
+
+    except Exception as e:
+        return jsonify({"message": f"Error: {str(e)}"}), 500
+
+@file_routes.route('/file/<int:file_id>/preview', methods=['GET'])
+@jwt_required()
+@read_replica
+def preview_file(file_id):
+    '''
+    A JPEG of one page of a file, ?size=thumbnail (default) or page and
+    ?page=N (default 1). Previews are rendered once per content and served
+    from the preview cache, so listings can show them without downloading files.
+    '''
+    current_user_id = get_jwt_identity()
+    size = request.args.get('size', 'thumbnail')
+    page = request.args.get('page', 1, type=int)
+    if size not in PREVIEW_SIZES:
+        return jsonify({"message": f"size must be one of {', '.join(PREVIEW_SIZES)}"}), 400
+    if page < 1:
+        return jsonify({"message": "page must be a positive integer"}), 400
+
+    try:
+        with db.session.begin():
+            [access] = resolve(('file', file_id))
+            if not access:
+                return jsonify({"message": "File not found"}), 404
+            if current_user_id != access.owner_id:
+                return jsonify({"msg": "Unauthorized"}), 401
+
+            file = File.query.get(file_id) if not access.deleted else None
+            if not file:
                 return jsonify({"message": "File not found"}), 404
+            digest = file.content
+
+        # Files stored before the blob store have no content hash to key previews by
+        if not is_blob_digest(digest):
+            return jsonify({"message": "No preview available"}), 404
+
+        # A preview never changes for the same content, size and page
+        etag = f"{digest}-{size}-{page}"
+        if not is_resource_modified(request.environ, etag=etag):
+            response = Response(status=304)
+        else:
+            try:
+                data = preview(digest, size, page)
+            except TimeoutError:
+                return jsonify({"message": "Preview is still rendering"}), 503, {"Retry-After": "5"}
+            if not data:
+                return jsonify({"message": "No preview available"}), 404
+            response = Response(data, mimetype='image/jpeg')
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.max_age = PREVIEW_MAX_AGE
+        return response
 
     except Exception as e:
         return jsonify({"message": f"Error: {str(e)}"}), 500
-     
+
 @file_routes.route('/file', methods=['POST'])
 @jwt_required()
+@transfer('upload')
 def create_file():
     current_user_id = get_jwt_identity()
     data = request.form
@@ -54,51 +171,231 @@ def create_file():
     if not parent_data_room_id:
         return jsonify({"message": "parent_data_room_id is required"}), 400
     
+    digest = None
     try:
         # Start a transaction
         with db.session.begin():
             # Ensure the parent data room exists and belongs to the current user
-            data_room = DataRoom.query.get(parent_data_room_id)
-            if not data_room:
+            data_room, parent_folder = resolve(('data_room', parent_data_room_id), ('folder', parent_folder_id))
+            if not data_room or data_room.deleted:
                 return jsonify({"message": "Data Room not found"}), 404
             if current_user_id != data_room.owner_id:
                 return jsonify({"msg": "Unauthorized"}), 401
             
             # Ensure that if parent folder exists, it belongs to the current user
             if parent_folder_id:
-                parent_folder = Folder.query.get(parent_folder_id)
-                if not parent_folder:
+                if not parent_folder or parent_folder.deleted:
                     return jsonify({"message": "Folder not found"}), 404
                 if current_user_id != parent_folder.owner_id:
                     return jsonify({"msg": "Unauthorized"}), 401
-                
-            # Ensure that the file name is unique within the parent folder
-            existing_file = File.query.filter_by(name=name, parent_data_room_id=parent_data_room_id, parent_folder_id=parent_folder_id).first()
-            if existing_file:
-                return jsonify({"message": "File already exists"}), 400
-                
+
+            # The cached access may not have seen a delete made by another worker
+            if is_tombstoned(data_room.id, parent_folder.id if parent_folder_id else None):
+                return jsonify({"message": "Folder not found" if parent_folder_id else "Data Room not found"}), 404
+
             # Handle file upload
             uploaded_file = request.files['files']
             if uploaded_file:
                 if not uploaded_file:
                     return jsonify({"message": "No file provided"}), 400
 
-                # New addition: Create user-specific subdirectory
-                user_upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'user-' + str(current_user_id), 'data-room-' + str(parent_data_room_id), 'folder-' + str(parent_folder_id))
-                os.makedirs(user_upload_folder, exist_ok=True)  # Ensure the user's folder exists
+                # Store the bytes once per distinct content, duplicates only add a reference
+                digest, size = store_blob(uploaded_file.stream)
+
+                def restore(digest):
+                    uploaded_file.stream.seek(0)
+                    store_blob(uploaded_file.stream)
 
-                file_path = os.path.join(user_upload_folder, uploaded_file.filename)
-                uploaded_file.save(file_path)
+                new_blob = acquire_blob(digest, size, restore)
 
-                # Save the file path in the database
-                new_file = File(name=name, content=file_path, owner_id=current_user_id, parent_data_room_id=parent_data_room_id, parent_folder_id=parent_folder_id)
+                # Save the content digest in the database, uq_file_name rejects a
+                # duplicate sibling name
+                new_file = File(name=name, content=digest, size=size, owner_id=current_user_id, parent_data_room_id=data_room.id, parent_folder_id=parent_folder.id if parent_folder_id else None)
                 db.session.add(new_file)
+                bump_versions(parents=[(new_file.parent_data_room_id, new_file.parent_folder_id)])
+
+                # Count the bytes against the user's quota and every total above the file
+                usage = UsageChanges(current_user_id)
+                usage.add(1, size, data_room.id, folder_chains([new_file.parent_folder_id]).get(new_file.parent_folder_id, []))
+                usage.apply(check_quota=True)
+                db.session.flush()
+                record_changes([change(data_room.id, 'file', 'create', new_file.id, name, new_file.parent_folder_id, size)])
                 db.session.commit()
 
+                # Index and render content seen for the first time
+                if new_blob:
+                    extract_text([digest])
+                    render_previews([digest])
+
             return jsonify({"msg": "File created successfully"})
+    except QuotaExceeded as e:
+        unlink_unreferenced([digest])
+        return jsonify({"message": str(e)}), 507
     except Exception as e:
+        if is_unique_violation(e):
+            # Drop the bytes if nothing else references them
+            unlink_unreferenced([digest])
+            return jsonify({"message": "File already exists"}), 400
         return jsonify({"message": f"Error: {str(e)}"}), 500
 
+@file_routes.route('/file/bulk', methods=['POST'])
+@jwt_required()
+@transfer('upload')
+def create_files():
+    '''
+    Upload many files into one data room or folder in a single request, either
+    as repeated "files" parts or as a zip "archive" part (flattened into the
+    target folder). Each file is named after its filename, blobs are written on
+    a bounded thread pool, and all File rows are inserted in one bulk insert.
+    '''
+    current_user_id = get_jwt_identity()
+    data = request.form
+
+    # Determine where to create the files
+    parent_data_room_id = data.get('parent_data_room_id')
+    parent_folder_id = data.get('parent_folder_id') or None
+    if not parent_data_room_id:
+        return jsonify({"message": "parent_data_room_id is required"}), 400
+
+    archive = None
+    uploads = [(uploaded_file.filename, uploaded_file.stream) for uploaded_file in request.files.getlist('files') if uploaded_file.filename]
+    if 'archive' in request.files:
+        try:
+            archive = zipfile.ZipFile(request.files['archive'].stream)
+        except zipfile.BadZipFile:
+            return jsonify({"message": "archive is not a valid zip file"}), 400
+        for member in archive.infolist():
+            name = os.path.basename(member.filename)
+            if member.is_dir() or not name or member.filename.startswith('__MACOSX/'):
+                continue
+            uploads.append((name, member))
+        # Checked before anything is extracted, a small archive can expand to fill the disk
+        if sum(member.file_size for _, member in uploads if isinstance(member, zipfile.ZipInfo)) > MAX_ARCHIVE_SIZE:
+            return jsonify({"message": f"archive expands to more than {MAX_ARCHIVE_SIZE} bytes"}), 413
+
+    if not uploads:
+        return jsonify({"message": "No file provided"}), 400
+    if len(uploads) > MAX_BULK_FILES:
+        return jsonify({"message": f"At most {MAX_BULK_FILES} files per request"}), 400
+
+    stored = []
+    try:
+        # Start a transaction
+        with db.session.begin():
+            # Ensure the parent data room exists and belongs to the current user
+            data_room, parent_folder = resolve(('data_room', parent_data_room_id), ('folder', parent_folder_id))
+            if not data_room or data_room.deleted:
+                return jsonify({"message": "Data Room not found"}), 404
+            if current_user_id != data_room.owner_id:
+                return jsonify({"msg": "Unauthorized"}), 401
+
+            # Ensure that if parent folder exists, it belongs to the current user
+            if parent_folder_id:
+                if not parent_folder or parent_folder.deleted:
+                    return jsonify({"message": "Folder not found"}), 404
+                if current_user_id != parent_folder.owner_id:
+                    return jsonify({"msg": "Unauthorized"}), 401
+                parent_folder_id = parent_folder.id
+
+            # The cached access may not have seen a delete made by another worker
+            if is_tombstoned(data_room.id, parent_folder_id):
+                return jsonify({"message": "Folder not found" if parent_folder_id else "Data Room not found"}), 404
+
+            # Check every name against the target folder in one query
+            names = {name for name, _ in uploads}
+            taken = {name for (name,) in db.session.query(File.name).filter(File.name.in_(names), File.parent_data_room_id == data_room.id, File.parent_folder_id == parent_folder_id)}
+
+            results = []
+            accepted = []
+            for name, source in uploads:
+                if name in taken:
+                    results.append({"name": name, "status": 400, "message": "File already exists"})
+                else:
+                    taken.add(name)
+                    results.append({"name": name, "status": 201, "message": "File created"})
+                    accepted.append((name, source))
+
+            # Archive members must fit in the quota before they are extracted
+            extracted = sum(source.file_size for _, source in accepted if isinstance(source, zipfile.ZipInfo))
+            if extracted and not has_quota(current_user_id, extracted):
+                return jsonify({"message": "Storage quota exceeded"}), 507
+
+            # Write the blobs concurrently, outside of any per-file transaction
+            app = current_app._get_current_object()
+
+            def store(source):
+                with app.app_context():
+                    if isinstance(source, zipfile.ZipInfo):
+                        with archive.open(source) as member:
+                            return store_blob(_DeclaredSize(member, source.file_size))
+                    return store_blob(source)
+
+            with ThreadPoolExecutor(max_workers=BULK_UPLOAD_WORKERS) as executor:
+                stored = list(executor.map(store, [source for _, source in accepted]))
+
+            # Reference the blobs and insert every File row in bulk
+            blobs, sources = {}, {}
+            for (_, source), (digest, size) in zip(accepted, stored):
+                blobs[digest] = (size, blobs.get(digest, (size, 0))[1] + 1)
+                sources.setdefault(digest, source)
+
+            def restore(digest):
+                source = sources[digest]
+                if not isinstance(source, zipfile.ZipInfo):
+                    source.seek(0)
+                store(source)
+
+            new_digests = acquire_blobs(blobs, restore)
+
+            db.session.bulk_insert_mappings(File, [
+                {"name": name, "content": digest, "size": size, "owner_id": current_user_id, "parent_data_room_id": data_room.id, "parent_folder_id": parent_folder_id}
+                for (name, _), (digest, size) in zip(accepted, stored)
+            ])
+            if accepted:
+                bump_versions(parents=[(data_room.id, parent_folder_id)])
+
+                # The whole upload fits in the quota or none of it is kept
+                usage = UsageChanges(current_user_id)
+                usage.add(len(stored), sum(size for _, size in stored), data_room.id, folder_chains([parent_folder_id]).get(parent_folder_id, []))
+                usage.apply(check_quota=True)
+
+                # The bulk insert returns no ids, read them back by name
+                sizes = {name: size for (name, _), (_, size) in zip(accepted, stored)}
+                created = db.session.query(File.id, File.name).filter(File.name.in_(sizes), File.parent_data_room_id == data_room.id, File.parent_folder_id == parent_folder_id).order_by(File.id)
+                record_changes([change(data_room.id, 'file', 'create', id, name, parent_folder_id, sizes[name]) for id, name in created])
+            db.session.commit()
+            extract_text(new_digests)
+            render_previews(new_digests)
+
+            return jsonify({"results": results}), 201
+    except QuotaExceeded as e:
+        unlink_unreferenced([digest for digest, _ in stored])
+        return jsonify({"message": str(e)}), 507
+    except zipfile.BadZipFile as e:
+        return jsonify({"message": f"archive is not a valid zip file: {str(e)}"}), 400
+    except Exception as e:
+        if is_unique_violation(e):
+            # A name was taken after the check above, nothing was created
+            unlink_unreferenced([digest for digest, _ in stored])
+            return jsonify({"message": "File already exists, retry the upload"}), 409
+        return jsonify({"message": f"Error: {str(e)}"}), 500
+
+class _DeclaredSize:
+    # A zip member that fails once it yields more bytes than its header declared
+    def __init__(self, member, size):
+        self._member = member
+        self._left = size
+
+    def read(self, size=-1):
+        data = self._member.read(size)
+        self._left -= len(data)
+        if self._left < 0:
+            raise zipfile.BadZipFile("member is larger than declared")
+        return data
+
+    def seekable(self):
+        return False
+
 @file_routes.route('/file/<int:file_id>', methods=['PUT'])
 @jwt_required()
 def move_file(file_id):
@@ -121,42 +418,61 @@ def move_file(file_id):
         # Start a transaction
         with db.session.begin():
             # Ensure that the file exists and belongs to the current user
-            print(file_id, parent_data_room_id, parent_folder_id)
-
-            file = File.query.get(file_id)
-            if not file:
+            access, data_room, parent_folder = resolve(('file', file_id), ('data_room', parent_data_room_id), ('folder', parent_folder_id))
+            if not access or access.deleted:
                 return jsonify({"message": "File not found"}), 404
-            if current_user_id != file.owner_id:
+            if current_user_id != access.owner_id:
                 return jsonify({"msg": "Unauthorized"}), 401
 
             # Ensure the parent data room exists and belongs to the current user
             # Out of the box support for moving files between data rooms, add if there's time
-            data_room = DataRoom.query.get(parent_data_room_id)
-            if not data_room:
+            if not data_room or data_room.deleted:
                 return jsonify({"message": "Data Room not found"}), 404
             if current_user_id != data_room.owner_id:
                 return jsonify({"msg": "Unauthorized"}), 401
             
             # Ensure that if parent folder exists, it belongs to the current user
             if parent_folder_id:
-                parent_folder = Folder.query.get(parent_folder_id)
-                if not parent_folder:
+                if not parent_folder or parent_folder.deleted:
                     return jsonify({"message": "Folder not found"}), 404
                 if current_user_id != parent_folder.owner_id:
                     return jsonify({"msg": "Unauthorized"}), 401
-            
-            # Ensure that the file doesn't already exist within the target folder
-            existing_file = File.query.filter_by(name=name, parent_data_room_id=parent_data_room_id, parent_folder_id=parent_folder_id).first()
-            if existing_file:
-                return jsonify({"message": "File name already exists"}), 400
-
-            # Move the file
-            file.name = name
-            file.parent_data_room_id = parent_data_room_id
-            file.parent_folder_id = parent_folder_id
+
+            # The old place comes from the row, a cached access may predate a move
+            # made by another worker. Locking it keeps concurrent moves in order.
+            file = db.session.query(File.parent_data_room_id, File.parent_folder_id, File.size).filter_by(id=file_id).with_for_update().first()
+            if not file or is_tombstoned(file.parent_data_room_id, file.parent_folder_id):
+                return jsonify({"message": "File not found"}), 404
+            if is_tombstoned(data_room.id, parent_folder.id if parent_folder_id else None):
+                return jsonify({"message": "Folder not found" if parent_folder_id else "Data Room not found"}), 404
+            old_place = (file.parent_data_room_id, file.parent_folder_id)
+
+            # Move the file, uq_file_name rejects a duplicate sibling name
+            new_folder_id = parent_folder.id if parent_folder_id else None
+            moved = File.query.filter_by(id=file_id).update({
+                File.name: name,
+                File.parent_data_room_id: data_room.id,
+                File.parent_folder_id: new_folder_id,
+            }, synchronize_session=False)
+            if not moved:
+                return jsonify({"message": "File not found"}), 404
+            bump_versions(parents=[old_place, (data_room.id, new_folder_id)])
+
+            # Carry the file's bytes from the totals above its old place to the new one
+            if old_place != (data_room.id, new_folder_id):
+                chains = folder_chains([file.parent_folder_id, new_folder_id])
+                usage = UsageChanges(current_user_id)
+                usage.add(-1, -file.size, file.parent_data_room_id, chains.get(file.parent_folder_id, []))
+                usage.add(1, file.size, data_room.id, chains.get(new_folder_id, []))
+                usage.apply()
+            record_changes(move_changes('file', file_id, name, old_place, (data_room.id, new_folder_id), file.size))
             db.session.commit()
+
+            invalidate(file_ids=[file_id])
             return jsonify({"msg": "File renamed successfully"})
     except Exception as e:
+        if is_unique_violation(e):
+            return jsonify({"message": "File name already exists"}), 400
         return jsonify({"message": f"Error: {str(e)}"}), 500
 
 @file_routes.route('/file/<int:file_id>', methods=['DELETE'])
@@ -166,23 +482,41 @@ def delete_file(file_id):
 
     try:
         with db.session.begin():
-            file = File.query.get(file_id)
-            if not file:
+            [access] = resolve(('file', file_id))
+            if not access:
                 return jsonify({"message": "File not found"}), 404
 
-            if current_user_id != file.owner_id:
+            if current_user_id != access.owner_id:
                 return jsonify({"msg": "Unauthorized"}), 401
 
-            # Delete the file from storage
-            file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'user-' + str(current_user_id), 'data-room-' + str(file.parent_data_room_id), 'folder-' + str(file.parent_folder_id), file.content)
-            print(file_path)
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            # Files inside a deleted folder or room are gone until they are purged.
+            # Checked on the locked row, the cached access may not have seen a
+            # delete made by another worker.
+            file = File.query.filter_by(id=file_id).with_for_update().first() if not access.deleted else None
+            if not file or is_tombstoned(file.parent_data_room_id, file.parent_folder_id):
+                return jsonify({"message": "File not found"}), 404
+
+            # Files uploaded before the blob store own their bytes outright
+            if not is_blob_digest(file.content):
+                file_path = stored_file_key(file)
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+
+            # Drop the file's reference on its blob
+            unreferenced = release_blobs([file.content])
 
             # Delete the file from the database
             db.session.delete(file)
+            bump_versions(parents=[(file.parent_data_room_id, file.parent_folder_id)])
+            usage = UsageChanges(current_user_id)
+            usage.add(-1, -file.size, file.parent_data_room_id, folder_chains([file.parent_folder_id]).get(file.parent_folder_id, []))
+            usage.apply()
+            record_changes([change(file.parent_data_room_id, 'file', 'delete', file_id)])
             db.session.commit()
+            invalidate(file_ids=[file_id])
 
-            return jsonify({"msg": "File deleted successfully"})
+        # Remove the bytes only once no committed File points at them
+        unlink_unreferenced(unreferenced)
+        return jsonify({"msg": "File deleted successfully"})
     except Exception as e:
         return jsonify({"message": f"Error: {str(e)}"}), 500
\ No newline at end of file
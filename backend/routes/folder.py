@@ -1,13 +1,27 @@
 # api/routes/folder.py
-import os, shutil
-from flask import Blueprint, jsonify, request, current_app
+import logging
+from datetime import datetime
+from flask import Blueprint, jsonify, request, Response, stream_with_context
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from database.models import db, Folder, DataRoom, File
+from database import is_unique_violation
+from database.models import db, Folder, File
+from database.pagination import InvalidCursor, children_page, page_size
+from database.hierarchy import ancestor_ids, breadcrumbs, folder_path, is_in_subtree, is_tombstoned, move_subtree, place_folder
+from database.permissions import invalidate, resolve
+from database.versions import bump_versions, listing_etag, not_modified, with_etag
+from database.usage import UsageChanges, folder_chain
+from database.changes import change, move_changes, record_changes
+from database.engine import read_replica
+from metrics import transfer
+from storage import ARCHIVE_COMPRESSION, archive_disposition, stream_archive
 
 folder_routes = Blueprint('folder', __name__)
 
+log = logging.getLogger(__name__)
+
 @folder_routes.route('/folder/<int:folder_id>', methods=['GET'])
 @jwt_required()
+@read_replica
 def view_folder(folder_id):
     current_user_id = get_jwt_identity()
 
@@ -15,24 +29,64 @@ def view_folder(folder_id):
         # Start a transaction
         with db.session.begin():
 
-            # Retrieve the folder from the database
-            folder = Folder.query.get(folder_id)
+            # Ensure that the folder exists and belongs to the current user
+            [access] = resolve(('folder', folder_id))
+
+            if not access:
+                return jsonify({"message": "Folder not found"}), 404
+
+            if current_user_id != access.owner_id:
+                return jsonify({"msg": "Unauthorized"}), 401
 
+            # Deleted folders stay in place until they are purged
+            if access.deleted:
+                return jsonify({"message": "Folder not found"}), 404
+
+            folder = Folder.query.get(folder_id)
             if not folder:
                 return jsonify({"message": "Folder not found"}), 404
 
-            if current_user_id != folder.owner_id:
+            # Answer polling clients from the folder row alone
+            etag = listing_etag('folder', folder.id, folder.version)
+            response = not_modified(etag)
+            if response:
+                return response
+
+            # Return folder details with a page of its children
+            return with_etag(jsonify(_folder_page(folder, request.args.get('cursor'), page_size())), etag)
+    except InvalidCursor as e:
+        return jsonify({"message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"message": f"Error: {str(e)}"}), 500
+
+@folder_routes.route('/folder/<int:folder_id>/archive', methods=['GET'])
+@jwt_required()
+@read_replica
+@transfer('download')
+def archive_folder(folder_id):
+    current_user_id = get_jwt_identity()
+
+    compression = request.args.get('compression', 'stored')
+    if compression not in ARCHIVE_COMPRESSION:
+        return jsonify({"message": f"compression must be one of {', '.join(ARCHIVE_COMPRESSION)}"}), 400
+
+    try:
+        # Start a transaction
+        with db.session.begin():
+            [access] = resolve(('folder', folder_id))
+
+            if not access or access.deleted:
+                return jsonify({"message": "Folder not found"}), 404
+
+            if current_user_id != access.owner_id:
                 return jsonify({"msg": "Unauthorized"}), 401
-            # Return folder details
-            return jsonify({
-                "id": folder.id,
-                "name": folder.name,
-                "parent_data_room_id": folder.parent_data_room_id,
-                "parent_folder_id": folder.parent_folder_id,
-                "owner_id": folder.owner_id,
-                "children_folders": [{"id": folder.id, "name": folder.name} for folder in folder.children_folders],
-                "children_files": [{"id": file.id, "name": file.name} for file in folder.children_files],
-            }), 200
+
+            folder = Folder.query.get(folder_id)
+            name, subtree_path = folder.name, folder_path(folder)
+
+        # The ZIP is written to the client as it is built, one chunk at a time
+        archive = stream_archive(access.data_room_id, folder_id, subtree_path, ARCHIVE_COMPRESSION[compression])
+        return Response(stream_with_context(archive), mimetype='application/zip', headers={"Content-Disposition": archive_disposition(name)})
     except Exception as e:
         return jsonify({"message": f"Error: {str(e)}"}), 500
 
@@ -56,32 +110,44 @@ def create_folder():
         with db.session.begin():
 
             # Ensure the parent data room exists and belongs to the current user
-            data_room = DataRoom.query.get(parent_data_room_id)
-            if not data_room:
+            data_room, parent_access = resolve(('data_room', parent_data_room_id), ('folder', parent_folder_id))
+            if not data_room or data_room.deleted:
                 return jsonify({"message": "Data Room not found"}), 404
             if current_user_id != data_room.owner_id:
                 return jsonify({"msg": "Unauthorized"}), 401
             
             # Ensure that if parent folder exists, it belongs to the current user
+            parent_folder = None
             if parent_folder_id:
-                parent_folder = Folder.query.get(parent_folder_id)
-                if not parent_folder:
+                if not parent_access or parent_access.deleted:
                     return jsonify({"message": "Folder not found"}), 404
-                if current_user_id != parent_folder.owner_id:
+                if current_user_id != parent_access.owner_id:
                     return jsonify({"msg": "Unauthorized"}), 401
-                
-            # Ensure that the folder name is unique within the parent folder
-            existing_folder = Folder.query.filter_by(name=name, parent_data_room_id=parent_data_room_id, parent_folder_id=parent_folder_id).first()
-            if existing_folder:
-                return jsonify({"message": "Folder already exists"}), 400
-                
-            # Create the folder
+
+                # The new folder's index is built from the parent's row, not the cache
+                parent_folder = Folder.query.get(parent_access.id)
+                if not parent_folder:
+                    return jsonify({"message": "Folder not found"}), 404
+                if parent_folder.parent_data_room_id != data_room.id:
+                    return jsonify({"message": "Parent folder is not in the Data Room"}), 400
+
+            # The cached access may not have seen a delete made by another worker
+            if is_tombstoned(data_room.id, parent_folder.id if parent_folder else None):
+                return jsonify({"message": "Folder not found" if parent_folder_id else "Data Room not found"}), 404
+
+            # Create the folder, uq_folder_name rejects a duplicate sibling name
             new_folder = Folder(name=name, parent_data_room_id=parent_data_room_id, parent_folder_id=parent_folder_id, owner_id=current_user_id)
+            place_folder(new_folder, parent_folder)
             db.session.add(new_folder)
+            bump_versions(parents=[(data_room.id, parent_folder.id if parent_folder else None)])
+            db.session.flush()
+            record_changes([change(data_room.id, 'folder', 'create', new_folder.id, name, new_folder.parent_folder_id)])
             db.session.commit()
 
             return jsonify({"msg": "Folder created successfully"}), 201
     except Exception as e:
+        if is_unique_violation(e):
+            return jsonify({"message": "Folder already exists"}), 400
         return jsonify({"message": f"Error: {str(e)}"}), 500
     
 
@@ -106,52 +172,73 @@ def move_folder(folder_id):
     try:
         # Start a transaction
         with db.session.begin():
-            # Ensure that the folder exists and belongs to the current user
-            folder = Folder.query.get(folder_id)
-            if not folder:
+            # Ensure that the folder, the parent data room and the parent folder
+            # exist and belong to the current user
+            # Out of the box support for moving folders between data rooms, add if there's time
+            access, data_room, parent_access = resolve(('folder', folder_id), ('data_room', parent_data_room_id), ('folder', parent_folder_id))
+            if not access or access.deleted:
                 return jsonify({"message": "Folder not found"}), 404
-            if current_user_id != folder.owner_id:
+            if current_user_id != access.owner_id:
                 return jsonify({"msg": "Unauthorized"}), 401
 
-            # Ensure the parent data room exists and belongs to the current user
-            # Out of the box support for moving folders between data rooms, add if there's time
-            data_room = DataRoom.query.get(parent_data_room_id)
-            if not data_room:
+            if not data_room or data_room.deleted:
                 return jsonify({"message": "Data Room not found"}), 404
             if current_user_id != data_room.owner_id:
                 return jsonify({"msg": "Unauthorized"}), 401
             
+            # Load the rows the move rewrites, a cached access may outlive a purge.
+            # Locking the folder keeps concurrent moves of its subtree in order.
+            folder = Folder.query.filter_by(id=folder_id).with_for_update().first()
+            if not folder or is_tombstoned(folder.parent_data_room_id, folder.id):
+                return jsonify({"message": "Folder not found"}), 404
+
             # Ensure that if parent folder exists, it belongs to the current user
+            parent_folder = None
             if parent_folder_id:
-                parent_folder = Folder.query.get(parent_folder_id)
-                if not parent_folder:
+                if not parent_access or parent_access.deleted:
                     return jsonify({"message": "Folder not found"}), 404
-                if current_user_id != parent_folder.owner_id:
+                if current_user_id != parent_access.owner_id:
                     return jsonify({"msg": "Unauthorized"}), 401
-            
-            # Ensure that the folder doesn't already exist within the target folder
-            existing_folder = Folder.query.filter_by(name=name, parent_data_room_id=parent_data_room_id, parent_folder_id=parent_folder_id).first()
-            if existing_folder:
-                return jsonify({"message": "Folder already exists"}), 400
-            
-            print(folder.name, name)
+                parent_folder = Folder.query.get(parent_access.id)
+                if not parent_folder:
+                    return jsonify({"message": "Folder not found"}), 404
+                if parent_folder.parent_data_room_id != data_room.id:
+                    return jsonify({"message": "Parent folder is not in the Data Room"}), 400
 
-            # Move the folder
+                # A folder can't be moved into itself or one of its descendants
+                if is_in_subtree(folder, parent_folder):
+                    return jsonify({"message": "Cannot move a folder into itself"}), 400
+
+            # Nor into a folder or room another worker has deleted
+            if is_tombstoned(data_room.id, parent_folder.id if parent_folder else None):
+                return jsonify({"message": "Folder not found" if parent_folder_id else "Data Room not found"}), 404
+
+            # Move the folder, re-indexing its subtree. uq_folder_name rejects a
+            # duplicate sibling name when the change is flushed.
             folder.name = name
-            folder.parent_data_room_id = parent_data_room_id
-            folder.parent_folder_id = parent_folder_id
+            moved_from = folder.parent_data_room_id
+            old_place = (folder.parent_data_room_id, folder.parent_folder_id)
+            parents = {(folder.parent_data_room_id, folder.parent_folder_id), (data_room.id, parent_folder.id if parent_folder else None)}
+            if (parent_folder.id if parent_folder else None) != folder.parent_folder_id or data_room.id != folder.parent_data_room_id:
+                # The subtree's totals leave the old ancestors for the new ones
+                usage = UsageChanges(current_user_id)
+                usage.add(-folder.file_count, -folder.total_bytes, folder.parent_data_room_id, ancestor_ids(folder))
+                usage.add(folder.file_count, folder.total_bytes, data_room.id, folder_chain(parent_folder))
+                move_subtree(folder, parent_folder, data_room.id)
+                usage.apply()
+            bump_versions(parents=parents, folders=[folder])
+            record_changes(move_changes('folder', folder.id, name, old_place, (folder.parent_data_room_id, folder.parent_folder_id)))
 
             # Return folder details
-            return jsonify({
-                "id": folder.id,
-                "name": folder.name,
-                "parent_data_room_id": folder.parent_data_room_id,
-                "parent_folder_id": folder.parent_folder_id,
-                "owner_id": folder.owner_id,
-                "children_folders": [{"id": folder.id, "name": folder.name} for folder in folder.children_folders],
-                "children_files": [{"id": file.id, "name": file.name} for file in folder.children_files],
-            }), 200
+            page = _folder_page(folder, None, page_size())
+            db.session.commit()
+
+            # The whole subtree may have changed room
+            invalidate(data_room_ids=[moved_from, data_room.id])
+        return jsonify(page), 200
     except Exception as e:
+        if is_unique_violation(e):
+            return jsonify({"message": "Folder already exists"}), 400
         return jsonify({"message": f"Error: {str(e)}"}), 500
 
 
@@ -163,24 +250,51 @@ def delete_folder(folder_id):
     try:
         # Start a transaction
         with db.session.begin():
-            folder = Folder.query.get(folder_id)
-            if not folder:
+            [access] = resolve(('folder', folder_id))
+            if not access or access.deleted:
                 return jsonify({"message": "Folder not found"}), 404
 
-            if current_user_id != folder.owner_id:
+            if current_user_id != access.owner_id:
                 return jsonify({"msg": "Unauthorized"}), 401
 
-            # Delete the entire folder directory from the storage
-            folder_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'user-' + str(current_user_id), 'data-room-' + str(folder.parent_data_room_id), 'folder-' + str(folder.id))
-            print('delete folder path', folder_path)
-            if os.path.exists(folder_path):
-                shutil.rmtree(folder_path)
+            # Tombstone the subtree root, purge.py removes the rows and blobs later
+            # The parent and deleted_at come from the locked row, a cached access may
+            # predate a move or delete made by another worker, and a delete applied
+            # twice would take the totals away twice
+            folder = db.session.query(Folder.parent_data_room_id, Folder.parent_folder_id, Folder.ancestor_path, Folder.file_count, Folder.total_bytes, Folder.deleted_at).filter_by(id=folder_id).with_for_update().first()
+            if not folder or folder.deleted_at or is_tombstoned(folder.parent_data_room_id, folder_id):
+                return jsonify({"message": "Folder not found"}), 404
+            Folder.query.filter_by(id=folder_id).update({Folder.deleted_at: datetime.utcnow()}, synchronize_session=False)
+            bump_versions(parents=[(folder.parent_data_room_id, folder.parent_folder_id)])
 
-            # Delete the folder from the database
-            db.session.delete(folder)
+            # Its files stop counting towards the ancestors, the room and the user
+            usage = UsageChanges(current_user_id)
+            usage.add(-folder.file_count, -folder.total_bytes, folder.parent_data_room_id, ancestor_ids(folder))
+            usage.apply()
+            record_changes([change(folder.parent_data_room_id, 'folder', 'delete', folder_id)])
             db.session.commit()
 
+            # Everything below the folder is now hidden, in the room the cache had too
+            invalidate(data_room_ids={access.data_room_id, folder.parent_data_room_id})
             return jsonify({"msg": "Folder deleted successfully"}), 200
     except Exception as e:
-        print(e)
+        log.exception("Deleting folder %s failed", folder_id)
         return jsonify({"message": f"Error: {str(e)}"}), 500
+
+
+def _folder_page(folder, cursor, limit):
+    folders, files, next_cursor = children_page(Folder.query.filter_by(parent_folder_id=folder.id, deleted_at=None), File.query.filter_by(parent_folder_id=folder.id), cursor, limit)
+    return {
+        "id": folder.id,
+        "name": folder.name,
+        "parent_data_room_id": folder.parent_data_room_id,
+        "parent_folder_id": folder.parent_folder_id,
+        "owner_id": folder.owner_id,
+        "file_count": folder.file_count,
+        "total_bytes": folder.total_bytes,
+        "breadcrumbs": breadcrumbs(folder),
+        "children_folders": [{"id": child_folder.id, "name": child_folder.name, "file_count": child_folder.file_count, "total_bytes": child_folder.total_bytes} for child_folder in folders],
+        "children_files": [{"id": file.id, "name": file.name, "size": file.size} for file in files],
+        "next_cursor": next_cursor,
+    }
+
@@ -0,0 +1,19 @@
+# api/routes/metrics.py
+import hmac
+from flask import Blueprint, Response, current_app, jsonify, request
+from metrics import exposition
+
+metrics_routes = Blueprint('metrics', __name__)
+
+@metrics_routes.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Only for scrapers holding METRICS_TOKEN, the endpoint doesn't exist without one
+    token = current_app.config.get('METRICS_TOKEN')
+    if not token:
+        return jsonify({"message": "Not found"}), 404
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        return jsonify({"msg": "Unauthorized"}), 401
+
+    # Prometheus text format, summed over every worker process
+    body, content_type = exposition()
+    return Response(body, content_type=content_type)
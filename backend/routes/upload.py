@@ -0,0 +1,262 @@
+# api/routes/upload.py
+import uuid
+from flask import Blueprint, jsonify, request
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from database import is_unique_violation
+from database.models import db, File, Folder, UploadSession
+from database.hierarchy import is_tombstoned
+from database.permissions import resolve
+from database.versions import bump_versions
+from database.usage import QuotaExceeded, UsageChanges, folder_chains, has_quota
+from database.changes import change, record_changes
+from metrics import transfer
+from previews import render_previews
+from search import extract_text
+from storage import acquire_blob, unlink_unreferenced, ChunkConflict, start_session, received_bytes, write_chunk, session_digest, finish_session, discard_session
+
+'''
+Chunked, resumable uploads:
+
+    POST   /file/upload                        start a session for a file of a declared size
+    PUT    /file/upload/<upload_id>?offset=N   stream the next chunk as the raw request body
+    GET    /file/upload/<upload_id>            current offset, to resume after a failure
+    POST   /file/upload/<upload_id>/complete   create the File from the received bytes
+    DELETE /file/upload/<upload_id>            abort the session
+'''
+
+upload_routes = Blueprint('upload', __name__)
+
+# Suggested chunk size for clients, chunks of any size are accepted
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def _session_status(upload_session, offset):
+    return {
+        "upload_id": upload_session.id,
+        "name": upload_session.name,
+        "size": upload_session.size,
+        "offset": offset,
+        "chunk_size": CHUNK_SIZE,
+    }
+
+
+def _in_data_room(folder_id, data_room_id):
+    # Read from the folder row, a cached access may predate a move to another room
+    return db.session.query(Folder.parent_data_room_id).filter_by(id=folder_id).scalar() == int(data_room_id)
+
+
+@upload_routes.route('/file/upload', methods=['POST'])
+@jwt_required()
+def start_upload():
+    current_user_id = get_jwt_identity()
+    data = request.get_json()
+    if not data:
+        return jsonify({"message": "No JSON data in request body"}), 400
+
+    name = data.get('name')
+    if not name:
+        return jsonify({"message": "name is required"}), 400
+
+    size = data.get('size')
+    if not isinstance(size, int) or size < 0:
+        return jsonify({"message": "size must be a non-negative integer"}), 400
+
+    # Determine where to create the file
+    parent_data_room_id = data.get('parent_data_room_id')
+    parent_folder_id = data.get('parent_folder_id')
+    if not parent_data_room_id:
+        return jsonify({"message": "parent_data_room_id is required"}), 400
+
+    try:
+        # Start a transaction
+        with db.session.begin():
+            # Ensure the parent data room exists and belongs to the current user
+            data_room, parent_folder = resolve(('data_room', parent_data_room_id), ('folder', parent_folder_id))
+            if not data_room or data_room.deleted:
+                return jsonify({"message": "Data Room not found"}), 404
+            if current_user_id != data_room.owner_id:
+                return jsonify({"msg": "Unauthorized"}), 401
+
+            # Ensure that if parent folder exists, it belongs to the current user
+            if parent_folder_id:
+                if not parent_folder or parent_folder.deleted:
+                    return jsonify({"message": "Folder not found"}), 404
+                if current_user_id != parent_folder.owner_id:
+                    return jsonify({"msg": "Unauthorized"}), 401
+                if not _in_data_room(parent_folder.id, data_room.id):
+                    return jsonify({"message": "Parent folder is not in the Data Room"}), 400
+
+            # The cached access may not have seen a delete made by another worker
+            if is_tombstoned(data_room.id, parent_folder.id if parent_folder_id else None):
+                return jsonify({"message": "Folder not found" if parent_folder_id else "Data Room not found"}), 404
+
+            # Fail early rather than after the whole file has been transferred
+            existing_file = File.query.filter_by(name=name, parent_data_room_id=parent_data_room_id, parent_folder_id=parent_folder_id).first()
+            if existing_file:
+                return jsonify({"message": "File already exists"}), 400
+            if not has_quota(current_user_id, size):
+                return jsonify({"message": "Storage quota exceeded"}), 507
+
+            upload_session = UploadSession(id=uuid.uuid4().hex, name=name, size=size, owner_id=current_user_id, parent_data_room_id=parent_data_room_id, parent_folder_id=parent_folder_id)
+            start_session(upload_session.id)
+            db.session.add(upload_session)
+            status = _session_status(upload_session, 0)
+            db.session.commit()
+
+            return jsonify(status), 201
+    except Exception as e:
+        return jsonify({"message": f"Error: {str(e)}"}), 500
+
+
+@upload_routes.route('/file/upload/<upload_id>', methods=['GET'])
+@jwt_required()
+def get_upload(upload_id):
+    current_user_id = get_jwt_identity()
+    try:
+        # Start a transaction
+        with db.session.begin():
+            upload_session = UploadSession.query.get(upload_id)
+            if not upload_session:
+                return jsonify({"message": "Upload not found"}), 404
+            if current_user_id != upload_session.owner_id:
+                return jsonify({"msg": "Unauthorized"}), 401
+
+            return jsonify(_session_status(upload_session, received_bytes(upload_id))), 200
+    except Exception as e:
+        return jsonify({"message": f"Error: {str(e)}"}), 500
+
+
+@upload_routes.route('/file/upload/<upload_id>', methods=['PUT'])
+@jwt_required()
+@transfer('upload')
+def upload_chunk(upload_id):
+    current_user_id = get_jwt_identity()
+    offset = request.args.get('offset', type=int)
+    if offset is None or offset < 0:
+        return jsonify({"message": "offset is required"}), 400
+
+    try:
+        # Only hold the transaction for the lookup, not while the chunk streams in
+        with db.session.begin():
+            upload_session = UploadSession.query.get(upload_id)
+            if not upload_session:
+                return jsonify({"message": "Upload not found"}), 404
+            if current_user_id != upload_session.owner_id:
+                return jsonify({"msg": "Unauthorized"}), 401
+            size = upload_session.size
+
+        if request.content_length is not None and offset + request.content_length > size:
+            return jsonify({"message": "Chunk extends past the declared file size"}), 400
+
+        # Stream the request body straight to disk
+        try:
+            new_offset = write_chunk(upload_id, offset, request.stream, size)
+        except ChunkConflict as conflict:
+            return jsonify({"message": str(conflict), "offset": conflict.offset}), 409
+
+        return jsonify({"upload_id": upload_id, "size": size, "offset": new_offset}), 200
+    except Exception as e:
+        return jsonify({"message": f"Error: {str(e)}"}), 500
+
+
+@upload_routes.route('/file/upload/<upload_id>/complete', methods=['POST'])
+@jwt_required()
+def complete_upload(upload_id):
+    current_user_id = get_jwt_identity()
+    digest = None
+    try:
+        # Start a transaction
+        with db.session.begin():
+            upload_session = UploadSession.query.get(upload_id)
+            if not upload_session:
+                return jsonify({"message": "Upload not found"}), 404
+            if current_user_id != upload_session.owner_id:
+                return jsonify({"msg": "Unauthorized"}), 401
+
+            offset = received_bytes(upload_id)
+            if offset != upload_session.size:
+                return jsonify({"message": "Upload is incomplete", "offset": offset}), 409
+
+            # The parents may have changed while the upload was in flight
+            data_room, parent_folder = resolve(('data_room', upload_session.parent_data_room_id), ('folder', upload_session.parent_folder_id))
+            if not data_room or data_room.deleted:
+                return jsonify({"message": "Data Room not found"}), 404
+            if current_user_id != data_room.owner_id:
+                return jsonify({"msg": "Unauthorized"}), 401
+
+            if upload_session.parent_folder_id:
+                if not parent_folder or parent_folder.deleted:
+                    return jsonify({"message": "Folder not found"}), 404
+                if current_user_id != parent_folder.owner_id:
+                    return jsonify({"msg": "Unauthorized"}), 401
+                if not _in_data_room(upload_session.parent_folder_id, upload_session.parent_data_room_id):
+                    return jsonify({"message": "Parent folder is not in the Data Room"}), 400
+
+            # The cached access may not have seen a delete made by another worker
+            if is_tombstoned(upload_session.parent_data_room_id, upload_session.parent_folder_id):
+                return jsonify({"message": "Folder not found" if upload_session.parent_folder_id else "Data Room not found"}), 404
+
+            # Checked up front as well as by uq_file_name, since finishing the
+            # session can't be undone
+            existing_file = File.query.filter_by(name=upload_session.name, parent_data_room_id=upload_session.parent_data_room_id, parent_folder_id=upload_session.parent_folder_id).first()
+            if existing_file:
+                return jsonify({"message": "File already exists"}), 400
+
+            # Reserve the bytes before the session is finished, a session over
+            # quota can be completed again once space has been freed
+            usage = UsageChanges(current_user_id)
+            usage.add(1, upload_session.size, upload_session.parent_data_room_id, folder_chains([upload_session.parent_folder_id]).get(upload_session.parent_folder_id, []))
+            usage.apply(check_quota=True)
+
+            # Copy the received bytes into the blob store. The reference is taken
+            # first, so stored bytes with the same digest can't be unlinked before
+            # this commits.
+            digest, size = session_digest(upload_id)
+            new_blob = acquire_blob(digest, size, restore=lambda digest: finish_session(upload_id, digest))
+
+            new_file = File(name=upload_session.name, content=digest, size=size, owner_id=current_user_id, parent_data_room_id=upload_session.parent_data_room_id, parent_folder_id=upload_session.parent_folder_id)
+            db.session.add(new_file)
+            db.session.delete(upload_session)
+            bump_versions(parents=[(upload_session.parent_data_room_id, upload_session.parent_folder_id)])
+            db.session.flush()
+            file_id = new_file.id
+            record_changes([change(new_file.parent_data_room_id, 'file', 'create', file_id, new_file.name, new_file.parent_folder_id, size)])
+            db.session.commit()
+
+            # Only now, a failed commit leaves the session to be completed again
+            discard_session(upload_id)
+            if new_blob:
+                extract_text([digest])
+                render_previews([digest])
+
+            return jsonify({"msg": "File created successfully", "id": file_id}), 201
+    except QuotaExceeded as e:
+        return jsonify({"message": str(e)}), 507
+    except Exception as e:
+        # Drop the bytes if nothing else references them
+        unlink_unreferenced([digest])
+        if is_unique_violation(e):
+            return jsonify({"message": "File already exists"}), 400
+        return jsonify({"message": f"Error: {str(e)}"}), 500
+
+
+@upload_routes.route('/file/upload/<upload_id>', methods=['DELETE'])
+@jwt_required()
+def abort_upload(upload_id):
+    current_user_id = get_jwt_identity()
+    try:
+        # Start a transaction
+        with db.session.begin():
+            upload_session = UploadSession.query.get(upload_id)
+            if not upload_session:
+                return jsonify({"message": "Upload not found"}), 404
+            if current_user_id != upload_session.owner_id:
+                return jsonify({"msg": "Unauthorized"}), 401
+
+            discard_session(upload_id)
+            db.session.delete(upload_session)
+            db.session.commit()
+
+            return jsonify({"msg": "Upload aborted"}), 200
+    except Exception as e:
+        return jsonify({"message": f"Error: {str(e)}"}), 500
@@ -1,12 +1,16 @@
 # api/routes/user.py
+from datetime import timedelta
 from flask import Blueprint, jsonify, request
 from flask_jwt_extended import jwt_required, get_jwt_identity, create_access_token
 from database.models import db, User
+from database.engine import read_replica
+from database.usage import user_quota
 
 user_routes = Blueprint('user', __name__)
 
 @user_routes.route('/user', methods=['GET'])
 @jwt_required()
+@read_replica
 def get_user():
     current_user_id = get_jwt_identity()
 
@@ -24,7 +28,9 @@ def get_user():
             return jsonify({
                 "id": user.id,
                 "username": user.username,
-                "email": user.email
+                "email": user.email,
+                "used_bytes": user.used_bytes,
+                "quota_bytes": user_quota(user)
             }), 200
     except Exception as e:
         return jsonify({"message": f"Error: {str(e)}"}), 500
@@ -52,9 +58,12 @@ def create_user():
 
             new_user = User(username=username, email=email)
             db.session.add(new_user)
+            # The id has to be read before the commit closes the transaction
+            db.session.flush()
+            new_user_id = new_user.id
             db.session.commit()
 
-            access_token = create_access_token(identity=new_user.id, expires_delta=timedelta(hours=12))
+            access_token = create_access_token(identity=new_user_id, expires_delta=timedelta(hours=12))
             return jsonify(access_token=access_token), 200
     except Exception as e:
         return jsonify({"message": f"Error: {str(e)}"}), 500
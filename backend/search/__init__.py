@@ -0,0 +1,4 @@
+# search/__init__.py
+from .extraction import SEARCH_WORKERS, extract_pages, extract_text, search_index_command, start_text_extractor, store_pages
+from .index import decode_search_cursor, search_pages
+from .names import MAX_TYPEAHEAD_LIMIT, TYPEAHEAD_LIMIT, find_names
@@ -0,0 +1,153 @@
+# search/extraction.py
+import itertools, logging, multiprocessing, threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from pypdf import PdfReader
+from database.models import db, Blob, FilePage
+from green import is_green, native_thread_pool
+from storage import master_key, storage_backend
+from storage.encryption import decode_master_key, open_blob
+
+'''
+Text extraction for the search index.
+
+Parsing a PDF is CPU bound, so it runs in a pool of SEARCH_WORKERS processes
+next to each web process. Upload routes hand over the digests of newly stored
+blobs once their transaction commits, and each blob is extracted once no matter
+how many File rows share it. Pages are written to FilePage, which the full-text
+index follows (search/index.py), and Blob.indexed_at marks the blob as done.
+
+Blobs stored before search existed, or while extraction was disabled with
+SEARCH_WORKERS=0, are indexed with `flask search-index`.
+'''
+
+SEARCH_WORKERS = 2
+PDF_SIGNATURE = b'%PDF-'
+
+# Workers are forked. Spawned workers would re-import the entry script, and
+# app.py creates the app at import time.
+_MP_CONTEXT = multiprocessing.get_context('fork')
+
+log = logging.getLogger(__name__)
+
+
+def extract_pages(backend, digest, key):
+    '''
+    Text of every page of the PDF stored in backend under digest, decrypted
+    with the master key, in page order. Runs in a worker process. Anything that
+    is not a readable PDF has no pages.
+    '''
+    try:
+        file, _ = open_blob(backend.open(digest), key)
+        with file:
+            if file.read(len(PDF_SIGNATURE)) != PDF_SIGNATURE:
+                return []
+            file.seek(0)
+            return [page.extract_text() or '' for page in PdfReader(file).pages]
+    except Exception:
+        return []
+
+
+def store_pages(digest, pages):
+    '''
+    Write the pages of a blob unless it was indexed or released meanwhile, in
+    the caller's transaction. Returns True when the pages were written.
+    '''
+    claimed = Blob.query.filter_by(digest=digest, indexed_at=None).update({Blob.indexed_at: datetime.utcnow()}, synchronize_session=False)
+    if not claimed:
+        return False
+    # Postgres text can't hold NUL, which some PDFs put in their text
+    db.session.bulk_insert_mappings(FilePage, [
+        {"digest": digest, "page": number, "text": text.replace('\x00', '')}
+        for number, text in enumerate(pages, 1) if text.strip()
+    ])
+    return True
+
+
+class TextExtractor:
+    # Process pool extracting blobs in the background of one web process
+
+    def __init__(self, app, workers=SEARCH_WORKERS):
+        self.app = app
+        self.workers = workers
+        self.backend = app.extensions['storage']
+        self.key = decode_master_key(app.config['ENCRYPTION_KEY'])
+        self._pool = None
+        # Pages are written from one thread, off the request and pool threads
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='search-index')
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        # Started on first use. Process pools don't work under gevent, there
+        # the workers are threads.
+        if self._pool is None:
+            if is_green():
+                self._pool = native_thread_pool(self.workers, 'search-extract')
+            else:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=_MP_CONTEXT)
+        return self._pool
+
+    def submit(self, digests):
+        for digest in set(digests):
+            with self._lock:
+                if digest in self._pending:
+                    continue
+                self._pending.add(digest)
+                future = self._executor().submit(extract_pages, self.backend, digest, self.key)
+            future.add_done_callback(lambda future, digest=digest: self._done(digest, future))
+
+    def _done(self, digest, future):
+        try:
+            self._writer.submit(self._store, digest, future)
+        except RuntimeError:
+            # Shutting down, the blob stays unindexed for `flask search-index`
+            with self._lock:
+                self._pending.discard(digest)
+
+    def _store(self, digest, future):
+        try:
+            pages = future.result()
+            with self.app.app_context():
+                with db.session.begin():
+                    store_pages(digest, pages)
+        except BrokenProcessPool:
+            # A worker died, start a new pool. The blob stays unindexed for `flask search-index`.
+            with self._lock:
+                self._pool = None
+        except Exception:
+            log.exception("Indexing %s failed", digest)
+        finally:
+            with self._lock:
+                self._pending.discard(digest)
+
+
+def start_text_extractor(app, workers=SEARCH_WORKERS):
+    app.extensions['text_extractor'] = TextExtractor(app, workers)
+
+
+def extract_text(digests):
+    # Queue newly stored blobs for indexing, a no-op when extraction is disabled
+    extractor = current_app.extensions.get('text_extractor')
+    if extractor and digests:
+        extractor.submit(digests)
+
+
+@click.command('search-index')
+@click.option('--workers', default=SEARCH_WORKERS, show_default=True, help='Extraction processes.')
+@with_appcontext
+def search_index_command(workers):
+    '''Extract and index the text of every blob that is not indexed yet.'''
+    with db.session.begin():
+        digests = [digest for (digest,) in db.session.query(Blob.digest).filter(Blob.indexed_at.is_(None)).order_by(Blob.digest)]
+
+    indexed = 0
+    with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=_MP_CONTEXT) as pool:
+        for digest, pages in zip(digests, pool.map(extract_pages, itertools.repeat(storage_backend()), digests, itertools.repeat(master_key()), chunksize=8)):
+            with db.session.begin():
+                indexed += store_pages(digest, pages)
+    click.echo(f"Indexed {indexed} blobs")
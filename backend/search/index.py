@@ -0,0 +1,118 @@
+# search/index.py
+import re
+from sqlalchemy import and_, column, func, literal_column, or_, table
+from sqlalchemy.sql.operators import custom_op
+from database.models import db, File, Folder, FilePage
+from database.hierarchy import under_tombstone
+from database.pagination import InvalidCursor, decode_cursor
+
+'''
+Full-text search over the pages in FilePage.
+
+The inverted index lives next to FilePage and is specific to the database:
+
+    SQLite      FTS5 table file_page_fts (porter stemming), ranked by bm25()
+    Postgres    generated tsvector column file_page.search_vector with a GIN
+                index, ranked by ts_rank()
+
+Both backends expose the same two queries: the matching pages with a score
+(lower is better) and highlighted snippets for a handful of pages. Snippets
+are built only for the page of hits being returned.
+
+Pages belong to blobs, not files, so a document shared by many files is
+indexed once. Hits are joined back to the files of the searched data room
+through File.content, leaving out files in deleted folders.
+'''
+
+MAX_QUERY_TERMS = 16
+SNIPPET_WORDS = 24
+HIGHLIGHT = ('<mark>', '</mark>')
+# Shared so statements using it stay in the compiled statement cache
+TS_MATCH = custom_op('@@')
+
+
+def query_terms(q):
+    # Words of the query, every one of them must match
+    return re.findall(r'\w+', q.lower())[:MAX_QUERY_TERMS]
+
+
+class SqliteSearch:
+    fts = table('file_page_fts', column('rowid'))
+    document = literal_column('file_page_fts')
+
+    def _match(self, terms):
+        # Quote every term so FTS5 query syntax in user input is taken literally
+        return self.document.match(' '.join(f'"{term}"' for term in terms))
+
+    def ranked_pages(self, terms):
+        return db.session.query(FilePage.id, FilePage.digest, FilePage.page, func.bm25(self.document).label('score')) \
+            .select_from(self.fts).join(FilePage, FilePage.id == self.fts.c.rowid).filter(self._match(terms))
+
+    def snippets(self, terms, page_ids):
+        snippet = func.snippet(self.document, 0, *HIGHLIGHT, '…', SNIPPET_WORDS // 2)
+        return dict(db.session.query(self.fts.c.rowid, snippet).filter(self._match(terms), self.fts.c.rowid.in_(page_ids)))
+
+
+class PostgresSearch:
+    search_vector = literal_column('file_page.search_vector')
+
+    def _query(self, terms):
+        return func.plainto_tsquery('english', ' '.join(terms))
+
+    def ranked_pages(self, terms):
+        query = self._query(terms)
+        return db.session.query(FilePage.id, FilePage.digest, FilePage.page, (-func.ts_rank(self.search_vector, query)).label('score')) \
+            .filter(self.search_vector.operate(TS_MATCH, query))
+
+    def snippets(self, terms, page_ids):
+        options = f'StartSel={HIGHLIGHT[0]}, StopSel={HIGHLIGHT[1]}, MaxWords={SNIPPET_WORDS}, MinWords={SNIPPET_WORDS // 2}'
+        headline = func.ts_headline('english', FilePage.text, self._query(terms), options)
+        return dict(db.session.query(FilePage.id, headline).filter(FilePage.id.in_(page_ids)))
+
+
+def decode_search_cursor(cursor):
+    # Cursor of search_pages, the (score, file_id, page) of the hit to continue after
+    values = decode_cursor(cursor)
+    if not isinstance(values, list) or len(values) != 3:
+        raise InvalidCursor("Invalid cursor")
+    return tuple(values)
+
+
+def _backend():
+    return PostgresSearch() if db.engine.dialect.name == 'postgresql' else SqliteSearch()
+
+
+def search_pages(data_room_id, owner_id, q, after, limit):
+    '''
+    Pages of owner_id's files in a data room matching every word of q, best first and
+    then by (file id, page). Continues after the (score, file_id, page) key in
+    after. Returns (hits, key of the last hit or None).
+    '''
+    terms = query_terms(q)
+    if not terms:
+        return [], None
+
+    backend = _backend()
+    pages = backend.ranked_pages(terms).subquery()
+    query = db.session.query(File.id, File.name, File.parent_folder_id, pages.c.id.label('page_id'), pages.c.page, pages.c.score) \
+        .join(pages, pages.c.digest == File.content) \
+        .outerjoin(Folder, Folder.id == File.parent_folder_id) \
+        .filter(File.parent_data_room_id == data_room_id, File.owner_id == owner_id, or_(File.parent_folder_id.is_(None), ~under_tombstone(Folder)))
+
+    if after is not None:
+        score, file_id, page = after
+        query = query.filter(or_(pages.c.score > score, and_(pages.c.score == score, or_(File.id > file_id, and_(File.id == file_id, pages.c.page > page)))))
+
+    rows = query.order_by(pages.c.score, File.id, pages.c.page).limit(limit + 1).all()
+    last = (rows[limit - 1].score, rows[limit - 1].id, rows[limit - 1].page) if len(rows) > limit else None
+    rows = rows[:limit]
+
+    snippets = backend.snippets(terms, [row.page_id for row in rows]) if rows else {}
+    hits = [{
+        "file_id": row.id,
+        "name": row.name,
+        "parent_folder_id": row.parent_folder_id,
+        "page": row.page,
+        "snippet": snippets.get(row.page_id),
+    } for row in rows]
+    return hits, last
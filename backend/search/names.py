@@ -0,0 +1,123 @@
+# search/names.py
+from sqlalchemy import and_, column, func, literal, literal_column, select, table, union_all
+from sqlalchemy.orm import aliased
+from database.models import db, File, Folder
+from database.hierarchy import under_tombstone
+
+'''
+Typeahead over file and folder names within a data room.
+
+Every query matches names starting with it through an index on
+(parent_data_room_id, lower(name)). Queries of three characters or more also
+match names containing it, through a trigram index:
+
+    SQLite      FTS5 tables file_name_fts / folder_name_fts (trigram tokenizer)
+    Postgres    GIN indexes on lower(name) with pg_trgm
+
+Prefix matches rank first, in case-insensitive name order, followed by the
+first substring matches the trigram index yields, also sorted by name. The
+folder path of every match comes from the same statement: a recursive CTE
+climbs parent_folder_id from the matches only, one primary-key lookup per
+level.
+'''
+
+TYPEAHEAD_LIMIT = 10
+MAX_TYPEAHEAD_LIMIT = 50
+# Shortest query the trigram indexes can answer
+MIN_SUBSTRING_LENGTH = 3
+# Sorts after any character a name can continue with
+MAX_CHARACTER = '\U0010ffff'
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class SqliteNames:
+    def prefix(self, model, q):
+        # Index range on lower(name), written so the planner can see it
+        key = func.lower(model.name)
+        return and_(key >= func.lower(q), key < func.lower(q) + MAX_CHARACTER)
+
+    def substring(self, query, model, q):
+        # Driven by the trigram table, then one primary-key lookup per hit
+        fts = table(f'{model.__tablename__}_name_fts', column('rowid'))
+        phrase = '"' + q.replace('"', '""') + '"'
+        return query.join_from(fts, model, model.id == fts.c.rowid).where(literal_column(fts.name).match(phrase))
+
+
+class PostgresNames:
+    # lower(name) LIKE 'q%' is served by the text_pattern_ops index, '%q%' by the trigram one
+    def prefix(self, model, q):
+        return func.lower(model.name).like(_escape_like(q.lower()) + '%', escape='\\')
+
+    def substring(self, query, model, q):
+        return query.where(func.lower(model.name).like('%' + _escape_like(q.lower()) + '%', escape='\\'))
+
+
+def _backend():
+    return PostgresNames() if db.engine.dialect.name == 'postgresql' else SqliteNames()
+
+
+def find_names(data_room_id, owner_id, q, limit=TYPEAHEAD_LIMIT):
+    '''
+    Files and folders of owner_id in a data room whose name starts with, or
+    contains, q. Deleted subtrees are left out. Returns up to limit dicts with
+    the match and its folder path, root first, from one query.
+    '''
+    backend = _backend()
+
+    def visible(query, model):
+        # A file is hidden by a tombstone on its parent folder or above
+        if model is Folder:
+            return query.where(~under_tombstone(Folder))
+        parent = aliased(Folder)
+        return query.outerjoin(parent, parent.id == File.parent_folder_id).where(~under_tombstone(parent))
+
+    def matches(model, kind, rank, data_room_column):
+        return select(
+            literal(kind).label('kind'), model.id, model.name, model.parent_folder_id,
+            literal(rank).label('rank'), func.lower(model.name).label('sort_name'),
+        ).where(data_room_column == data_room_id, model.owner_id == owner_id)
+
+    def first(query, model, *order_by):
+        # Each arm is cut to limit before the arms are merged
+        return select(visible(query, model).order_by(*order_by).limit(limit).subquery())
+
+    arms = []
+    for model, kind in ((Folder, 'folder'), (File, 'file')):
+        prefix = backend.prefix(model, q)
+        arms.append(first(matches(model, kind, 0, model.parent_data_room_id).where(prefix), model, func.lower(model.name), model.id))
+        if len(q) >= MIN_SUBSTRING_LENGTH:
+            # The trigram index leads: parent_data_room_id + 0 keeps the planner
+            # from scanning the whole room instead, and the arm stops at the
+            # first matches since sorting them all costs as much as the search
+            substring = matches(model, kind, 1, model.parent_data_room_id + 0).where(~prefix)
+            arms.append(first(backend.substring(substring, model, q), model))
+
+    rank, sort_name, kind, id = (literal_column(label) for label in ('rank', 'sort_name', 'kind', 'id'))
+    found = union_all(*arms).order_by(rank, sort_name, kind, id).limit(limit).cte('found')
+
+    # Climb from each match's parent folder to the room root
+    step = aliased(Folder)
+    ancestors = select(found.c.kind, found.c.id.label('match_id'), Folder.id.label('folder_id'), Folder.name, Folder.parent_folder_id, literal(1).label('level')) \
+        .join_from(found, Folder, Folder.id == found.c.parent_folder_id) \
+        .cte('ancestors', recursive=True)
+    ancestors = ancestors.union_all(
+        select(ancestors.c.kind, ancestors.c.match_id, step.id, step.name, step.parent_folder_id, ancestors.c.level + 1)
+        .join_from(ancestors, step, step.id == ancestors.c.parent_folder_id)
+    )
+
+    rows = db.session.execute(
+        select(found.c.kind, found.c.id, found.c.name, found.c.parent_folder_id, ancestors.c.folder_id, ancestors.c.name.label('folder_name'))
+        .outerjoin(ancestors, and_(ancestors.c.kind == found.c.kind, ancestors.c.match_id == found.c.id))
+        .order_by(found.c.rank, found.c.sort_name, found.c.kind, found.c.id, ancestors.c.level.desc())
+    )
+
+    results = []
+    for row in rows:
+        if not results or (results[-1]["type"], results[-1]["id"]) != (row.kind, row.id):
+            results.append({"type": row.kind, "id": row.id, "name": row.name, "parent_folder_id": row.parent_folder_id, "path": []})
+        if row.folder_id is not None:
+            results[-1]["path"].append({"id": row.folder_id, "name": row.folder_name})
+    return results
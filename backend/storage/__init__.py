@@ -0,0 +1,4 @@
+# storage/__init__.py
+from .blob_store import init_storage, storage_backend, is_blob_digest, master_key, stored_file_key, open_stored_file, download_url, store_blob, BlobMissing, acquire_blob, acquire_blobs, release_blobs, unlink_unreferenced, encrypt_blobs_command
+from .upload_sessions import UPLOAD_SESSION_TTL, ChunkConflict, start_session, received_bytes, write_chunk, session_digest, finish_session, discard_session, expire_sessions
+from .archive import ARCHIVE_COMPRESSION, archive_disposition, stream_archive
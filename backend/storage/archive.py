@@ -0,0 +1,165 @@
+# storage/archive.py
+import os, zipfile
+from urllib.parse import quote
+from sqlalchemy import or_
+from database.models import db, Folder, File
+from database.hierarchy import under_path, under_tombstone
+from .blob_store import CHUNK_SIZE, open_stored_file, stored_file_key
+
+'''
+Streaming ZIP export of a data room or folder.
+
+The archive is built while the response is sent, from the decrypted contents
+of the blob store: zipfile writes each entry into a sink that the response
+generator drains after every chunk, with a data descriptor after each file
+since the output can't seek back. Entries and the central directory switch to
+ZIP64 on their own once a file or the archive passes 4 GiB or 65535 entries.
+
+Nothing is staged. Memory holds one chunk of file data, the folder names of the
+export and the central directory (a few hundred bytes per entry). Files are
+read one folder at a time, ARCHIVE_BATCH_SIZE rows per short transaction, so a
+download lasting hours never keeps a transaction open.
+'''
+
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_COMPRESSION = {"stored": zipfile.ZIP_STORED, "deflate": zipfile.ZIP_DEFLATED}
+# The earliest timestamp a ZIP entry can hold
+EARLIEST_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+class _Sink:
+    # Write-only target for zipfile, emptied by the response generator
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _entry_name(name):
+    # One path component, whatever the user named the file or folder
+    name = name.replace('/', '_').replace('\\', '_')
+    return '_' if name in ('', '.', '..') else name
+
+
+def _unique_name(taken, name, is_folder=False):
+    '''
+    name, or "name (2)", "name (3)"... when a sibling in the archive already has
+    it, since "a/b" and "a_b" both become "a_b". Files keep their extension last.
+    '''
+    root, extension = (name, '') if is_folder else os.path.splitext(name)
+    candidate, number = name, 2
+    while candidate in taken:
+        candidate = f"{root} ({number}){extension}"
+        number += 1
+    taken.add(candidate)
+    return candidate
+
+
+def _date_time(created_at):
+    if created_at is None:
+        return EARLIEST_DATE_TIME
+    return max(created_at.timetuple()[:6], EARLIEST_DATE_TIME)
+
+
+def _archive_folders(data_room_id, folder_id, subtree_path):
+    '''
+    Archive path of every live folder in the export, '' for the exported folder
+    or room, and the entry names taken in each of those paths so far.
+    '''
+    query = db.session.query(Folder.id, Folder.name, Folder.parent_folder_id).filter(~under_tombstone(Folder))
+    if folder_id is None:
+        query = query.filter(Folder.parent_data_room_id == data_room_id)
+    else:
+        query = query.filter(or_(Folder.id == folder_id, under_path(subtree_path)))
+
+    # Parents sort before their children by ancestor_path, the room root is None
+    paths = {None: '', folder_id: ''}
+    taken = {}
+    for id, name, parent_folder_id in query.order_by(Folder.ancestor_path):
+        if id != folder_id:
+            parent_path = paths[parent_folder_id]
+            paths[id] = f"{parent_path}{_unique_name(taken.setdefault(parent_path, set()), _entry_name(name), is_folder=True)}/"
+    return paths, taken
+
+
+def _folder_files(condition):
+    # (name, stored file key, created_at) of the files matching condition, in name order
+    after = None
+    while True:
+        with db.session.begin():
+            query = db.session.query(File.name, File.content, File.owner_id, File.parent_data_room_id, File.parent_folder_id, File.created_at).filter(condition)
+            if after is not None:
+                query = query.filter(File.name > after)
+            rows = query.order_by(File.name).limit(ARCHIVE_BATCH_SIZE).all()
+            files = [(row.name, stored_file_key(row), row.created_at) for row in rows]
+        yield from files
+        if len(rows) < ARCHIVE_BATCH_SIZE:
+            return
+        after = rows[-1].name
+
+
+def _write_file(archive, sink, name, key, created_at):
+    try:
+        source, size = open_stored_file(key)
+    except FileNotFoundError:
+        # Deleted since it was listed
+        return
+    with source:
+        info = zipfile.ZipInfo(name, _date_time(created_at))
+        info.compress_type = archive.compression
+        info.external_attr = 0o644 << 16
+        # A known size lets zipfile pick ZIP64 for this entry up front
+        info.file_size = size
+        with archive.open(info, 'w') as entry:
+            for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                entry.write(chunk)
+                data = sink.drain()
+                if data:
+                    yield data
+
+
+def stream_archive(data_room_id, folder_id=None, subtree_path=None, compression=zipfile.ZIP_STORED):
+    '''
+    Generate the bytes of a ZIP of a data room, or of the folder folder_id whose
+    children have ancestor_path subtree_path. Deleted subtrees are left out,
+    empty folders are kept.
+    '''
+    with db.session.begin():
+        folders, taken = _archive_folders(data_room_id, folder_id, subtree_path)
+
+    sink = _Sink()
+    archive = zipfile.ZipFile(sink, 'w', compression=compression, allowZip64=True)
+
+    # The exported folder or room root first, then every folder in path order
+    if folder_id is None:
+        containers = [('', (File.parent_data_room_id == data_room_id) & File.parent_folder_id.is_(None))]
+    else:
+        containers = [('', File.parent_folder_id == folder_id)]
+    containers += [(path, File.parent_folder_id == id) for id, path in sorted(folders.items(), key=lambda item: item[1]) if path]
+
+    for path, condition in containers:
+        if path:
+            archive.writestr(zipfile.ZipInfo(path, EARLIEST_DATE_TIME), b'')
+        for name, key, created_at in _folder_files(condition):
+            yield from _write_file(archive, sink, path + _unique_name(taken.setdefault(path, set()), _entry_name(name)), key, created_at)
+        data = sink.drain()
+        if data:
+            yield data
+
+    archive.close()
+    yield sink.drain()
+
+
+def archive_disposition(name):
+    # Content-Disposition for the archive of a room or folder called name
+    return f"attachment; filename*=UTF-8''{quote(name + '.zip')}"
@@ -0,0 +1,25 @@
+# storage/backends/__init__.py
+import os
+from .base import S3_MAX_CONNECTIONS, S3_PRESIGN_EXPIRES, StorageBackend
+from .local import LocalBackend, LocalFile
+
+
+def create_backend(config):
+    '''
+    The blob backend selected by STORAGE_BACKEND: 'local' (default) keeps blobs
+    under UPLOAD_FOLDER, 's3' in an S3-compatible bucket configured by the S3_*
+    settings.
+    '''
+    if config.get('STORAGE_BACKEND', 'local') == 's3':
+        # boto3 is only needed by deployments that use it
+        from .s3 import S3Backend
+        return S3Backend(
+            config['S3_BUCKET'],
+            prefix=config.get('S3_PREFIX', 'blobs/'),
+            endpoint_url=config.get('S3_ENDPOINT_URL'),
+            region_name=config.get('S3_REGION'),
+            max_connections=config.get('S3_MAX_CONNECTIONS'),
+            server_side_encryption=config.get('S3_SERVER_SIDE_ENCRYPTION'),
+            presign_expires=config.get('S3_PRESIGN_EXPIRES'),
+        )
+    return LocalBackend(os.path.join(config['UPLOAD_FOLDER'], 'blobs'))
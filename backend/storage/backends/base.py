@@ -0,0 +1,45 @@
+# storage/backends/base.py
+
+'''
+Interface of the stores that hold blob bytes.
+
+Keys are blob digests. Backends only move opaque bytes, encryption happens
+above them (storage/encryption.py) unless the backend encrypts at rest itself.
+Backends are pickled into the search and preview worker processes, so they
+must not hold on to connections when pickled.
+'''
+
+# Defaults of the S3 driver, here so configuring it doesn't need boto3
+S3_MAX_CONNECTIONS = 32
+S3_PRESIGN_EXPIRES = 300
+
+
+class StorageBackend:
+    # True when the store encrypts at rest on its own and blobs are written as is
+    server_side_encryption = False
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def put(self, key, path, sealed):
+        '''
+        Store the file at path under key, consuming the file. sealed tells
+        whether its bytes are encrypted by the application.
+        '''
+        raise NotImplementedError
+
+    def open(self, key):
+        '''
+        A seekable binary file object over the stored bytes, with a size
+        attribute and a thread-safe read_at(offset, length). Raises
+        FileNotFoundError for a missing key.
+        '''
+        raise NotImplementedError
+
+    def delete(self, key):
+        # Missing keys are ignored
+        raise NotImplementedError
+
+    def url(self, key, filename):
+        # A URL clients can download the plaintext from directly, None when there is none
+        return None
@@ -0,0 +1,70 @@
+# storage/backends/local.py
+import os
+from metrics import STORAGE_BYTES_READ, STORAGE_BYTES_WRITTEN
+from .base import StorageBackend
+
+_bytes_read = STORAGE_BYTES_READ.labels('local')
+_bytes_written = STORAGE_BYTES_WRITTEN.labels('local')
+
+
+class LocalFile:
+    # Stored file opened for reading, read_at() shares the descriptor across threads
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+
+    def read_at(self, offset, length):
+        data = os.pread(self._file.fileno(), length, offset)
+        _bytes_read.inc(len(data))
+        return data
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        _bytes_read.inc(len(data))
+        return data
+
+    def __getattr__(self, name):
+        # seek, tell, fileno, close... come from the file itself, so servers
+        # can still sendfile() it (those bytes go uncounted)
+        return getattr(self._file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._file.close()
+
+
+class LocalBackend(StorageBackend):
+    '''
+    Blobs on the local or a mounted filesystem, fanned out over two directory
+    levels so no single directory grows unbounded:
+
+        <root>/<digest[0:2]>/<digest[2:4]>/<digest>
+    '''
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def put(self, key, path, sealed):
+        # Temporary files live on the same filesystem, so this is a rename
+        target = self.path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        size = os.path.getsize(path)
+        os.replace(path, target)
+        _bytes_written.inc(size)
+
+    def open(self, key):
+        return LocalFile(self.path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,189 @@
+# storage/backends/s3.py
+import os, threading
+from urllib.parse import quote
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from metrics import STORAGE_BYTES_READ, STORAGE_BYTES_WRITTEN
+from .base import S3_MAX_CONNECTIONS, S3_PRESIGN_EXPIRES, StorageBackend
+
+'''
+Blobs in an S3-compatible bucket (AWS S3, MinIO, moto server...):
+
+    s3://<bucket>/<prefix><digest[0:2]>/<digest[2:4]>/<digest>
+
+Each process keeps one client with a pool of S3_MAX_CONNECTIONS keep-alive
+connections, shared by all of its threads. Blobs above MULTIPART_THRESHOLD are
+uploaded in MULTIPART_CHUNK_SIZE parts, UPLOAD_CONCURRENCY at a time. Reads are
+ranged GETs, so a range request or a decrypted chunk only fetches the bytes it
+needs.
+
+With S3_SERVER_SIDE_ENCRYPTION ('AES256' or 'aws:kms') the bucket encrypts at
+rest, blobs are stored as plaintext and downloads are redirected to presigned
+URLs, keeping file bytes off the web workers altogether. Without it blobs are
+sealed by the application and streamed through it.
+'''
+
+MULTIPART_THRESHOLD = 16 * 1024 * 1024
+MULTIPART_CHUNK_SIZE = 16 * 1024 * 1024
+UPLOAD_CONCURRENCY = 8
+# Bytes fetched per GET by sequential reads
+READ_SIZE = 1024 * 1024
+# Object metadata marking blobs encrypted by the application
+SEALED_METADATA = 'sealed'
+
+_bytes_read = STORAGE_BYTES_READ.labels('s3')
+_bytes_written = STORAGE_BYTES_WRITTEN.labels('s3')
+
+
+class S3File:
+    '''
+    Seekable read-only file object over an object. Sequential reads fetch
+    READ_SIZE at a time, read_at() fetches exactly the range asked for.
+    '''
+
+    def __init__(self, backend, key, size):
+        self._backend = backend
+        self._key = key
+        self.size = size
+        self._position = 0
+        self._buffer = b''
+        self._buffer_start = 0
+        self.closed = False
+
+    def read_at(self, offset, length):
+        if length <= 0 or offset >= self.size:
+            return b''
+        end = min(self.size, offset + length) - 1
+        response = self._backend.client().get_object(Bucket=self._backend.bucket, Key=self._key, Range=f"bytes={offset}-{end}")
+        data = response['Body'].read()
+        _bytes_read.inc(len(data))
+        return data
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self.size, self._position + size)
+        if end <= self._position:
+            return b''
+        buffer_end = self._buffer_start + len(self._buffer)
+        if not self._buffer_start <= self._position < buffer_end or end > buffer_end:
+            self._buffer_start = self._position
+            self._buffer = self.read_at(self._position, max(end - self._position, READ_SIZE))
+        data = self._buffer[self._position - self._buffer_start:end - self._buffer_start]
+        self._position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self._buffer = b''
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class S3Backend(StorageBackend):
+    def __init__(self, bucket, prefix='blobs/', endpoint_url=None, region_name=None, max_connections=None, server_side_encryption=None, presign_expires=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.region_name = region_name
+        self.max_connections = max_connections or S3_MAX_CONNECTIONS
+        self.server_side_encryption = server_side_encryption or None
+        self.presign_expires = presign_expires or S3_PRESIGN_EXPIRES
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Workers build their own client, connections can't cross processes
+        state = self.__dict__.copy()
+        state.update(_client=None, _pid=None, _lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def client(self):
+        # One client per process, boto3 clients are thread safe
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._client = boto3.session.Session().client(
+                        's3', endpoint_url=self.endpoint_url, region_name=self.region_name,
+                        config=Config(max_pool_connections=self.max_connections, retries={"mode": "standard"}),
+                    )
+                    self._pid = os.getpid()
+        return self._client
+
+    def _object_key(self, key):
+        return f"{self.prefix}{key[:2]}/{key[2:4]}/{key}"
+
+    def _head(self, key):
+        try:
+            return self.client().head_object(Bucket=self.bucket, Key=self._object_key(key))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def exists(self, key):
+        return self._head(key) is not None
+
+    def put(self, key, path, sealed):
+        extra = {"Metadata": {SEALED_METADATA: '1' if sealed else '0'}}
+        if self.server_side_encryption:
+            extra["ServerSideEncryption"] = self.server_side_encryption
+        transfer = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, multipart_chunksize=MULTIPART_CHUNK_SIZE, max_concurrency=UPLOAD_CONCURRENCY)
+        self.client().upload_file(path, self.bucket, self._object_key(key), ExtraArgs=extra, Config=transfer)
+        _bytes_written.inc(os.path.getsize(path))
+        os.remove(path)
+
+    def open(self, key):
+        head = self._head(key)
+        if head is None:
+            raise FileNotFoundError(self._object_key(key))
+        return S3File(self, self._object_key(key), head['ContentLength'])
+
+    def delete(self, key):
+        self.client().delete_object(Bucket=self.bucket, Key=self._object_key(key))
+
+    def url(self, key, filename):
+        # Only plaintext objects can be handed out, sealed ones need decrypting here
+        if not self.server_side_encryption:
+            return None
+        head = self._head(key)
+        if head is None or head.get('Metadata', {}).get(SEALED_METADATA) != '0':
+            return None
+        return self.client().generate_presigned_url('get_object', ExpiresIn=self.presign_expires, Params={
+            "Bucket": self.bucket,
+            "Key": self._object_key(key),
+            "ResponseContentDisposition": f"attachment; filename*=UTF-8''{quote(filename)}",
+        })
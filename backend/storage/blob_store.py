@@ -0,0 +1,289 @@
+# storage/blob_store.py
+import hashlib, os, re, shutil, tempfile
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import case, func
+from sqlalchemy.exc import IntegrityError
+from database.models import db, Blob, File, FilePage
+from .backends import LocalFile, create_backend
+from .encryption import decode_master_key, encrypt_file, is_sealed, open_blob
+
+'''
+Content-addressed blob store for uploaded files.
+
+Every upload is keyed by the SHA-256 of its bytes and stored once, by the
+backend STORAGE_BACKEND selects (storage/backends): the local filesystem under
+uploads/blobs, or an S3-compatible bucket.
+
+File rows keep the digest in File.content, and the Blob table counts how many
+File rows point at each digest. Uploading a document that is already stored
+only costs a new File row and a ref_count bump; the bytes are removed once the
+last File referencing them is deleted.
+
+Blobs are encrypted as they move into the backend (storage/encryption.py),
+unless the backend encrypts at rest itself, so only uploads still in progress
+are ever plaintext on disk. Read them back through open_stored_file().
+'''
+
+CHUNK_SIZE = 1024 * 1024
+DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def init_storage(app):
+    app.extensions['storage'] = create_backend(app.config)
+
+
+def storage_backend():
+    return current_app.extensions['storage']
+
+
+def is_blob_digest(content):
+    return bool(DIGEST_PATTERN.match(content))
+
+
+def stored_file_key(file):
+    # The blob digest of a file, or the path of a file uploaded before the blob store
+    if is_blob_digest(file.content):
+        return file.content
+    legacy_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'user-' + str(file.owner_id), 'data-room-' + str(file.parent_data_room_id), 'folder-' + str(file.parent_folder_id))
+    return os.path.join(legacy_folder, file.content)
+
+
+def master_key():
+    return decode_master_key(current_app.config['ENCRYPTION_KEY'])
+
+
+def open_stored_file(key):
+    # (plaintext file object, size) for a key from stored_file_key(), FileNotFoundError when it is gone
+    stored = storage_backend().open(key) if is_blob_digest(key) else LocalFile(key)
+    return open_blob(stored, master_key())
+
+
+def download_url(digest, filename):
+    # A URL serving the blob straight from the backend, None when it has to go through us
+    return storage_backend().url(digest, filename)
+
+
+def _hash_stream(stream):
+    hasher = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        hasher.update(chunk)
+        size += len(chunk)
+    return hasher.hexdigest(), size
+
+
+def _move_into_place(tmp_path, digest):
+    backend = storage_backend()
+    if backend.exists(digest):
+        # Duplicate content, the bytes are already stored
+        os.remove(tmp_path)
+    elif backend.server_side_encryption:
+        backend.put(digest, tmp_path, sealed=False)
+    else:
+        sealed_path = tmp_path + '.sealed'
+        try:
+            encrypt_file(tmp_path, sealed_path, master_key())
+            os.remove(tmp_path)
+            backend.put(digest, sealed_path, sealed=True)
+        finally:
+            if os.path.exists(sealed_path):
+                os.remove(sealed_path)
+
+
+def _copy_into_place(path, digest):
+    # Store the file at path under digest like _move_into_place(), leaving it where it is
+    backend = storage_backend()
+    if backend.exists(digest):
+        return
+    copy_path = path + ('.copy' if backend.server_side_encryption else '.sealed')
+    try:
+        if backend.server_side_encryption:
+            shutil.copyfile(path, copy_path)
+        else:
+            encrypt_file(path, copy_path, master_key())
+        backend.put(digest, copy_path, sealed=not backend.server_side_encryption)
+    finally:
+        if os.path.exists(copy_path):
+            os.remove(copy_path)
+
+
+def store_blob(stream):
+    '''
+    Write the contents of a binary stream to the blob store, returning (digest, size).
+
+    Seekable streams (werkzeug FileStorage streams are) are hashed first and only
+    copied when the digest is not already stored, so duplicate uploads never touch
+    the blob directory. Other streams are hashed while being spooled to a temp file.
+    '''
+    if stream.seekable():
+        start = stream.tell()
+        digest, size = _hash_stream(stream)
+        if storage_backend().exists(digest):
+            return digest, size
+        stream.seek(start)
+
+    tmp_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'tmp')
+    os.makedirs(tmp_folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_folder)
+    try:
+        hasher = hashlib.sha256()
+        size = 0
+        with os.fdopen(fd, 'wb') as tmp_file:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                hasher.update(chunk)
+                tmp_file.write(chunk)
+                size += len(chunk)
+        digest = hasher.hexdigest()
+        _move_into_place(tmp_path, digest)
+        return digest, size
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class BlobMissing(Exception):
+    # The bytes of a blob were unlinked before the reference taken on it was committed
+    pass
+
+
+def acquire_blob(digest, size, restore=None):
+    # Take a reference on a stored blob, registering it on first use. True for a new blob.
+    return bool(acquire_blobs({digest: (size, 1)}, restore))
+
+
+def acquire_blobs(blobs, restore=None):
+    '''
+    Take references on many blobs at once, blobs maps digest -> (size, count).
+    One UPDATE, one SELECT and one bulk INSERT regardless of size. Returns the
+    digests that were registered as new blobs.
+
+    The bytes of a blob nobody referenced until now may have been unlinked
+    since they were stored (see unlink_unreferenced()), so those blobs are
+    checked once the references are held and written again with
+    restore(digest). Without restore, BlobMissing is raised instead.
+    '''
+    if not blobs:
+        return []
+    table = Blob.__table__
+    digests = list(blobs)
+    increments = case({digest: count for digest, (_, count) in blobs.items()}, value=table.c.digest)
+    db.session.execute(table.update().where(table.c.digest.in_(digests)).values(ref_count=table.c.ref_count + increments))
+    ref_counts = dict(db.session.query(Blob.digest, Blob.ref_count).filter(Blob.digest.in_(digests)))
+
+    new_blobs = [{"digest": digest, "size": size, "ref_count": count} for digest, (size, count) in blobs.items() if digest not in ref_counts]
+    if new_blobs:
+        db.session.bulk_insert_mappings(Blob, new_blobs)
+
+    backend = storage_backend()
+    for digest, (_, count) in blobs.items():
+        if ref_counts.get(digest, 0) > count or backend.exists(digest):
+            continue
+        if restore is not None:
+            restore(digest)
+        if restore is None or not backend.exists(digest):
+            raise BlobMissing(f"Blob {digest} is no longer stored")
+    return [blob['digest'] for blob in new_blobs]
+
+
+def release_blobs(digests):
+    '''
+    Drop one reference per entry in digests. Returns the digests left without
+    references, whose bytes unlink_unreferenced() removes once the transaction
+    commits.
+    '''
+    counts = {}
+    for digest in digests:
+        if is_blob_digest(digest):
+            counts[digest] = counts.get(digest, 0) + 1
+    if not counts:
+        return []
+
+    table = Blob.__table__
+    decrements = case(counts, value=table.c.digest)
+    db.session.execute(table.update().where(table.c.digest.in_(list(counts))).values(ref_count=table.c.ref_count - decrements))
+    return [digest for (digest,) in db.session.query(Blob.digest).filter(Blob.digest.in_(list(counts)), Blob.ref_count <= 0)]
+
+
+def unlink_unreferenced(digests):
+    '''
+    Remove the bytes of blobs without references: digests from release_blobs(),
+    or of blobs stored for a write that was rolled back. Call after commit,
+    outside of a transaction.
+
+    Each blob gets a transaction of its own, which deletes its row while
+    ref_count is still 0 (or holds a new one, for bytes that never had a row)
+    and deletes the bytes before it commits. An upload referencing the blob
+    meanwhile waits for that row, then finds the bytes gone and stores them
+    again, so no File ever points at unlinked bytes.
+    '''
+    backend = storage_backend()
+    for digest in set(digests or ()):
+        if not digest or not is_blob_digest(digest):
+            continue
+        try:
+            with db.session.begin():
+                claimed = Blob.query.filter(Blob.digest == digest, Blob.ref_count <= 0).delete(synchronize_session=False)
+                if not claimed:
+                    if db.session.query(Blob.digest).filter_by(digest=digest).first():
+                        # Re-acquired by a concurrent upload
+                        continue
+                    db.session.add(Blob(digest=digest, size=0, ref_count=0))
+                    db.session.flush()
+                    Blob.query.filter_by(digest=digest).delete(synchronize_session=False)
+
+                # Their extracted text leaves the search index with them
+                FilePage.query.filter_by(digest=digest).delete(synchronize_session=False)
+                backend.delete(digest)
+        except IntegrityError:
+            # Registered by a concurrent upload before this could hold the row
+            continue
+
+
+@click.command('encrypt-blobs')
+@with_appcontext
+def encrypt_blobs_command():
+    '''Encrypt stored files that were written before encryption at rest.'''
+    backend = storage_backend()
+    with db.session.begin():
+        # Backends that encrypt at rest keep their blobs as they are
+        digests = [] if backend.server_side_encryption else [digest for (digest,) in db.session.query(Blob.digest).order_by(Blob.digest)]
+        # Files from before the blob store keep their own path
+        legacy_paths = [stored_file_key(file) for file in File.query.filter(func.length(File.content) != 64)]
+
+    key = master_key()
+    tmp_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'tmp')
+    os.makedirs(tmp_folder, exist_ok=True)
+    encrypted = 0
+    for digest in digests:
+        try:
+            stored = backend.open(digest)
+        except FileNotFoundError:
+            continue
+        with stored:
+            if is_sealed(stored):
+                continue
+            fd, tmp_path = tempfile.mkstemp(dir=tmp_folder)
+            with os.fdopen(fd, 'wb') as tmp_file:
+                for chunk in iter(lambda: stored.read(CHUNK_SIZE), b''):
+                    tmp_file.write(chunk)
+        # Readers holding the plaintext open keep reading it after the swap
+        try:
+            encrypt_file(tmp_path, tmp_path + '.sealed', key)
+            backend.put(digest, tmp_path + '.sealed', sealed=True)
+        finally:
+            for path in (tmp_path, tmp_path + '.sealed'):
+                if os.path.exists(path):
+                    os.remove(path)
+        encrypted += 1
+
+    for path in legacy_paths:
+        if os.path.exists(path):
+            with LocalFile(path) as stored:
+                if is_sealed(stored):
+                    continue
+            encrypt_file(path, path, key)
+            encrypted += 1
+    click.echo(f"Encrypted {encrypted} files")
@@ -0,0 +1,253 @@
+# storage/encryption.py
+import base64, hashlib, os, struct, threading
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.keywrap import aes_key_wrap, aes_key_unwrap
+from green import native_thread_pool, on_native_worker
+
+'''
+Chunked AES-GCM encryption of blobs at rest.
+
+Every blob gets its own random 256-bit key, stored in the blob's header wrapped
+(AES key wrap) under the master key from ENCRYPTION_KEY. The plaintext is split
+into ENCRYPTION_CHUNK_SIZE chunks, each encrypted and authenticated on its own:
+
+    header      magic | master key id | chunk size | plaintext size | wrapped key
+    chunk i     AES-GCM(chunk i), nonce = i, associated data = header + i
+
+Binding the header and the chunk index into every tag means chunks can't be
+reordered, dropped or moved between blobs, and the size can't be changed, so a
+tampered blob fails to decrypt instead of returning different bytes.
+
+Since chunk i always starts at HEADER_SIZE + i * (ENCRYPTION_CHUNK_SIZE + TAG_SIZE),
+a range read decrypts only the chunks it overlaps. Larger reads and whole-blob
+encryption spread their chunks over a pool of ENCRYPTION_WORKERS threads, which
+run in parallel since OpenSSL releases the GIL.
+
+Blobs written before encryption, and files from before the blob store, have no
+header and are read as they are. `flask encrypt-blobs` encrypts them in place.
+'''
+
+MAGIC = b'DRBLOB\x00\x01'
+ENCRYPTION_CHUNK_SIZE = 64 * 1024
+TAG_SIZE = 16
+ENCRYPTION_WORKERS = min(8, os.cpu_count() or 1)
+# Chunks read ahead by a sequential reader, and encrypted per batch by a writer
+ENCRYPTION_WINDOW = 4 * ENCRYPTION_WORKERS
+
+_HEADER = struct.Struct('>8s8sIQ40s')
+HEADER_SIZE = _HEADER.size
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class DecryptionError(Exception):
+    pass
+
+
+def _executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = native_thread_pool(ENCRYPTION_WORKERS, 'blob-crypto')
+        return _pool
+
+
+def _forget_pool():
+    # Threads don't survive a fork, children of the web process start their own pool
+    global _pool, _pool_lock
+    _pool, _pool_lock = None, threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_pool)
+
+
+def decode_master_key(value):
+    # ENCRYPTION_KEY is the URL-safe base64 of a 128, 192 or 256-bit key
+    key = base64.urlsafe_b64decode(value)
+    if len(key) not in (16, 24, 32):
+        raise ValueError("ENCRYPTION_KEY must encode a 16, 24 or 32 byte key")
+    return key
+
+
+def _key_id(master_key):
+    return hashlib.sha256(master_key).digest()[:8]
+
+
+def _map(function, items):
+    # Run function over items on the pool, in order, inline when there is only
+    # one or when already on a pool thread under gevent
+    if len(items) <= 1 or on_native_worker():
+        return [function(item) for item in items]
+    return list(_executor().map(function, items))
+
+
+def _nonce(index):
+    return struct.pack('>4xQ', index)
+
+
+def is_sealed(file):
+    # True when a stored file opened by its backend is encrypted
+    return file.read_at(0, len(MAGIC)) == MAGIC
+
+
+def encrypt_file(source, target, master_key):
+    '''
+    Encrypt the plaintext file at source into target, replacing target
+    atomically once it is complete.
+    '''
+    file_key = AESGCM.generate_key(bit_length=256)
+    cipher = AESGCM(file_key)
+    size = os.path.getsize(source)
+    header = _HEADER.pack(MAGIC, _key_id(master_key), ENCRYPTION_CHUNK_SIZE, size, aes_key_wrap(master_key, file_key))
+
+    def encrypt(item):
+        index, chunk = item
+        return cipher.encrypt(_nonce(index), chunk, header + struct.pack('>Q', index))
+
+    partial = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(source, 'rb') as plaintext, open(partial, 'wb') as ciphertext:
+            ciphertext.write(header)
+            index = 0
+            while True:
+                batch = []
+                for _ in range(ENCRYPTION_WINDOW):
+                    chunk = plaintext.read(ENCRYPTION_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    batch.append((index, chunk))
+                    index += 1
+                if not batch:
+                    break
+                for sealed in _map(encrypt, batch):
+                    ciphertext.write(sealed)
+        os.replace(partial, target)
+    except Exception:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+
+class DecryptingReader:
+    '''
+    Read-only, seekable file object over an encrypted blob, returning plaintext.
+
+    Reads decrypt the chunks they overlap. While reads stay sequential, the
+    reader also decrypts up to ENCRYPTION_WINDOW chunks ahead in parallel,
+    doubling the distance after every sequential read, so a full download runs
+    on every worker while a short range read decrypts little more than it asks
+    for. There is deliberately no fileno(), servers must not sendfile() it.
+
+    file is a stored file opened by a backend (storage/backends), read through
+    its read_at().
+    '''
+
+    def __init__(self, file, master_key):
+        self._file = file
+        header = file.read_at(0, HEADER_SIZE)
+        if len(header) != HEADER_SIZE:
+            raise DecryptionError("Truncated blob header")
+        magic, key_id, self._chunk_size, self.size, wrapped_key = _HEADER.unpack(header)
+        if key_id != _key_id(master_key):
+            raise DecryptionError("Blob is encrypted under a different master key")
+        self._header = header
+        self._cipher = AESGCM(aes_key_unwrap(master_key, wrapped_key))
+        self._chunks = -(-self.size // self._chunk_size)
+        self._position = 0
+        self._decrypted = {}
+        self._ahead = 0
+
+    def _decrypt(self, item):
+        index, sealed = item
+        try:
+            return self._cipher.decrypt(_nonce(index), sealed, self._header + struct.pack('>Q', index))
+        except Exception:
+            raise DecryptionError(f"Chunk {index} failed authentication")
+
+    def _load(self, indexes):
+        # Fetch consecutive chunks with one read, then decrypt them in parallel
+        sealed_size = self._chunk_size + TAG_SIZE
+        first, last = indexes[0], indexes[-1]
+        data = self._file.read_at(HEADER_SIZE + first * sealed_size, (last - first + 1) * sealed_size)
+        return _map(self._decrypt, [(index, data[(index - first) * sealed_size:(index - first + 1) * sealed_size]) for index in range(first, last + 1)])
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self.size, self._position + size)
+        if end <= self._position:
+            return b''
+        first, last = self._position // self._chunk_size, (end - 1) // self._chunk_size
+
+        # Chunks behind this read are never needed again by a sequential reader
+        wanted = range(first, min(self._chunks - 1, last + self._ahead) + 1)
+        self._decrypted = {index: self._decrypted[index] for index in wanted if index in self._decrypted}
+        missing = [index for index in wanted if index not in self._decrypted]
+        if missing:
+            # One read from the first missing chunk to the last, whatever is cached between
+            for index, chunk in zip(range(missing[0], missing[-1] + 1), self._load(missing)):
+                self._decrypted[index] = chunk
+        self._ahead = min(ENCRYPTION_WINDOW, max(1, self._ahead * 2))
+
+        offset = self._position - first * self._chunk_size
+        if first == last:
+            data = self._decrypted[first][offset:offset + end - self._position]
+        else:
+            data = b''.join(self._decrypted[index] for index in range(first, last + 1))[offset:offset + end - self._position]
+        self._position = end
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        if offset != self._position:
+            # Random access, stop reading ahead
+            self._ahead = 0
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self._decrypted = {}
+        self._file.close()
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_blob(file, master_key):
+    '''
+    Plaintext view of a stored file opened by its backend, decrypting it when
+    it is encrypted. Returns (file object, plaintext size).
+    '''
+    try:
+        if not is_sealed(file):
+            return file, file.size
+        reader = DecryptingReader(file, master_key)
+        return reader, reader.size
+    except Exception:
+        file.close()
+        raise
@@ -0,0 +1,145 @@
+# storage/upload_sessions.py
+import fcntl, hashlib, os, threading, time
+from datetime import datetime, timedelta
+from flask import current_app
+from database.models import db, UploadSession
+from .blob_store import CHUNK_SIZE, _copy_into_place, _hash_stream
+
+'''
+On-disk state for chunked, resumable uploads.
+
+Each session streams into uploads/sessions/<upload_id>.part. The size of the part
+file is the resume offset, so a client that lost its connection asks for the
+session status and continues from there, even if it lands on another worker.
+
+Chunks that arrive in order are hashed as they are written. The running hasher
+lives in this process only; if a session is resumed elsewhere, the part file is
+re-hashed once when the upload is finalized.
+
+Sessions that go UPLOAD_SESSION_TTL seconds without receiving a chunk are
+abandoned, the purge worker deletes them and their part files.
+'''
+
+UPLOAD_SESSION_TTL = 24 * 3600
+
+_hashers = {}
+_hashers_lock = threading.Lock()
+
+
+class ChunkConflict(Exception):
+    # Raised when a chunk does not start at the current end of the upload
+    def __init__(self, offset):
+        super().__init__(f"Expected chunk at offset {offset}")
+        self.offset = offset
+
+
+def session_path(upload_id):
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], 'sessions', upload_id + '.part')
+
+
+def start_session(upload_id):
+    path = session_path(upload_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    with _hashers_lock:
+        _hashers[upload_id] = (0, hashlib.sha256())
+
+
+def received_bytes(upload_id):
+    path = session_path(upload_id)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def write_chunk(upload_id, offset, stream, max_size):
+    '''
+    Append a chunk read from stream at offset, returning the new end offset.
+    Bytes beyond max_size are left unread. Raises ChunkConflict when the chunk
+    does not continue the upload or another request is writing to the session.
+    '''
+    with open(session_path(upload_id), 'r+b') as part_file:
+        try:
+            fcntl.flock(part_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise ChunkConflict(received_bytes(upload_id))
+
+        end = part_file.seek(0, os.SEEK_END)
+        if offset != end:
+            raise ChunkConflict(end)
+
+        with _hashers_lock:
+            hashed_offset, hasher = _hashers.pop(upload_id, (None, None))
+        if hashed_offset != offset:
+            hasher = None
+
+        # Never read past the size declared when the session was started
+        remaining = max_size - end
+        while remaining > 0:
+            chunk = stream.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            part_file.write(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+            end += len(chunk)
+            remaining -= len(chunk)
+
+        if hasher is not None:
+            with _hashers_lock:
+                _hashers[upload_id] = (end, hasher)
+        return end
+
+
+def session_digest(upload_id):
+    # (digest, size) of a complete upload
+    path = session_path(upload_id)
+    size = os.path.getsize(path)
+    with _hashers_lock:
+        hashed_offset, hasher = _hashers.pop(upload_id, (None, None))
+
+    if hashed_offset == size:
+        return hasher.hexdigest(), size
+    # The session was written by another worker, hash the part file once
+    with open(path, 'rb') as part_file:
+        digest, _ = _hash_stream(part_file)
+    return digest, size
+
+
+def finish_session(upload_id, digest):
+    '''
+    Store a complete upload in the blob store under its digest from
+    session_digest(). The part file stays until discard_session(), so the
+    upload can still be completed again if the transaction fails.
+    '''
+    _copy_into_place(session_path(upload_id), digest)
+
+
+def discard_session(upload_id):
+    with _hashers_lock:
+        _hashers.pop(upload_id, None)
+    path = session_path(upload_id)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def expire_sessions(ttl=UPLOAD_SESSION_TTL):
+    # Delete sessions started and last written to more than ttl seconds ago, returns how many
+    cutoff = datetime.utcnow() - timedelta(seconds=ttl)
+    with db.session.begin():
+        started = [id for (id,) in db.session.query(UploadSession.id).filter(UploadSession.created_at < cutoff)]
+
+    # The part file's modification time is the last chunk received
+    idle = []
+    for upload_id in started:
+        try:
+            if time.time() - os.path.getmtime(session_path(upload_id)) > ttl:
+                idle.append(upload_id)
+        except FileNotFoundError:
+            idle.append(upload_id)
+    if not idle:
+        return 0
+
+    with db.session.begin():
+        expired = UploadSession.query.filter(UploadSession.id.in_(idle)).delete(synchronize_session=False)
+    for upload_id in idle:
+        discard_session(upload_id)
+    return expired
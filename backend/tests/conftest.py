@@ -0,0 +1,76 @@
+# tests/conftest.py
+import io, os, sys
+import pytest
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+'''
+Fixtures for tests against the Flask test client, on a fresh SQLite database
+and upload folder per test, with the background workers switched off.
+'''
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'test.db'}")
+    monkeypatch.setenv('UPLOAD_FOLDER', str(tmp_path / 'uploads'))
+    for worker in ('PURGE_INTERVAL', 'SEARCH_WORKERS', 'PREVIEW_WORKERS'):
+        monkeypatch.setenv(worker, '0')
+    from app_factory import create_app
+    return create_app()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def auth(client):
+    token = client.post('/login', json={"username": "alice"}).get_json()['access_token']
+    return {"Authorization": f"Bearer {token}"}
+
+
+class Statements:
+    # Counts the SQL statements the app's engine executes while counting
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+@pytest.fixture
+def statements(app):
+    from database import db
+    counter = Statements()
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', counter)
+    yield counter
+    event.remove(engine, 'before_cursor_execute', counter)
+
+
+def create_data_room(client, auth, name):
+    response = client.post('/data-room', json={"name": name}, headers=auth)
+    assert response.status_code == 201, response.get_json()
+    from database.models import DataRoom
+    with client.application.app_context():
+        return DataRoom.query.filter_by(name=name).one().id
+
+
+def create_folder(client, auth, name, data_room_id, parent_folder_id=None):
+    response = client.post('/folder', json={"name": name, "parent_data_room_id": data_room_id, "parent_folder_id": parent_folder_id}, headers=auth)
+    assert response.status_code == 201, response.get_json()
+    from database.models import Folder
+    with client.application.app_context():
+        return Folder.query.filter_by(name=name, parent_data_room_id=data_room_id, parent_folder_id=parent_folder_id).one().id
+
+
+def create_file(client, auth, name, data_room_id, parent_folder_id=None, content=b'%PDF-1.4 test'):
+    data = {"name": name, "parent_data_room_id": str(data_room_id), "files": (io.BytesIO(content), name)}
+    if parent_folder_id:
+        data['parent_folder_id'] = str(parent_folder_id)
+    response = client.post('/file', data=data, headers=auth)
+    assert response.status_code == 200, response.get_json()
@@ -0,0 +1,25 @@
+# tests/test_archive.py
+import io, zipfile
+from conftest import create_data_room, create_file, create_folder
+
+'''
+Names that only differ in characters a ZIP path can't hold still get an entry
+each (see storage/archive.py).
+'''
+
+
+def test_sanitized_names_stay_unique(client, auth):
+    data_room_id = create_data_room(client, auth, "Room")
+    create_folder(client, auth, "Q1/Q2", data_room_id)
+    create_folder(client, auth, "Q1_Q2", data_room_id)
+    create_file(client, auth, "a/b.pdf", data_room_id, content=b'slash')
+    create_file(client, auth, "a_b.pdf", data_room_id, content=b'underscore')
+    create_file(client, auth, "a\\b.pdf", data_room_id, content=b'backslash')
+
+    response = client.get(f'/data-room/{data_room_id}/archive', headers=auth)
+    assert response.status_code == 200
+    archive = zipfile.ZipFile(io.BytesIO(response.get_data()))
+    names = archive.namelist()
+    assert len(names) == len(set(names))
+    assert sorted(names) == ["Q1_Q2 (2)/", "Q1_Q2/", "a_b (2).pdf", "a_b (3).pdf", "a_b.pdf"]
+    assert sorted(archive.read(name) for name in names if not name.endswith('/')) == [b'backslash', b'slash', b'underscore']
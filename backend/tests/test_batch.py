@@ -0,0 +1,25 @@
+# tests/test_batch.py
+from conftest import create_data_room, create_file
+
+'''
+Operations are validated one by one before the batch touches the database
+(see routes/batch.py).
+'''
+
+
+def test_booleans_are_not_ids(app, client, auth):
+    data_room_id = create_data_room(client, auth, "Room")
+    create_file(client, auth, "Lease.pdf", data_room_id)
+    from database.models import File
+    with app.app_context():
+        file_id = File.query.filter_by(name="Lease.pdf").one().id
+    assert file_id == 1
+
+    response = client.post('/batch', json={"operations": [
+        {"op": "delete", "type": "file", "id": True},
+        {"op": "move", "type": "file", "id": file_id, "parent_data_room_id": True},
+        {"op": "rename", "type": "file", "id": file_id, "name": "Renamed.pdf"},
+    ]}, headers=auth)
+    assert [result["status"] for result in response.get_json()["results"]] == [400, 400, 200]
+    with app.app_context():
+        assert File.query.get(file_id).name == "Renamed.pdf"
@@ -0,0 +1,42 @@
+# tests/test_previews.py
+import io, os
+import pypdfium2 as pdfium
+from conftest import create_data_room, create_file
+
+'''
+Pages a file doesn't have are turned away by its recorded page count and leave
+nothing behind in the preview cache (see previews/rendering.py).
+'''
+
+
+def pdf(pages):
+    document = pdfium.PdfDocument.new()
+    for _ in range(pages):
+        document.new_page(200, 300)
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+
+def cached(app):
+    directory = os.path.join(app.config['UPLOAD_FOLDER'], 'previews')
+    return sorted((name, os.path.getsize(os.path.join(root, name))) for root, _, names in os.walk(directory) for name in names)
+
+
+def test_pages_past_the_end(app, client, auth):
+    data_room_id = create_data_room(client, auth, "Room")
+    create_file(client, auth, "Deck.pdf", data_room_id, content=pdf(2))
+    create_file(client, auth, "Notes.txt", data_room_id, content=b'not a pdf')
+    from database.models import File
+    with app.app_context():
+        deck, notes = (File.query.filter_by(name=name).one() for name in ("Deck.pdf", "Notes.txt"))
+
+    assert client.get(f'/file/{deck.id}/preview?size=page&page=2', headers=auth).status_code == 200
+    for page in (3, 1000, 10 ** 9):
+        assert client.get(f'/file/{deck.id}/preview?size=page&page={page}', headers=auth).status_code == 404
+    for page in (1, 2):
+        assert client.get(f'/file/{notes.id}/preview?page={page}', headers=auth).status_code == 404
+
+    entries = cached(app)
+    assert [name for name, _ in entries] == sorted([f"{deck.content}-page-2.jpg", f"{deck.content}.pages", f"{notes.content}.pages"])
+    assert all(size > 0 for _, size in entries)
@@ -0,0 +1,59 @@
+# tests/test_query_counts.py
+import pytest
+from conftest import create_data_room, create_file, create_folder
+
+'''
+Listings and views run a fixed number of SQL statements however many rooms,
+folders and files there are (see database/pagination.py). A count that grows
+with the tree means an N+1 query crept back in.
+'''
+
+# Rooms, folders per room and files per folder of the small and the large tree
+TREES = [(1, 1, 1), (4, 5, 3)]
+
+
+def build_tree(client, auth, rooms, folders, files):
+    tree = []
+    for room in range(rooms):
+        data_room_id = create_data_room(client, auth, f"Room {room}")
+        parent_folder_id = None
+        for folder in range(folders):
+            # Half of the folders nest under the previous one
+            folder_id = create_folder(client, auth, f"Folder {folder}", data_room_id, parent_folder_id if folder % 2 else None)
+            for file in range(files):
+                create_file(client, auth, f"File {file}.pdf", data_room_id, folder_id, content=f"{room} {folder} {file}".encode())
+            create_file(client, auth, f"Top {folder}.pdf", data_room_id)
+            parent_folder_id = folder_id
+        tree.append((data_room_id, parent_folder_id))
+    return tree
+
+
+def count(client, auth, statements, url, status=200, headers=None):
+    # Statements of one request, with the access cache cleared so ownership is looked up again
+    client.application.extensions.pop('access_cache', None)
+    statements.count = 0
+    response = client.get(url, headers={**auth, **(headers or {})})
+    response.get_data()
+    assert response.status_code == status, response.get_json()
+    return statements.count, response
+
+
+@pytest.mark.parametrize('rooms, folders, files', TREES)
+def test_listing_statements(client, auth, statements, rooms, folders, files):
+    [(data_room_id, folder_id), *_] = build_tree(client, auth, rooms, folders, files)
+
+    assert count(client, auth, statements, '/data-room')[0] == 4
+    assert count(client, auth, statements, f'/data-room/{data_room_id}')[0] == 4
+    assert count(client, auth, statements, f'/data-room/{data_room_id}/tree')[0] == 2
+    assert count(client, auth, statements, f'/folder/{folder_id}')[0] == 4
+    assert count(client, auth, statements, '/user')[0] == 1
+
+
+@pytest.mark.parametrize('rooms, folders, files', TREES)
+def test_not_modified_statements(client, auth, statements, rooms, folders, files):
+    [(data_room_id, folder_id), *_] = build_tree(client, auth, rooms, folders, files)
+
+    # Revalidating a listing only reads the versions
+    for url, expected in (('/data-room', 1), (f'/data-room/{data_room_id}', 1), (f'/folder/{folder_id}', 2)):
+        etag = client.get(url, headers=auth).headers['ETag']
+        assert count(client, auth, statements, url, 304, {"If-None-Match": etag})[0] == expected
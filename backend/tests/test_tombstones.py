@@ -0,0 +1,55 @@
+# tests/test_tombstones.py
+import io
+import pytest
+from conftest import create_data_room, create_file, create_folder
+
+'''
+Writes check deleted state against the database, not the access cache: a
+worker whose cache predates a delete made by another worker must not delete
+the item again or write into it (see database/permissions.py).
+'''
+
+
+@pytest.fixture
+def other(app):
+    # A second worker on the same database, with its own access cache
+    from app_factory import create_app
+    return create_app().test_client()
+
+
+def usage(app, data_room_id, folder_id):
+    from database.models import DataRoom, Folder, User
+    with app.app_context():
+        data_room, folder = DataRoom.query.get(data_room_id), Folder.query.get(folder_id)
+        return User.query.filter_by(username='alice').one().used_bytes, data_room.file_count, data_room.total_bytes, folder.total_bytes
+
+
+def test_stale_cache_writes_into_deleted_folder(app, client, auth, other):
+    data_room_id = create_data_room(client, auth, "Room")
+    folder_id = create_folder(client, auth, "Folder", data_room_id)
+    create_file(client, auth, "Lease.pdf", data_room_id, folder_id)
+    from database.models import File
+    with app.app_context():
+        file_id = File.query.filter_by(name="Lease.pdf").one().id
+
+    # The other worker caches the folder and the file as live
+    assert other.get(f'/folder/{folder_id}', headers=auth).status_code == 200
+    assert other.get(f'/file/{file_id}', headers=auth).status_code == 200
+
+    assert client.delete(f'/folder/{folder_id}', headers=auth).status_code == 200
+    before = usage(app, data_room_id, folder_id)
+    assert before[:3] == (0, 0, 0)
+
+    assert other.delete(f'/folder/{folder_id}', headers=auth).status_code == 404
+    assert other.delete(f'/file/{file_id}', headers=auth).status_code == 404
+    assert other.put(f'/folder/{folder_id}', json={"name": "Moved", "parent_data_room_id": data_room_id}, headers=auth).status_code == 404
+    assert other.put(f'/file/{file_id}', json={"name": "Moved.pdf", "parent_data_room_id": data_room_id}, headers=auth).status_code == 404
+    upload = {"name": "New.pdf", "parent_data_room_id": str(data_room_id), "parent_folder_id": str(folder_id), "files": (io.BytesIO(b'%PDF-1.4 new'), "New.pdf")}
+    assert other.post('/file', data=upload, headers=auth).status_code == 404
+    started = other.post('/file/upload', json={"name": "New.pdf", "size": 3, "parent_data_room_id": data_room_id, "parent_folder_id": folder_id}, headers=auth)
+    assert started.status_code == 404
+    assert usage(app, data_room_id, folder_id) == before
+
+    from database.models import Change
+    with app.app_context():
+        assert Change.query.filter_by(kind='folder', op='delete').count() == 1
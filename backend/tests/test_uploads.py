@@ -0,0 +1,35 @@
+# tests/test_uploads.py
+import os
+from conftest import create_data_room
+
+'''
+A chunked upload keeps its received bytes until completing it commits, so a
+failed completion can be retried (see routes/upload.py).
+'''
+
+
+def test_complete_again_after_a_failed_commit(app, client, auth, monkeypatch):
+    data_room_id = create_data_room(client, auth, "Room")
+    content = b'%PDF-1.4 chunked'
+    started = client.post('/file/upload', json={"name": "Deck.pdf", "size": len(content), "parent_data_room_id": data_room_id}, headers=auth)
+    upload_id = started.get_json()['upload_id']
+    assert client.put(f'/file/upload/{upload_id}?offset=0', data=content, headers=auth).status_code == 200
+
+    import routes.upload
+    from storage.upload_sessions import session_path
+
+    def fail(changes):
+        raise RuntimeError("commit failed")
+
+    monkeypatch.setattr(routes.upload, 'record_changes', fail)
+    assert client.post(f'/file/upload/{upload_id}/complete', headers=auth).status_code == 500
+    with app.app_context():
+        assert os.path.getsize(session_path(upload_id)) == len(content)
+    assert client.get(f'/file/upload/{upload_id}', headers=auth).get_json()['offset'] == len(content)
+
+    monkeypatch.undo()
+    completed = client.post(f'/file/upload/{upload_id}/complete', headers=auth)
+    assert completed.status_code == 201
+    with app.app_context():
+        assert not os.path.exists(session_path(upload_id))
+    assert client.get(f"/file/{completed.get_json()['id']}", headers=auth).get_data() == content
@@ -0,0 +1,37 @@
+# transfers.py
+from gevent import monkey
+monkey.patch_all()
+from app_factory import create_app
+
+'''
+The app for gevent workers (make serve_transfers), which the endpoints that
+move file bytes are routed to:
+
+    GET  /file/<id>                                       downloads and ranges
+    POST /file, POST /file/bulk, PUT /file/upload/<id>    uploads
+    GET  /folder/<id>/archive, GET /data-room/<id>/archive
+    GET  /data-room/<id>/changes                          change feeds, only served here
+
+A gevent worker serves every connection from a greenlet, so a slow client
+parked on a socket read or write costs a few kilobytes instead of one of the 8
+threads of a `make serve` worker, and a node holds thousands of transfers.
+The views are the same as in app.py. They hold a database connection only for
+their short transactions, never while the body streams, and with psycopg2
+patched a greenlet waiting on Postgres yields to the others too. Encryption
+runs on real threads (storage/encryption.py).
+
+Change feeds wait for the next change, up to 30 seconds for a long-poll and 5
+minutes for an event stream, and are only registered here (routes/changes.py).
+
+Metadata routes stay on the threaded workers. Both kinds of worker run the
+same code against the same database, so either can serve any other route.
+'''
+
+try:
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+except ImportError:
+    # No psycopg2, the database is SQLite
+    pass
+
+app = create_app()